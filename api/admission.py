@@ -0,0 +1,309 @@
+"""
+Admission control: turn traffic spikes into fast refusals instead of a
+database meltdown.
+
+Two layers, both per worker process:
+
+1. Rate limits. Each client (remote address, or behind proxies the entry
+   ADMISSION['trusted_hops'] from the right of ADMISSION['client_header'])
+   has a token bucket refilled at ADMISSION['rate'] requests per second,
+   holding up to ADMISSION['burst']. A client that is out of tokens gets
+   429 with Retry-After before the request does any work.
+
+2. A cap on concurrent database work. At most ADMISSION['max_concurrent']
+   requests of this process hold the database at once. A request takes its
+   slot when it first borrows a pooled connection (db.ConnectionPool.getconn
+   calls admit()) and keeps it until it finishes, so requests answered from
+   the catalog cache or the image store never queue. Requests over the cap
+   wait up to ADMISSION['max_wait'] seconds in a short queue
+   (ADMISSION['queue_size']), served by priority: cart and checkout, then
+   catalog reads, then debug endpoints, which never wait at all. A full queue
+   drops its lowest priority waiter to make room for a higher one. Requests
+   that don't get a slot are answered 503 with Retry-After.
+
+Health checks and /metrics are exempt from both. Queue depth, slots in use
+and shed counts are exported to /metrics.
+
+In ASGI mode (asgi.py) the async catalog handlers are rate limited the same
+way, but don't take slots: they borrow from the async pool, which bounds
+their database work by itself and answers 503 when its wait times out.
+Routes delegated to the Flask app get both layers.
+"""
+import heapq
+import itertools
+import math
+import threading
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+
+from flask import jsonify, request
+
+import metrics
+from config import ADMISSION
+
+# Lower is served first
+PRIORITIES = {'cart': 0, 'catalog': 1, 'debug': 2}
+
+# Paths that skip admission control entirely
+EXEMPT_PREFIXES = ('/api/health/', '/metrics')
+
+SHED = metrics.registry.register(metrics.Counter(
+    'admission_shed_total', 'Requests refused by admission control, by priority and reason.',
+    ('priority', 'reason')))
+QUEUE_WAIT_SECONDS = metrics.registry.register(metrics.Histogram(
+    'admission_queue_wait_seconds', 'Time requests waited in the admission queue for a database slot.',
+    buckets=metrics.QUERY_BUCKETS))
+
+
+class Overloaded(Exception):
+    """No database slot became available; answered with 503 and Retry-After."""
+
+    def __init__(self, message, reason, retry_after=None):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def classify(path):
+    """Priority class of a request path, or None when it is exempt."""
+    if path.startswith(EXEMPT_PREFIXES):
+        return None
+    if path.startswith('/api/debug/'):
+        return 'debug'
+    if path.startswith('/api/cart'):
+        return 'cart'
+    return 'catalog'
+
+
+class RateLimiter:
+    """Token bucket per client, for the most recently seen `max_clients` clients."""
+
+    def __init__(self, rate, burst, max_clients):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self._limited = 0
+
+    def take(self, client):
+        """Spend a token; returns 0 if allowed, else the seconds until one is available."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(client)
+            if bucket is None:
+                if len(self._buckets) >= self.max_clients:
+                    self._buckets.popitem(last=False)
+                bucket = self._buckets[client] = [self.burst, now]
+            else:
+                self._buckets.move_to_end(client)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            self._limited += 1
+            return (1 - bucket[0]) / self.rate
+
+    def stats(self):
+        with self._lock:
+            return {'clients': len(self._buckets), 'rate_limited': self._limited}
+
+
+class _Waiter:
+    __slots__ = ('event', 'state')
+
+    def __init__(self):
+        self.event = threading.Event()
+        # None while queued, then 'granted' or 'shed'
+        self.state = None
+
+
+class ConcurrencyLimiter:
+    """
+    Counting semaphore with a bounded priority queue. A released slot goes
+    straight to the best waiter (lowest priority number, then arrival order).
+    """
+
+    def __init__(self, limit, queue_size):
+        self.limit = limit
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._active = 0
+        self._queue = []
+        self._seq = itertools.count()
+        self._stats = {'admitted': 0, 'queued': 0, 'shed': 0}
+
+    def acquire(self, priority, max_wait):
+        """Take a slot, waiting up to max_wait seconds; raises Overloaded."""
+        with self._lock:
+            if self._active < self.limit and not self._queue:
+                self._active += 1
+                self._stats['admitted'] += 1
+                return
+            if max_wait <= 0:
+                self._shed()
+                raise Overloaded("Server is busy", 'busy')
+            if len(self._queue) >= self.queue_size:
+                # No queue at all (queue_size 0), or no waiter worse than this one
+                if not self._queue or max(self._queue)[0] <= priority:
+                    self._shed()
+                    raise Overloaded("Server is busy", 'queue_full')
+                # Make room by dropping the lowest priority, latest arrival
+                worst = max(self._queue)
+                self._queue.remove(worst)
+                heapq.heapify(self._queue)
+                worst[2].state = 'shed'
+                worst[2].event.set()
+            waiter = _Waiter()
+            heapq.heappush(self._queue, (priority, next(self._seq), waiter))
+            self._stats['queued'] += 1
+
+        started = time.monotonic()
+        waiter.event.wait(max_wait)
+        with self._lock:
+            if waiter.state == 'granted':
+                self._stats['admitted'] += 1
+                QUEUE_WAIT_SECONDS.observe(time.monotonic() - started)
+                return
+            reason = 'queue_full'
+            if waiter.state is None:
+                reason = 'timeout'
+                self._queue = [entry for entry in self._queue if entry[2] is not waiter]
+                heapq.heapify(self._queue)
+            self._shed()
+        raise Overloaded("Server is busy", reason)
+
+    def _shed(self):
+        self._stats['shed'] += 1
+
+    def release(self):
+        with self._lock:
+            if self._queue:
+                # Hand the slot over; the count of active slots stays the same
+                _, _, waiter = heapq.heappop(self._queue)
+                waiter.state = 'granted'
+                waiter.event.set()
+            else:
+                self._active -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'limit': self.limit,
+                'active': self._active,
+                'queue_depth': len(self._queue),
+                'queue_size': self.queue_size,
+                **self._stats,
+            }
+
+
+class _Ticket:
+    """Admission state of the current request."""
+    __slots__ = ('priority_class', 'admitted')
+
+    def __init__(self, priority_class):
+        self.priority_class = priority_class
+        self.admitted = False
+
+
+_rate_limiter = RateLimiter(ADMISSION['rate'], ADMISSION['burst'], ADMISSION['max_clients'])
+_limiter = ConcurrencyLimiter(ADMISSION['max_concurrent'], ADMISSION['queue_size'])
+_ticket = ContextVar('admission_ticket', default=None)
+
+
+def admit():
+    """
+    Take a database slot for the current request if it doesn't hold one
+    yet. A no-op outside requests (background threads, scripts) and for
+    exempt ones. Raises Overloaded when no slot frees up in time.
+    """
+    ticket = _ticket.get()
+    if ticket is None or ticket.admitted:
+        return
+    priority_class = ticket.priority_class
+    max_wait = 0 if priority_class == 'debug' else ADMISSION['max_wait']
+    try:
+        _limiter.acquire(PRIORITIES[priority_class], max_wait)
+    except Overloaded as e:
+        SHED.inc(1, priority_class, e.reason)
+        e.retry_after = ADMISSION['retry_after']
+        raise
+    ticket.admitted = True
+
+
+def client_key(headers, remote_addr):
+    """Rate limit key of a request, from its headers and remote address."""
+    if ADMISSION['client_header']:
+        # X-Forwarded-For style headers: each proxy appends the address it
+        # got the request from, and anything left of our own proxies' entries
+        # is whatever the client sent. Counting trusted hops from the right
+        # gives an address the client can't choose.
+        hops = [hop.strip() for hop in headers.get(ADMISSION['client_header'], '').split(',')]
+        hops = [hop for hop in hops if hop]
+        if len(hops) >= ADMISSION['trusted_hops']:
+            return hops[-ADMISSION['trusted_hops']]
+    return remote_addr or 'unknown'
+
+
+def client_id():
+    return client_key(request.headers, request.remote_addr)
+
+
+def rate_limit(client, priority_class):
+    """Spend one of the client's tokens; returns 0 if allowed, else the seconds to wait."""
+    if not ADMISSION['enabled'] or ADMISSION['rate'] <= 0 or priority_class is None:
+        return 0
+    wait = _rate_limiter.take(client)
+    if wait:
+        SHED.inc(1, priority_class, 'rate_limited')
+    return wait
+
+
+def retry_after(e=None):
+    """Retry-After header value for an overloaded response."""
+    return str(math.ceil(getattr(e, 'retry_after', None) or ADMISSION['retry_after']))
+
+
+def overloaded_response(e=None):
+    """503 telling the client when to retry (for Overloaded and pool timeouts)."""
+    response = jsonify({"error": "Server is busy, please retry"})
+    response.status_code = 503
+    response.headers['Retry-After'] = retry_after(e)
+    return response
+
+
+def stats():
+    return {**_limiter.stats(), **_rate_limiter.stats()}
+
+
+def init_app(app):
+    """Rate limit and track the database slots of a Flask app's requests."""
+    if not ADMISSION['enabled']:
+        return
+
+    @app.before_request
+    def admit_request():
+        priority_class = classify(request.path)
+        if priority_class is None:
+            _ticket.set(None)
+            return None
+        wait = rate_limit(client_id(), priority_class)
+        if wait:
+            _ticket.set(None)
+            response = jsonify({"error": "Too many requests"})
+            response.status_code = 429
+            response.headers['Retry-After'] = str(math.ceil(wait))
+            return response
+        _ticket.set(_Ticket(priority_class))
+        return None
+
+    @app.teardown_request
+    def release_slot(exc):
+        ticket = _ticket.get()
+        _ticket.set(None)
+        if ticket is not None and ticket.admitted:
+            _limiter.release()
+
+    app.register_error_handler(Overloaded, overloaded_response)
@@ -0,0 +1,330 @@
+"""
+ASGI entry point for the API.
+
+Catalog reads (categories, products, featured, search, browse) are served by async handlers
+on an async psycopg connection pool, so a single process can keep many
+requests waiting on Postgres without tying up a thread per request. They
+use the same SQL and response shapes as the Flask handlers (catalog.py)
+and share the catalog cache and ETags. Every other route (cart, images,
+debug) is delegated to the Flask app through asgiref's WsgiToAsgi, so both
+modes expose exactly the same API.
+
+Run with:
+    SERVER_MODE=asgi python main.py
+or
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+"""
+import logging
+import math
+import time
+from contextlib import asynccontextmanager
+
+from asgiref.wsgi import WsgiToAsgi
+from psycopg.conninfo import make_conninfo
+from psycopg.rows import dict_row
+from psycopg.types.numeric import FloatLoader
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Mount, Route
+from werkzeug.http import http_date, parse_date, parse_etags
+
+import admission
+import catalog
+import metrics
+from cache import catalog_cache, catalog_flights, ensure_invalidation_listener
+from config import DB_CONFIG, DB_POOL, FEATURED_REFRESH, METRICS, QUERY_LOG
+from http_cache import CACHE_CONTROL, build_cached_body
+from main import app as flask_app
+from query_log import query_log
+
+logger = logging.getLogger(__name__)
+
+async def configure_connection(conn):
+    # NUMERIC as float, like the psycopg2 typecaster in db.py
+    conn.adapters.register_loader('numeric', FloatLoader)
+
+
+pool = AsyncConnectionPool(
+    make_conninfo(
+        host=DB_CONFIG['host'],
+        port=DB_CONFIG['port'],
+        dbname=DB_CONFIG['database'],
+        user=DB_CONFIG['user'],
+        password=DB_CONFIG['password'],
+    ),
+    kwargs={'row_factory': dict_row},
+    configure=configure_connection,
+    min_size=DB_POOL['min_size'],
+    max_size=DB_POOL['max_size'],
+    timeout=DB_POOL['timeout'],
+    max_lifetime=DB_POOL['max_age'] or 3600.0,
+    max_idle=DB_POOL['validate_after'] * 10,
+    check=AsyncConnectionPool.check_connection,
+    open=False,
+)
+
+
+async def run_catalog_query(query):
+    borrow_started = time.perf_counter()
+    async with pool.connection() as conn:
+        metrics.observe_pool_wait(time.perf_counter() - borrow_started)
+        async with conn.cursor() as cur:
+            query_started = time.perf_counter()
+            await cur.execute(query.sql, query.params)
+            rows = await cur.fetchone() if query.one else await cur.fetchall()
+            elapsed = time.perf_counter() - query_started
+            metrics.observe_query(elapsed)
+            if QUERY_LOG['enabled']:
+                # Stats and slow-query log only; plans are captured by the sync path
+                query_log.observe(query.sql, elapsed, cur.rowcount)
+    return query.shape(rows)
+
+
+def rate_limited(handler):
+    """Rate limit a handler's clients, like admission.init_app() does for the Flask routes."""
+    async def endpoint(request):
+        client = admission.client_key(request.headers, request.client.host if request.client else None)
+        wait = admission.rate_limit(client, admission.classify(request.url.path))
+        if wait:
+            return JSONResponse({"error": "Too many requests"}, status_code=429,
+                                headers={'Access-Control-Allow-Origin': '*',
+                                         'Retry-After': str(math.ceil(wait))})
+        return await handler(request)
+
+    return endpoint
+
+
+def instrumented_route(path, handler):
+    """
+    Rate limited GET route whose requests are recorded in the metrics, like
+    metrics.init_app() does for the Flask routes. The route label uses
+    Flask's <param> syntax so both server modes report the same series.
+    """
+    handler = rate_limited(handler)
+    if not METRICS['enabled']:
+        return Route(path, handler, methods=['GET'])
+    route = path.replace('{', '<').replace('}', '>')
+
+    async def endpoint(request):
+        token = metrics.start_request()
+        response = await handler(request)
+        server_timing = metrics.finish_request(token, route, request.method, response.status_code)
+        if server_timing and METRICS['server_timing']:
+            response.headers['Server-Timing'] = server_timing
+        return response
+
+    return Route(path, endpoint, methods=['GET'])
+
+
+def conditional_response(request, entry):
+    """Async counterpart of http_cache.conditional_response()."""
+    headers = {'Access-Control-Allow-Origin': '*', 'Vary': 'Accept-Encoding'}
+    body, etag, encoding = entry.negotiate(request.headers.get('accept-encoding'))
+    if encoding is not None:
+        headers['Content-Encoding'] = encoding
+    if entry.status == 200:
+        headers.update({
+            'ETag': f'"{etag}"',
+            'Last-Modified': http_date(entry.last_modified),
+            'Cache-Control': CACHE_CONTROL,
+        })
+        if_none_match = request.headers.get('if-none-match')
+        if if_none_match is not None:
+            not_modified = parse_etags(if_none_match).contains_weak(etag)
+        else:
+            since = parse_date(request.headers.get('if-modified-since'))
+            not_modified = since is not None and entry.last_modified <= since
+        if not_modified:
+            return Response(status_code=304, headers=headers)
+    return Response(body, status_code=entry.status,
+                    media_type='application/json', headers=headers)
+
+
+async def catalog_response(request, key, make_query=None, not_found="Not found", ttl=None,
+                           loader=None):
+    """
+    Serve a catalog query through the shared catalog cache. Responses built
+    from several queries pass a `loader` coroutine function instead.
+    """
+    ensure_invalidation_listener()
+    entry = catalog_cache.get(key)
+    metrics.mark_cache('hit' if entry is not None else 'miss')
+    if entry is None:
+        version = catalog_cache.version
+
+        async def load():
+            last_modified = catalog_cache.last_modified()
+            if loader is not None:
+                data = await loader()
+            else:
+                data = await run_catalog_query(make_query())
+            if data is None:
+                return build_cached_body({"error": not_found}, status=404,
+                                         json_provider=flask_app.json)
+            return build_cached_body(data, json_provider=flask_app.json,
+                                     last_modified=last_modified)
+
+        if catalog_flights is not None:
+            # Concurrent misses for the key await the same query
+            entry = await catalog_flights.do_async(key, load, generation=version)
+        else:
+            entry = await load()
+        catalog_cache.set(key, entry, version=version, ttl=ttl)
+    return conditional_response(request, entry)
+
+
+def error_response(e):
+    """Async counterpart of main.database_error()."""
+    headers = {'Access-Control-Allow-Origin': '*'}
+    if isinstance(e, (admission.Overloaded, PoolTimeout)):
+        headers['Retry-After'] = admission.retry_after(e)
+        return JSONResponse({"error": "Server is busy, please retry"}, status_code=503,
+                            headers=headers)
+    logger.error(f"Database error: {e}")
+    return JSONResponse({"error": "Internal server error"}, status_code=500, headers=headers)
+
+
+async def get_categories(request):
+    try:
+        return await catalog_response(request, ('categories',), catalog.categories_query)
+    except Exception as e:
+        return error_response(e)
+
+
+async def get_category(request):
+    category_id = request.path_params['category_id']
+    try:
+        return await catalog_response(request, ('category', category_id),
+                                      lambda: catalog.category_query(category_id),
+                                      not_found="Category not found")
+    except Exception as e:
+        return error_response(e)
+
+
+async def get_products_by_category(request):
+    category_id = request.path_params['category_id']
+    try:
+        fields, limit, after = catalog.parse_category_products_args(request.query_params)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400,
+                            headers={'Access-Control-Allow-Origin': '*'})
+
+    try:
+        return await catalog_response(
+            request, ('category_products', category_id, fields, limit, after),
+            lambda: catalog.products_by_category_query(category_id, fields, limit, after))
+    except Exception as e:
+        return error_response(e)
+
+
+async def get_featured_products(request):
+    try:
+        return await catalog_response(request, ('featured',), catalog.featured_products_query,
+                                      ttl=FEATURED_REFRESH)
+    except Exception as e:
+        return error_response(e)
+
+
+async def get_products_by_ids(request):
+    product_ids = catalog.parse_product_ids(request.query_params.get('ids'))
+    if not product_ids:
+        return JSONResponse({"error": "ids parameter is required"}, status_code=400,
+                            headers={'Access-Control-Allow-Origin': '*'})
+    try:
+        return await catalog_response(request, ('products', product_ids),
+                                      lambda: catalog.products_by_ids_query(product_ids))
+    except Exception as e:
+        return error_response(e)
+
+
+async def get_product(request):
+    product_id = request.path_params['product_id']
+    try:
+        return await catalog_response(request, ('product', product_id),
+                                      lambda: catalog.product_query(product_id),
+                                      not_found="Product not found")
+    except Exception as e:
+        return error_response(e)
+
+
+async def search_products(request):
+    try:
+        q, limit, after = catalog.parse_search_args(request.query_params)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400,
+                            headers={'Access-Control-Allow-Origin': '*'})
+    try:
+        return await catalog_response(request, ('search', q, limit, after),
+                                      lambda: catalog.search_query(q, limit, after))
+    except Exception as e:
+        return error_response(e)
+
+
+async def suggest_products(request):
+    try:
+        q, limit, _ = catalog.parse_search_args(request.query_params,
+                                                default_limit=8, max_limit=20)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400,
+                            headers={'Access-Control-Allow-Origin': '*'})
+    try:
+        return await catalog_response(request, ('suggest', q, limit),
+                                      lambda: catalog.suggest_query(q, limit))
+    except Exception as e:
+        return error_response(e)
+
+
+async def load_browse(filters, sort, limit, after=None):
+    page = await run_catalog_query(catalog.browse_query(filters, sort, limit, after))
+    if after is None:
+        # Facets only come with the first page, as in main.load_browse()
+        page.update(await run_catalog_query(catalog.browse_facets_query(filters)))
+    return page
+
+
+async def browse_products(request):
+    try:
+        filters, sort, limit, after = catalog.parse_browse_args(request.query_params)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400,
+                            headers={'Access-Control-Allow-Origin': '*'})
+    try:
+        return await catalog_response(request, ('browse', filters, sort, limit, after),
+                                      loader=lambda: load_browse(filters, sort, limit, after))
+    except Exception as e:
+        return error_response(e)
+
+
+async def debug_async_pool(request):
+    """Async connection pool statistics."""
+    return JSONResponse(pool.get_stats())
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await pool.open()
+    try:
+        yield
+    finally:
+        await pool.close()
+
+
+app = Starlette(
+    routes=[
+        instrumented_route('/api/categories', get_categories),
+        instrumented_route('/api/categories/{category_id}', get_category),
+        instrumented_route('/api/categories/{category_id}/products', get_products_by_category),
+        instrumented_route('/api/products', get_products_by_ids),
+        instrumented_route('/api/products/featured', get_featured_products),
+        # Before {product_id}, which would otherwise match "browse"
+        instrumented_route('/api/products/browse', browse_products),
+        instrumented_route('/api/products/{product_id}', get_product),
+        instrumented_route('/api/search', search_products),
+        instrumented_route('/api/search/suggest', suggest_products),
+        instrumented_route('/api/debug/async-pool', debug_async_pool),
+        # Everything else is served by the Flask app in a thread pool
+        Mount('/', app=WsgiToAsgi(flask_app)),
+    ],
+    lifespan=lifespan,
+)
@@ -0,0 +1,747 @@
+#!/usr/bin/env python3
+"""
+Reproducible HTTP benchmark for the bookstore API.
+
+`run` starts a throwaway Postgres cluster (initdb into a temporary
+directory), starts the API against it, seeds the catalog with --scale extra
+generated books and then drives every API route at each --concurrency
+level, one scenario at a time: catalog reads, search, cover images, cart
+add/update/remove and checkout. Each (scenario, concurrency) pair gets a
+warm-up followed by a fixed measuring window; the report records throughput
+and p50/p95/p99 latency as JSON.
+
+`compare` reads two reports and flags scenarios whose throughput dropped or
+whose tail latency grew by more than --threshold, exiting non-zero if any
+did, so it can gate CI.
+
+    python benchmark.py run --scale 10000 --concurrency 1,8,32 --output after.json
+    python benchmark.py compare before.json after.json
+
+Use --db-host to create a throwaway database on an existing server instead
+of a private cluster, or --api-url to benchmark an API that is already
+running (nothing is started or seeded then). The load generator uses one
+thread and one keep-alive connection per simulated client; run it on the
+same machine and settings for both sides of a comparison.
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timezone
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+API_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_CONCURRENCY = '1,8,32'
+
+# Words used for generated titles and descriptions, and as search terms
+WORDS = (
+    'war', 'peace', 'river', 'night', 'garden', 'winter', 'empire', 'letters',
+    'shadow', 'island', 'journey', 'kingdom', 'memory', 'ocean', 'silence',
+    'stars', 'storm', 'summer', 'machine', 'mirror', 'forest', 'city',
+)
+
+# Stock given to every product, so checkout scenarios never run out and
+# verify_orders() can account for every unit sold
+BENCH_STOCK = 1000000000
+# Titles every checkout_hot client orders
+HOT_TITLES = 3
+
+
+# Throwaway database -------------------------------------------------------
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def find_pg_bin(pg_bin=None):
+    """Directory holding initdb/pg_ctl: --pg-bin, PATH or `pg_config --bindir`."""
+    if pg_bin:
+        return pg_bin
+    initdb = shutil.which('initdb')
+    if initdb:
+        return os.path.dirname(initdb)
+    try:
+        return subprocess.check_output(['pg_config', '--bindir'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class TempCluster:
+    """A private Postgres cluster in a temporary directory, on a free port."""
+
+    def __init__(self, pg_bin, options=()):
+        self.pg_bin = pg_bin
+        self.options = list(options)
+        self.dir = tempfile.mkdtemp(prefix='bookstore-bench-pg-')
+        self.data = os.path.join(self.dir, 'data')
+        self.port = free_port()
+
+    def start(self):
+        print(f"Creating throwaway Postgres cluster in {self.data}")
+        subprocess.run(
+            [os.path.join(self.pg_bin, 'initdb'), '-D', self.data, '-U', 'postgres',
+             '--auth=trust', '-E', 'UTF8', '--no-sync'],
+            check=True, stdout=subprocess.DEVNULL)
+        settings = ['-p', str(self.port), '-k', self.dir, '-c', 'listen_addresses=127.0.0.1']
+        for option in self.options:
+            settings += ['-c', option]
+        subprocess.run(
+            [os.path.join(self.pg_bin, 'pg_ctl'), '-D', self.data, '-w',
+             '-l', os.path.join(self.dir, 'postgres.log'),
+             '-o', subprocess.list2cmdline(settings), 'start'],
+            check=True, stdout=subprocess.DEVNULL)
+        return {'host': '127.0.0.1', 'port': str(self.port), 'user': 'postgres',
+                'password': 'postgres', 'database': 'bookstore_bench'}
+
+    def stop(self):
+        subprocess.run(
+            [os.path.join(self.pg_bin, 'pg_ctl'), '-D', self.data, '-m', 'fast', 'stop'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+class TempDatabase:
+    """A throwaway database on an existing server, dropped afterwards."""
+
+    def __init__(self, host, port, user, password):
+        self.settings = {'host': host, 'port': str(port), 'user': user, 'password': password,
+                         'database': f"bookstore_bench_{os.getpid()}"}
+
+    def _admin(self):
+        conn = psycopg2.connect(host=self.settings['host'], port=self.settings['port'],
+                                user=self.settings['user'], password=self.settings['password'],
+                                dbname='postgres')
+        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        return conn
+
+    def start(self):
+        # The API creates the database itself on startup (init_db)
+        self.stop()
+        return self.settings
+
+    def stop(self):
+        conn = self._admin()
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT pg_terminate_backend(pid) FROM pg_stat_activity '
+                            'WHERE datname = %s', (self.settings['database'],))
+                cur.execute(f'DROP DATABASE IF EXISTS "{self.settings["database"]}"')
+        finally:
+            conn.close()
+
+
+def seed_catalog(db, scale, covers):
+    """
+    Add `scale` generated books spread over the existing categories, with
+    searchable titles and descriptions and covers from the image directory.
+    """
+    conn = psycopg2.connect(host=db['host'], port=db['port'], user=db['user'],
+                            password=db['password'], dbname=db['database'])
+    try:
+        with conn.cursor() as cur:
+            if scale:
+                print(f"Seeding {scale} generated books")
+                cur.execute('''
+                    WITH cats AS (
+                        SELECT array_agg(id ORDER BY id) AS ids,
+                               array_agg(name ORDER BY id) AS names
+                        FROM categories
+                    )
+                    INSERT INTO products (id, name, author, price, category_id, category,
+                                          description, image_url, pages, published)
+                    SELECT 'bench-' || n,
+                           initcap(w.words[1 + n %% cardinality(w.words)] || ' of the ' ||
+                                   w.words[1 + (n / 7) %% cardinality(w.words)]) || ' ' || n,
+                           'Author ' || (n %% 997),
+                           round(5 + (n %% 4000) / 100.0, 2),
+                           cats.ids[1 + n %% cardinality(cats.ids)],
+                           cats.names[1 + n %% cardinality(cats.ids)],
+                           'A generated story about ' || w.words[1 + (n / 3) %% cardinality(w.words)] ||
+                           ', ' || w.words[1 + (n / 11) %% cardinality(w.words)] ||
+                           ' and the ' || w.words[1 + (n / 13) %% cardinality(w.words)] || '.',
+                           CASE WHEN cardinality(%s::text[]) > 0
+                                THEN '/api/images/books/' || (%s::text[])[1 + n %% cardinality(%s::text[])]
+                           END,
+                           100 + n %% 900,
+                           1800 + n %% 225
+                    FROM generate_series(1, %s) AS n, cats, (SELECT %s::text[] AS words) w
+                    ON CONFLICT (id) DO NOTHING
+                ''', (covers, covers, covers, scale, list(WORDS)))
+            cur.execute('''
+                INSERT INTO inventory (product_id, stock)
+                SELECT id, %s FROM products
+                ON CONFLICT (product_id) DO UPDATE SET stock = EXCLUDED.stock
+            ''', (BENCH_STOCK,))
+            cur.execute('ANALYZE')
+            cur.execute('SELECT count(*) FROM products')
+            products = cur.fetchone()[0]
+        conn.commit()
+    finally:
+        conn.close()
+    return products
+
+
+class ApiServer:
+    """The API under test, started as `python main.py` with the benchmark settings."""
+
+    def __init__(self, db, port, server_mode, extra_env=None, command=None):
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        self.command = command or [sys.executable, 'main.py']
+        self.env = dict(os.environ, DB_HOST=db['host'], DB_PORT=db['port'],
+                        DB_USER=db['user'], DB_PASSWORD=db['password'], DB_NAME=db['database'],
+                        PORT=str(port), DEBUG='false', SERVER_MODE=server_mode,
+                        # Every benchmark client comes from one address
+                        RATE_LIMIT_RATE='0')
+        self.env.update(extra_env or {})
+        self.log = tempfile.NamedTemporaryFile(prefix='bookstore-bench-api-', suffix='.log',
+                                               delete=False)
+        self.process = None
+
+    def start(self, timeout=60):
+        print(f"Starting API ({' '.join(self.command)}) on port {self.port}, log: {self.log.name}")
+        self.process = subprocess.Popen(self.command, cwd=API_DIR, env=self.env,
+                                        stdout=self.log, stderr=subprocess.STDOUT,
+                                        start_new_session=True)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"API exited with {self.process.returncode}, see {self.log.name}")
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=2)
+                conn.request('GET', '/api/categories')
+                if conn.getresponse().status == 200:
+                    return
+            except OSError:
+                pass
+            time.sleep(0.5)
+        raise RuntimeError(f"API did not become ready within {timeout}s, see {self.log.name}")
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            os.killpg(self.process.pid, signal.SIGTERM)
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                os.killpg(self.process.pid, signal.SIGKILL)
+        self.log.close()
+
+
+# Load generation ----------------------------------------------------------
+
+class Client:
+    """One simulated client: a keep-alive connection and its own cart."""
+
+    def __init__(self, base_url, catalog, seed):
+        url = urllib.parse.urlsplit(base_url)
+        self.host, self.port = url.hostname, url.port or 80
+        self.catalog = catalog
+        self.rng = random.Random(seed)
+        self.cart_id = f"bench-{seed:08d}-{os.getpid()}-cart"
+        self.conn = None
+        self.checkouts = 0
+        self.last_idempotency_key = None
+
+    def request(self, method, path, body=None, headers=None):
+        """Send one request; returns (status, body bytes). Reconnects once if needed."""
+        all_headers = {'X-Cart-Id': self.cart_id}
+        if body is not None:
+            body = json.dumps(body)
+            all_headers['Content-Type'] = 'application/json'
+        all_headers.update(headers or {})
+        for attempt in (1, 2):
+            try:
+                if self.conn is None:
+                    self.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+                    self.conn.connect()
+                    self.conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.conn.request(method, path, body=body, headers=all_headers)
+                response = self.conn.getresponse()
+                data = response.read()
+                if response.getheader('Connection', '').lower() == 'close':
+                    self.close()
+                return response.status, data
+            except (OSError, http.client.HTTPException):
+                self.close()
+                if attempt == 2:
+                    raise
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def product_id(self):
+        return self.rng.choice(self.catalog['product_ids'])
+
+    def add_to_cart(self, product_id=None, quantity=1):
+        return self.request('POST', '/api/cart/add',
+                            {'productId': product_id or self.product_id(), 'quantity': quantity})
+
+
+# Each scenario takes a Client, does any untimed preparation itself and
+# returns the (method, path, body, headers) of the request to time.
+
+def _get(path, headers=None):
+    return 'GET', path, None, headers
+
+
+def scenario_cart_update(client):
+    product_id = client.product_id()
+    client.add_to_cart(product_id)
+    return 'POST', '/api/cart/update', {'itemId': product_id,
+                                        'quantity': client.rng.randint(1, 5)}, None
+
+
+def scenario_cart_remove(client):
+    product_id = client.product_id()
+    client.add_to_cart(product_id)
+    return 'DELETE', f'/api/cart/remove/{urllib.parse.quote(product_id)}', None, None
+
+
+def scenario_checkout(client):
+    client.add_to_cart()
+    client.add_to_cart()
+    return 'POST', '/api/cart/checkout', None, None
+
+
+# Idempotent replays that did not return the original order (see verify_orders)
+REPLAY_FAILURES = []
+
+
+def scenario_checkout_hot(client):
+    """
+    Every client orders the same few titles (in random order and amounts),
+    so checkouts contend for the same stock rows. Each checkout carries an
+    Idempotency-Key and is replayed once afterwards, like a client retrying
+    after a lost response; the replay must return the original order.
+    """
+    if client.last_idempotency_key:
+        status, _ = client.request('POST', '/api/cart/checkout',
+                                   headers={'Idempotency-Key': client.last_idempotency_key})
+        # 201/409/503: the original attempt failed and the retry placed (or
+        # failed) it now; 400 would mean the original order wasn't found
+        if status not in (200, 201, 409, 503):
+            REPLAY_FAILURES.append(status)
+    hot = client.catalog['product_ids'][:HOT_TITLES]
+    for product_id in client.rng.sample(hot, client.rng.randint(1, len(hot))):
+        client.add_to_cart(product_id, client.rng.randint(1, 3))
+    client.checkouts += 1
+    client.last_idempotency_key = f"{client.cart_id}-{client.checkouts}"
+    return 'POST', '/api/cart/checkout', None, {'Idempotency-Key': client.last_idempotency_key}
+
+
+def scenario_browse(client):
+    """A category with a price bucket, in a random order: what clicking facets produces."""
+    rng = client.rng
+    low, high = rng.choice([(0, 10), (10, 20), (20, 50), (50, None)])
+    path = (f"/api/products/browse?category={rng.choice(client.catalog['category_ids'])}"
+            f"&price_min={low}&sort={rng.choice(['name', 'price_asc', 'newest'])}")
+    if high is not None:
+        path += f"&price_max={high}"
+    return _get(path)
+
+
+def scenario_cart_get(client):
+    if not client.rng.randrange(20):
+        # Keep the cart from growing without bound
+        client.request('POST', '/api/cart/checkout')
+        client.add_to_cart()
+        client.add_to_cart()
+    return _get('/api/cart')
+
+
+SCENARIOS = {
+    'categories': lambda c: _get('/api/categories'),
+    'category': lambda c: _get(f"/api/categories/{c.rng.choice(c.catalog['category_ids'])}"),
+    'category_products': lambda c: _get(
+        f"/api/categories/{c.rng.choice(c.catalog['category_ids'])}/products"),
+    'category_products_page': lambda c: _get(
+        f"/api/categories/{c.rng.choice(c.catalog['category_ids'])}/products"
+        "?limit=20&fields=name,price,image_url"),
+    'products_by_ids': lambda c: _get(
+        '/api/products?ids=' + ','.join(c.product_id() for _ in range(5))),
+    'featured': lambda c: _get('/api/products/featured'),
+    'product': lambda c: _get(f'/api/products/{urllib.parse.quote(c.product_id())}'),
+    'search': lambda c: _get(
+        f"/api/search?q={c.rng.choice(WORDS)}+{c.rng.choice(WORDS)}&limit=20"),
+    'suggest': lambda c: _get(f"/api/search/suggest?q={c.rng.choice(WORDS)[:3]}"),
+    'browse': scenario_browse,
+    'image': lambda c: _get(c.rng.choice(c.catalog['image_urls'])),
+    'image_thumbnail': lambda c: _get(
+        c.rng.choice(c.catalog['image_urls']) + '&w=200', {'Accept': 'image/webp,*/*'}),
+    'cart_get': scenario_cart_get,
+    'cart_add': lambda c: ('POST', '/api/cart/add',
+                           {'productId': c.product_id(), 'quantity': 1}, None),
+    'cart_update': scenario_cart_update,
+    'cart_remove': scenario_cart_remove,
+    'checkout': scenario_checkout,
+    'checkout_hot': scenario_checkout_hot,
+}
+# Not benchmarked: the /api/debug/* endpoints and the SPA catch-all route
+
+
+def load_catalog(base_url):
+    """Ids and cover URLs to build requests from, read through the API itself."""
+    client = Client(base_url, None, 0)
+    status, body = client.request('GET', '/api/categories')
+    if status != 200:
+        raise RuntimeError(f"GET /api/categories returned {status}")
+    category_ids = [c['id'] for c in json.loads(body)]
+    product_ids, image_urls = [], set()
+    for category_id in category_ids:
+        status, body = client.request(
+            'GET', f'/api/categories/{category_id}/products?fields=image_url')
+        for product in json.loads(body):
+            product_ids.append(product['id'])
+            url = product.get('image_url')
+            if url and url.startswith('/api/images/'):
+                image_urls.add(url if '?' in url else url + '?')
+    client.close()
+    if not product_ids:
+        raise RuntimeError("The catalog is empty")
+    return {'category_ids': category_ids, 'product_ids': product_ids,
+            'image_urls': sorted(image_urls)}
+
+
+def verify_orders(db):
+    """
+    Consistency checks after the checkout scenarios: every unit sold is
+    accounted for in the stock, and every order is complete and adds up.
+    Returns the checks with a list of failures (empty when all pass).
+    """
+    conn = psycopg2.connect(host=db['host'], port=db['port'], user=db['user'],
+                            password=db['password'], dbname=db['database'])
+    try:
+        with conn.cursor() as cur:
+            cur.execute('''
+                SELECT count(*) FROM inventory i
+                LEFT JOIN (SELECT product_id, sum(quantity) AS sold
+                           FROM order_items GROUP BY product_id) s USING (product_id)
+                WHERE %s - i.stock <> coalesce(s.sold, 0)
+            ''', (BENCH_STOCK,))
+            stock_mismatches = cur.fetchone()[0]
+            cur.execute('''
+                SELECT count(*),
+                       count(*) FILTER (WHERE s.total IS DISTINCT FROM o.total
+                                           OR s.items IS DISTINCT FROM o.item_count)
+                FROM orders o
+                LEFT JOIN (SELECT order_id, sum(price * quantity) AS total, sum(quantity) AS items
+                           FROM order_items GROUP BY order_id) s ON s.order_id = o.id
+            ''')
+            orders, inconsistent_orders = cur.fetchone()
+    finally:
+        conn.close()
+    failures = []
+    if stock_mismatches:
+        failures.append(f"{stock_mismatches} products whose stock does not match units ordered")
+    if inconsistent_orders:
+        failures.append(f"{inconsistent_orders} orders whose lines don't add up to their totals")
+    if REPLAY_FAILURES:
+        failures.append(f"{len(REPLAY_FAILURES)} idempotent replays did not return the original order")
+    return {'orders': orders, 'failures': failures}
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(p / 100.0 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def run_scenario(base_url, catalog, name, concurrency, duration, warmup, seed):
+    """Drive one scenario with `concurrency` clients; returns its result record."""
+    scenario = SCENARIOS[name]
+    start_at = time.monotonic() + 0.2
+    measure_from = start_at + warmup
+    stop_at = measure_from + duration
+    latencies = [[] for _ in range(concurrency)]
+    errors = [0] * concurrency
+    statuses = [{} for _ in range(concurrency)]
+
+    def worker(i):
+        client = Client(base_url, catalog, seed * 1000 + i)
+        time.sleep(max(0.0, start_at - time.monotonic()))
+        try:
+            while True:
+                method, path, body, headers = scenario(client)
+                started = time.monotonic()
+                if started >= stop_at:
+                    break
+                try:
+                    status, _ = client.request(method, path, body, headers)
+                except (OSError, http.client.HTTPException):
+                    status = 'error'
+                finished = time.monotonic()
+                if started < measure_from:
+                    continue
+                statuses[i][status] = statuses[i].get(status, 0) + 1
+                if status == 'error' or status >= 400:
+                    errors[i] += 1
+                else:
+                    latencies[i].append(finished - started)
+        finally:
+            client.close()
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    samples = sorted(x for worker_latencies in latencies for x in worker_latencies)
+    status_counts = {}
+    for worker_statuses in statuses:
+        for status, count in worker_statuses.items():
+            status_counts[str(status)] = status_counts.get(str(status), 0) + count
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        'scenario': name,
+        'concurrency': concurrency,
+        'duration': duration,
+        'requests': len(samples),
+        'errors': sum(errors),
+        'statuses': status_counts,
+        'throughput': round(len(samples) / duration, 2),
+        'latency_ms': {
+            'mean': ms(sum(samples) / len(samples)) if samples else None,
+            'p50': ms(percentile(samples, 50)),
+            'p95': ms(percentile(samples, 95)),
+            'p99': ms(percentile(samples, 99)),
+            'max': ms(samples[-1]) if samples else None,
+        },
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=API_DIR, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def cover_filenames():
+    from config import IMAGES
+    try:
+        return sorted(name for name in os.listdir(IMAGES['dir'])
+                      if not name.startswith('.'))
+    except FileNotFoundError:
+        return []
+
+
+def parse_concurrency(value):
+    levels = [int(v) for v in value.split(',') if v.strip()]
+    if not levels or min(levels) < 1:
+        raise argparse.ArgumentTypeError("concurrency levels must be positive integers")
+    return levels
+
+
+def cmd_run(args):
+    scenarios = args.scenarios.split(',') if args.scenarios else list(SCENARIOS)
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if unknown:
+        sys.exit(f"Unknown scenarios: {', '.join(unknown)} (known: {', '.join(SCENARIOS)})")
+
+    database = server = None
+    products = None
+    try:
+        if args.api_url:
+            base_url = args.api_url.rstrip('/')
+        else:
+            if args.db_host:
+                database = TempDatabase(args.db_host, args.db_port, args.db_user, args.db_password)
+            else:
+                pg_bin = find_pg_bin(args.pg_bin)
+                if not pg_bin:
+                    sys.exit("initdb not found: pass --pg-bin, or --db-host to use an existing server")
+                database = TempCluster(pg_bin, args.pg_option)
+            db = database.start()
+            server = ApiServer(db, args.port or free_port(), args.server_mode,
+                               extra_env=dict(e.split('=', 1) for e in args.env),
+                               command=args.server_command.split() if args.server_command else None)
+            # First start creates and migrates the database; seed, then let
+            # LISTEN/NOTIFY drop anything the API cached before seeding
+            server.start()
+            products = seed_catalog(db, args.scale, cover_filenames())
+            base_url = server.url
+
+        catalog = load_catalog(base_url)
+        if not catalog['image_urls']:
+            scenarios = [s for s in scenarios if not s.startswith('image')]
+            print("No cover images found, skipping image scenarios")
+
+        results = []
+        for concurrency in args.concurrency:
+            for index, name in enumerate(scenarios):
+                result = run_scenario(base_url, catalog, name, concurrency,
+                                      args.duration, args.warmup, args.seed + index)
+                results.append(result)
+                latency = result['latency_ms']
+                print(f"{name:24} c={concurrency:<4} {result['throughput']:>9.1f} req/s  "
+                      f"p50={latency['p50']}ms p95={latency['p95']}ms p99={latency['p99']}ms  "
+                      f"errors={result['errors']}")
+
+        checks = None
+        if database and any(s.startswith('checkout') for s in scenarios):
+            checks = verify_orders(db)
+            print(f"Orders placed: {checks['orders']}; consistency: "
+                  f"{'; '.join(checks['failures']) or 'ok'}")
+    finally:
+        if server:
+            server.stop()
+        if database:
+            database.stop()
+
+    report = {
+        'meta': {
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'api_url': args.api_url,
+            'server_mode': None if args.api_url else args.server_mode,
+            'scale': None if args.api_url else args.scale,
+            'products': products if products is not None else len(catalog['product_ids']),
+            'concurrency': args.concurrency,
+            'duration': args.duration,
+            'warmup': args.warmup,
+            'seed': args.seed,
+        },
+        'results': results,
+        'checks': checks,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.output}")
+    if checks and checks['failures']:
+        sys.exit(1)
+
+
+# Comparison ---------------------------------------------------------------
+
+def compare_reports(baseline, current, threshold, min_delta_ms):
+    """
+    Match results by (scenario, concurrency) and flag regressions: throughput
+    down, or p95/p99 latency up, by more than `threshold` (a fraction).
+    Latency changes smaller than `min_delta_ms` are treated as noise.
+    """
+    base = {(r['scenario'], r['concurrency']): r for r in baseline['results']}
+    rows = []
+    for result in current['results']:
+        key = (result['scenario'], result['concurrency'])
+        old = base.get(key)
+        if old is None:
+            continue
+        row = {'scenario': key[0], 'concurrency': key[1], 'regressions': []}
+        if old['throughput']:
+            change = result['throughput'] / old['throughput'] - 1
+            row['throughput_change'] = round(change, 4)
+            if change < -threshold:
+                row['regressions'].append('throughput')
+        for p in ('p95', 'p99'):
+            before, after = old['latency_ms'][p], result['latency_ms'][p]
+            if not before or after is None:
+                continue
+            change = after / before - 1
+            row[f'{p}_change'] = round(change, 4)
+            if change > threshold and after - before > min_delta_ms:
+                row['regressions'].append(p)
+        if result['errors'] > old['errors']:
+            row['regressions'].append('errors')
+        rows.append(row)
+    return rows
+
+
+def cmd_compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    rows = compare_reports(baseline, current, args.threshold, args.min_delta_ms)
+
+    def pct(value):
+        return '' if value is None else f"{value * 100:+.1f}%"
+
+    print(f"{'scenario':24} {'conc':>5} {'req/s':>9} {'p95':>9} {'p99':>9}  regressions")
+    for row in rows:
+        print(f"{row['scenario']:24} {row['concurrency']:>5} "
+              f"{pct(row.get('throughput_change')):>9} {pct(row.get('p95_change')):>9} "
+              f"{pct(row.get('p99_change')):>9}  {', '.join(row['regressions'])}")
+    regressions = [row for row in rows if row['regressions']]
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'threshold': args.threshold, 'rows': rows}, f, indent=2)
+    if regressions:
+        print(f"{len(regressions)} regression(s) beyond {args.threshold:.0%}")
+        sys.exit(1)
+    print("No regressions")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run = sub.add_parser('run', help='run the benchmark and write a JSON report')
+    run.add_argument('--output', default='benchmark-results.json')
+    run.add_argument('--scale', type=int, default=10000,
+                     help='generated books added to the seed catalog (default 10000)')
+    run.add_argument('--concurrency', type=parse_concurrency, default=parse_concurrency(DEFAULT_CONCURRENCY),
+                     help=f'comma separated client counts (default {DEFAULT_CONCURRENCY})')
+    run.add_argument('--duration', type=float, default=10, help='measured seconds per scenario')
+    run.add_argument('--warmup', type=float, default=2, help='unmeasured seconds per scenario')
+    run.add_argument('--scenarios', help=f"comma separated subset of: {', '.join(SCENARIOS)}")
+    run.add_argument('--seed', type=int, default=1, help='random seed for request selection')
+    run.add_argument('--server-mode', default='wsgi', choices=('wsgi', 'asgi'))
+    run.add_argument('--server-command', help='command starting the API (default: python main.py)')
+    run.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                     help='extra environment for the API (repeatable)')
+    run.add_argument('--port', type=int, help='API port (default: a free port)')
+    run.add_argument('--api-url', help='benchmark an already running API instead')
+    run.add_argument('--pg-bin', help='directory with initdb and pg_ctl')
+    run.add_argument('--pg-option', action='append', default=[], metavar='NAME=VALUE',
+                     help='extra postgres setting for the throwaway cluster (repeatable)')
+    run.add_argument('--db-host', help='use a throwaway database on this server instead')
+    run.add_argument('--db-port', default='5432')
+    run.add_argument('--db-user', default='postgres')
+    run.add_argument('--db-password', default='postgres')
+    run.set_defaults(func=cmd_run)
+
+    compare = sub.add_parser('compare', help='compare two reports and flag regressions')
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    compare.add_argument('--threshold', type=float, default=0.10,
+                         help='allowed relative change before flagging (default 0.10)')
+    compare.add_argument('--min-delta-ms', type=float, default=1.0,
+                         help='ignore latency changes smaller than this (default 1ms)')
+    compare.add_argument('--output', help='also write the comparison as JSON')
+    compare.set_defaults(func=cmd_compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+"""
+In-process cache for catalog reads.
+
+Catalog data (categories, products, featured list) only changes when the
+seeding/schema scripts run, so handlers read through a bounded LRU cache
+with a per-entry TTL. Writes to the catalog tables fire a Postgres NOTIFY
+(see check_db_schema.ensure_catalog_notify_triggers); every worker LISTENs
+on that channel and drops its entries as soon as the notification arrives.
+The TTL is only a safety net for when the listener is disconnected.
+With read replicas, reloads wait for a replica that has replayed the change
+(see replicas.require_lsn).
+"""
+import math
+import os
+import select
+import threading
+import time
+import logging
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from config import CATALOG_CACHE, SINGLE_FLIGHT
+from db import connect
+from replicas import replicas_configured, require_lsn
+from singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# Channel the catalog triggers NOTIFY on
+CATALOG_CHANNEL = 'catalog_changed'
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries also expire after `ttl` seconds.
+
+    Args:
+        max_entries: Maximum number of entries before least-recently-used eviction
+        ttl: Seconds an entry stays valid (0 = no expiry)
+    """
+
+    def __init__(self, max_entries=1024, ttl=300.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped on every invalidation; lets callers tag data with the
+        # catalog version it was loaded under
+        self.version = 0
+        # Whole epoch second of the last invalidation, strictly increasing
+        self.changed_at = 0
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'invalidations': 0,
+        }
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING:
+                self._stats['misses'] += 1
+                return default
+            expires_at, value = item
+            if expires_at and expires_at <= now:
+                del self._data[key]
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                return default
+            self._data.move_to_end(key)
+            self._stats['hits'] += 1
+            return value
+
+    def set(self, key, value, version=None, ttl=None):
+        """
+        Store a value. If `version` is given and the cache has been
+        invalidated since, the value is stale and silently dropped.
+        `ttl` overrides the cache-wide TTL for this entry.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else 0
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def get_or_load(self, key, loader, ttl=None, flights=None):
+        """
+        Return the cached value for key, calling loader() on a miss. With
+        `flights` (a singleflight.SingleFlight), concurrent misses for the
+        same key share one loader() call.
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        version = self.version
+        if flights is not None:
+            value = flights.do(key, loader, generation=version)
+        else:
+            value = loader()
+        self.set(key, value, version=version, ttl=ttl)
+        return value
+
+    def invalidate(self):
+        """Drop every entry and start a new catalog version."""
+        with self._lock:
+            self._data.clear()
+            self.version += 1
+            self.changed_at = max(math.ceil(time.time()), self.changed_at + 1)
+            self._stats['invalidations'] += 1
+
+    def last_modified(self):
+        """
+        Last-Modified for data about to be loaded: the later of the last
+        invalidation and now, in whole seconds. Anything built before an
+        invalidation is dated strictly earlier than anything built after
+        it, so If-Modified-Since never matches a body from an older version.
+        Take it before loading, so a change during the load errs older.
+        """
+        return datetime.fromtimestamp(max(self.changed_at, int(time.time())), timezone.utc)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                'size': len(self._data),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'version': self.version,
+            })
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+
+catalog_cache = TTLCache(
+    max_entries=CATALOG_CACHE['max_entries'],
+    ttl=CATALOG_CACHE['ttl'],
+)
+
+
+def dump_shared_entry(entry):
+    """A catalog response (http_cache.CachedBody) as plain data for other workers."""
+    return {'status': entry.status, 'last_modified': entry.last_modified.timestamp()}, entry.body
+
+
+def load_shared_entry(meta, body):
+    """Rebuild a catalog response from dump_shared_entry(); its ETag is recomputed from the body."""
+    # http_cache imports this module
+    from http_cache import CachedBody
+    if not isinstance(meta.get('status'), int) or not isinstance(meta.get('last_modified'), (int, float)):
+        raise ValueError("Invalid shared catalog response")
+    entry = CachedBody(body, meta['status'])
+    entry.last_modified = datetime.fromtimestamp(meta['last_modified'], timezone.utc)
+    return entry
+
+
+# Concurrent misses for the same catalog key run one query (singleflight.py)
+catalog_flights = SingleFlight(
+    wait_timeout=SINGLE_FLIGHT['wait_timeout'],
+    lock_dir=SINGLE_FLIGHT['lock_dir'] or None,
+    dump=dump_shared_entry,
+    load=load_shared_entry,
+) if SINGLE_FLIGHT['enabled'] else None
+
+
+class InvalidationListener(threading.Thread):
+    """
+    Background thread that LISTENs for catalog change notifications and
+    invalidates the cache. Reconnects with backoff if the connection drops,
+    and invalidates on reconnect since notifications may have been missed.
+    """
+
+    def __init__(self, cache, channel=CATALOG_CHANNEL, poll_interval=5.0):
+        super().__init__(name='catalog-invalidation', daemon=True)
+        self.cache = cache
+        self.channel = channel
+        self.poll_interval = poll_interval
+        self.connected = False
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        backoff = 1.0
+        while not self._stop_event.is_set():
+            conn = None
+            try:
+                conn = connect()
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f'LISTEN {self.channel}')
+                # Anything cached while we were not listening may be stale
+                self.cache.invalidate()
+                self.connected = True
+                backoff = 1.0
+                logger.info(f"Listening for catalog changes on '{self.channel}'")
+                self._listen(conn)
+            except Exception as e:
+                logger.warning(f"Catalog invalidation listener error: {e}")
+            finally:
+                self.connected = False
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            self._stop_event.wait(backoff)
+            backoff = min(backoff * 2, 30.0)
+
+    def _listen(self, conn):
+        while not self._stop_event.is_set():
+            if select.select([conn], [], [], self.poll_interval) == ([], [], []):
+                continue
+            conn.poll()
+            if conn.notifies:
+                tables = {n.payload for n in conn.notifies}
+                conn.notifies.clear()
+                logger.info(f"Catalog changed ({', '.join(sorted(tables))}), invalidating cache")
+                if replicas_configured():
+                    # Reloads must not read the old rows from a lagging replica
+                    with conn.cursor() as cur:
+                        cur.execute('SELECT pg_current_wal_lsn()::text')
+                        require_lsn(cur.fetchone()[0])
+                self.cache.invalidate()
+
+
+_listener = None
+_listener_pid = None
+_listener_lock = threading.Lock()
+
+
+def ensure_invalidation_listener():
+    """Start the LISTEN thread for this process if it isn't running yet."""
+    global _listener, _listener_pid
+    if not CATALOG_CACHE['listen']:
+        return
+    pid = os.getpid()
+    if _listener_pid == pid and _listener.is_alive():
+        return
+    with _listener_lock:
+        if _listener_pid == pid and _listener.is_alive():
+            return
+        if _listener_pid is not None and _listener_pid != pid:
+            # Forked: whatever the parent cached is no longer being invalidated
+            catalog_cache.invalidate()
+        _listener = InvalidationListener(catalog_cache)
+        _listener.start()
+        _listener_pid = pid
+
+
+def cached(key, loader, ttl=None):
+    """Read-through helper used by the catalog handlers."""
+    ensure_invalidation_listener()
+    return catalog_cache.get_or_load(key, loader, ttl=ttl, flights=catalog_flights)
+
+
+def flight_stats():
+    return catalog_flights.stats() if catalog_flights is not None else {}
+
+
+def cache_stats():
+    stats = catalog_cache.stats()
+    stats['listener_connected'] = bool(_listener and _listener.connected)
+    return stats
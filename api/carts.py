@@ -0,0 +1,152 @@
+"""
+Per-session carts.
+
+Each visitor gets a cart id, sent back by the browser in a cookie or by API
+clients in the X-Cart-Id header. Cart lines are stored in cart_items with
+the cart id in user_id, and every cart query filters (and is indexed) on
+(user_id, product_id). Carts nobody has touched for CARTS['ttl_days'] are
+deleted by a background sweep.
+"""
+import os
+import re
+import secrets
+import threading
+import logging
+
+from flask import after_this_request, request
+
+from config import CARTS
+from db import get_db_connection
+
+logger = logging.getLogger(__name__)
+
+_CART_ID_RE = re.compile(r'^[A-Za-z0-9_-]{16,100}$')
+
+# Any constant works; it just has to be the same in every worker
+SWEEP_LOCK_ID = 0x63617274
+
+# Most copies of one book a single add or update may ask for
+MAX_QUANTITY = 1000
+
+
+def get_cart_id():
+    """
+    Return (cart_id, is_new) for the current request. A new id is issued
+    (and set as a cookie on the response) when the client sent none or an
+    invalid one; a new cart is known to be empty without asking Postgres.
+    """
+    cart_id = request.headers.get(CARTS['header']) or request.cookies.get(CARTS['cookie'])
+    if cart_id and _CART_ID_RE.match(cart_id):
+        return cart_id, False
+
+    cart_id = secrets.token_urlsafe(24)
+
+    @after_this_request
+    def set_cart_cookie(response):
+        response.set_cookie(
+            CARTS['cookie'], cart_id,
+            max_age=CARTS['ttl_days'] * 86400,
+            httponly=True,
+            samesite='Lax',
+        )
+        response.headers[CARTS['header']] = cart_id
+        return response
+
+    return cart_id, True
+
+
+def parse_quantity(value, allow_zero=False):
+    """
+    Validate a cart line quantity from a JSON body: a positive integer up to
+    MAX_QUANTITY (or 0 with allow_zero). Raises ValueError otherwise.
+    """
+    minimum = 0 if allow_zero else 1
+    # bool is an int subclass, but true is not a quantity
+    if not isinstance(value, int) or isinstance(value, bool) or not minimum <= value <= MAX_QUANTITY:
+        raise ValueError(f"quantity must be an integer from {minimum} to {MAX_QUANTITY}")
+    return value
+
+
+def sweep_abandoned_carts(batch_size=1000):
+    """
+    Delete lines of carts with no activity for CARTS['ttl_days'], in small
+    batches so no single transaction holds many row locks. Only one worker
+    sweeps at a time (advisory lock). Returns the number of lines deleted.
+    """
+    deleted = 0
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT pg_try_advisory_lock(%s)', (SWEEP_LOCK_ID,))
+            if not cur.fetchone()[0]:
+                conn.rollback()
+                return 0
+            try:
+                while True:
+                    cur.execute('''
+                        DELETE FROM cart_items WHERE id IN (
+                            SELECT c.id FROM cart_items c
+                            WHERE c.updated_at < now() - make_interval(days => %s)
+                              AND NOT EXISTS (
+                                  SELECT 1 FROM cart_items r
+                                  WHERE r.user_id = c.user_id
+                                    AND r.updated_at >= now() - make_interval(days => %s)
+                              )
+                            LIMIT %s
+                        )
+                    ''', (CARTS['ttl_days'], CARTS['ttl_days'], batch_size))
+                    conn.commit()
+                    deleted += cur.rowcount
+                    if cur.rowcount < batch_size:
+                        break
+            finally:
+                cur.execute('SELECT pg_advisory_unlock(%s)', (SWEEP_LOCK_ID,))
+                conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    if deleted:
+        logger.info(f"Swept {deleted} abandoned cart lines")
+    return deleted
+
+
+class CartSweeper(threading.Thread):
+    """Background thread running sweep_abandoned_carts() periodically."""
+
+    def __init__(self, interval):
+        super().__init__(name='cart-sweeper', daemon=True)
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                sweep_abandoned_carts()
+            except Exception as e:
+                logger.warning(f"Cart sweep failed: {e}")
+
+
+_sweeper = None
+_sweeper_pid = None
+_sweeper_lock = threading.Lock()
+
+
+def ensure_cart_sweeper():
+    """Start the sweep thread for this process if it isn't running yet."""
+    global _sweeper, _sweeper_pid
+    if not CARTS['sweep_interval']:
+        return
+    pid = os.getpid()
+    if _sweeper_pid == pid and _sweeper.is_alive():
+        return
+    with _sweeper_lock:
+        if _sweeper_pid == pid and _sweeper.is_alive():
+            return
+        _sweeper = CartSweeper(CARTS['sweep_interval'])
+        _sweeper.start()
+        _sweeper_pid = pid
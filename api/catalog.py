@@ -0,0 +1,622 @@
+"""
+Catalog queries shared by the WSGI (main.py) and ASGI (asgi.py) apps.
+
+Each function returns a CatalogQuery: the SQL, its parameters and a shape()
+function that turns the fetched rows into the JSON-ready response data.
+Running the query is left to the caller, so the same SQL and response
+shapes are used whether rows come from psycopg2 or from async psycopg.
+"""
+import re
+
+from images import image_store
+from pagination import decode_cursor, encode_cursor, parse_fields, parse_limit, select_list
+
+
+# Explicit product column lists (products also has internal columns such as
+# search_vector that must not end up in responses)
+PRODUCT_COLUMNS = select_list(None)
+PRODUCT_COLUMNS_P = select_list(None, table='p')
+
+
+# Normalized form of stored cover URLs: IMAGE_URL_PREFIX + filename
+IMAGE_BASE_URL = '/api/images/books'
+IMAGE_URL_PREFIX = IMAGE_BASE_URL + '/'
+
+
+class CatalogQuery:
+    """
+    Args:
+        sql: Statement with %s placeholders
+        params: Parameters for the statement
+        one: Fetch a single row (fetchone) instead of all rows
+        shape: Callable turning the fetched row(s) into response data
+    """
+    __slots__ = ('sql', 'params', 'one', 'shape')
+
+    def __init__(self, sql, params=(), one=False, shape=None):
+        self.sql = sql
+        self.params = params
+        self.one = one
+        self.shape = shape or (lambda rows: rows)
+
+
+def prepare_product(product):
+    """
+    Make a product row JSON-ready. Prices already arrive as floats (see the
+    NUMERIC typecaster in db.py) and image URLs are stored normalized (see
+    check_db_schema.ensure_image_url_normalization), so all that is left is
+    adding the cover's content version, which only this process knows.
+    """
+    image_url = product.get('image_url') if product else None
+    if image_url and image_url.startswith(IMAGE_URL_PREFIX):
+        product['image_url'] = image_store.versioned_url(
+            IMAGE_BASE_URL, image_url[len(IMAGE_URL_PREFIX):])
+    return product
+
+
+def prepare_products(products):
+    return [prepare_product(product) for product in products]
+
+
+def categories_query():
+    return CatalogQuery('SELECT * FROM categories')
+
+
+def category_query(category_id):
+    return CatalogQuery('SELECT * FROM categories WHERE id = %s', (category_id,), one=True)
+
+
+def products_by_category_query(category_id, fields=None, limit=None, after=None):
+    """
+    Products in a category. With a limit, the result is one keyset page
+    ({"products": [...], "next": cursor}) ordered by id; without one, the
+    whole category as a list (the original response shape).
+    """
+    sql = f'SELECT {select_list(fields)} FROM products WHERE category_id = %s'
+    params = [category_id]
+    if limit is not None:
+        if after is not None:
+            sql += ' AND id > %s'
+            params.append(after)
+        # Fetch one extra row to learn whether there is a next page
+        sql += ' ORDER BY id LIMIT %s'
+        params.append(limit + 1)
+
+    def shape(rows):
+        products = prepare_products(rows)
+        if limit is None:
+            return products
+        next_cursor = None
+        if len(products) > limit:
+            products = products[:limit]
+            next_cursor = encode_cursor([products[-1]['id']])
+        return {"products": products, "next": next_cursor}
+
+    return CatalogQuery(sql, params, shape=shape)
+
+
+def parse_category_products_args(args):
+    """
+    Validate ?fields=, ?limit= and ?after= for a category's product list.
+    Returns (fields, limit, after); limit is None (the whole category) unless
+    limit or after was given. Raises ValueError on bad input.
+    """
+    fields = parse_fields(args.get('fields'))
+    limit = None
+    after = None
+    if 'limit' in args or 'after' in args:
+        limit = parse_limit(args.get('limit'))
+        if args.get('after'):
+            after = decode_cursor(args['after'])[0]
+            if not isinstance(after, str):
+                raise ValueError("Invalid cursor")
+    return fields, limit, after
+
+
+def featured_products_query():
+    """Currently scheduled featured products, in position order."""
+    return CatalogQuery(f'''
+        SELECT {PRODUCT_COLUMNS_P} FROM featured_products f
+        JOIN products p ON p.id = f.product_id
+        WHERE (f.starts_at IS NULL OR f.starts_at <= now())
+          AND (f.ends_at IS NULL OR f.ends_at > now())
+        ORDER BY f.position, f.product_id
+    ''', shape=prepare_products)
+
+
+def products_by_ids_query(product_ids):
+    """
+    Several products in one query, in the order requested. The result is
+    {"products": [...], "missing": [ids not found]}.
+    """
+    def shape(rows):
+        products = prepare_products(rows)
+        found = {product['id'] for product in products}
+        return {
+            "products": products,
+            "missing": [pid for pid in product_ids if pid not in found]
+        }
+
+    # unnest ... WITH ORDINALITY keeps the requested order while the join
+    # itself is a primary key lookup per id
+    return CatalogQuery(f'''
+        SELECT {PRODUCT_COLUMNS_P} FROM unnest(%s::varchar[]) WITH ORDINALITY AS req(id, ord)
+        JOIN products p ON p.id = req.id
+        ORDER BY req.ord
+    ''', (list(product_ids),), shape=shape)
+
+
+def product_query(product_id):
+    return CatalogQuery(f'SELECT {PRODUCT_COLUMNS} FROM products WHERE id = %s', (product_id,),
+                        one=True, shape=prepare_product)
+
+
+def parse_product_ids(value):
+    """Split ?ids=1,3,7 into a tuple, de-duplicated but in the requested order."""
+    return tuple(dict.fromkeys(pid.strip() for pid in (value or '').split(',') if pid.strip()))
+
+
+# Full-text search ---------------------------------------------------------
+
+SEARCH_CONFIG = 'english'
+MAX_SEARCH_LENGTH = 200
+_SEARCH_TOKEN_RE = re.compile(r'\w+')
+
+# ts_headline options for result snippets
+SNIPPET_OPTIONS = 'StartSel=<mark>, StopSel=</mark>, MaxFragments=2, MaxWords=25, MinWords=8'
+
+
+def parse_search_args(args, default_limit=20, max_limit=100):
+    """
+    Validate ?q=, ?limit= and ?after= for the search endpoints. Returns
+    (q, limit, after) with q whitespace/case normalized, so equivalent
+    queries share a cache entry; raises ValueError on bad input.
+    """
+    q = ' '.join((args.get('q') or '').split()).lower()
+    if not q:
+        raise ValueError("q parameter is required")
+    if len(q) > MAX_SEARCH_LENGTH:
+        raise ValueError(f"q must be at most {MAX_SEARCH_LENGTH} characters")
+    limit = parse_limit(args.get('limit'), default=default_limit, maximum=max_limit)
+    after = None
+    if args.get('after'):
+        rank, last_id = decode_cursor(args['after'], size=2)
+        if not isinstance(rank, (int, float)) or not isinstance(last_id, str):
+            raise ValueError("Invalid cursor")
+        after = (float(rank), last_id)
+    return q, limit, after
+
+
+def prefix_tsquery(q):
+    """
+    tsquery text matching every word, the last one as a prefix
+    ('war pea' -> 'war & pea:*'), for search-as-you-type. Only word
+    characters get through, so the result is always valid to_tsquery input.
+    """
+    tokens = _SEARCH_TOKEN_RE.findall(q)
+    if not tokens:
+        return None
+    return ' & '.join(tokens[:-1] + [tokens[-1] + ':*'])
+
+
+def search_query(q, limit, after=None):
+    """
+    Ranked full-text search over name (weight A), author (B) and
+    description (C) using the GIN-indexed search_vector column. Results are
+    ordered by rank and keyset-paginated on (rank, id); snippets are only
+    computed for the rows on the page.
+    """
+    params = [q]
+    page_filter = ''
+    if after is not None:
+        page_filter = 'WHERE (rank, id) < (%s::float8, %s)'
+        params.extend(after)
+    # One extra row tells us whether there is a next page
+    params.append(limit + 1)
+
+    sql = f'''
+        WITH q AS (SELECT websearch_to_tsquery('{SEARCH_CONFIG}', %s) AS query),
+        ranked AS (
+            SELECT p.id, ts_rank_cd(p.search_vector, q.query)::float8 AS rank
+            FROM products p, q
+            WHERE p.search_vector @@ q.query
+        ),
+        page AS (
+            SELECT id, rank FROM ranked
+            {page_filter}
+            ORDER BY rank DESC, id DESC
+            LIMIT %s
+        )
+        SELECT {PRODUCT_COLUMNS_P}, page.rank,
+               ts_headline('{SEARCH_CONFIG}', coalesce(p.description, ''), q.query,
+                           '{SNIPPET_OPTIONS}') AS snippet
+        FROM page JOIN products p ON p.id = page.id, q
+        ORDER BY page.rank DESC, page.id DESC
+    '''
+
+    def shape(rows):
+        results = prepare_products(rows)
+        next_cursor = None
+        if len(results) > limit:
+            results = results[:limit]
+            next_cursor = encode_cursor([results[-1]['rank'], results[-1]['id']])
+        return {"results": results, "next": next_cursor}
+
+    return CatalogQuery(sql, params, shape=shape)
+
+
+def suggest_query(q, limit):
+    """
+    Typeahead suggestions: prefix matches on the full-text index first,
+    then fuzzy (trigram word similarity) matches on name and author, which
+    also catch typos. Both conditions are served by GIN indexes.
+    """
+    tsquery = prefix_tsquery(q)
+    if tsquery is None:
+        return CatalogQuery('SELECT NULL WHERE false', shape=lambda rows: {"suggestions": []})
+
+    sql = f'''
+        SELECT p.id, p.name, p.author, p.image_url
+        FROM products p, to_tsquery('{SEARCH_CONFIG}', %s) query
+        WHERE p.search_vector @@ query
+           OR %s <%% p.name
+           OR %s <%% p.author
+        ORDER BY (p.search_vector @@ query) DESC,
+                 greatest(word_similarity(%s, p.name), word_similarity(%s, p.author)) DESC,
+                 p.id
+        LIMIT %s
+    '''
+    params = (tsquery, q, q, q, q, limit)
+    return CatalogQuery(sql, params,
+                        shape=lambda rows: {"suggestions": prepare_products(rows)})
+
+
+# Faceted browse -----------------------------------------------------------
+
+class BrowseSort:
+    """
+    Args:
+        expression: SQL sort key (each has an index, see migrations/0005)
+        descending: Sort order
+        cast: Cast applied to the cursor value so the comparison uses the index
+        value: Sort key of a fetched product, for the next page's cursor
+    """
+    __slots__ = ('expression', 'descending', 'cast', 'value')
+
+    def __init__(self, expression, descending, cast, value):
+        self.expression = expression
+        self.descending = descending
+        self.cast = cast
+        self.value = value
+
+
+BROWSE_SORTS = {
+    'name': BrowseSort('p.name', False, '', lambda p: p['name']),
+    'price_asc': BrowseSort('p.price', False, '::numeric', lambda p: p['price']),
+    'price_desc': BrowseSort('p.price', True, '::numeric', lambda p: p['price']),
+    # Books without a publication year sort as oldest
+    'newest': BrowseSort('coalesce(p.published, 0)', True, '::int', lambda p: p['published'] or 0),
+    'oldest': BrowseSort('coalesce(p.published, 0)', False, '::int', lambda p: p['published'] or 0),
+}
+DEFAULT_BROWSE_SORT = 'name'
+
+# Lower bounds of the price facet buckets; must match price_bucket() in
+# migrations/0005_browse.sql
+PRICE_BUCKETS = (0, 5, 10, 15, 20, 30, 50)
+AUTHOR_FACET_LIMIT = 20
+MAX_BROWSE_VALUES = 50
+
+
+def _parse_number(args, name, parse):
+    value = args.get(name)
+    if value is None or value == '':
+        return None
+    try:
+        number = parse(value)
+    except ValueError:
+        raise ValueError(f"{name} must be a number")
+    if number < 0:
+        raise ValueError(f"{name} must not be negative")
+    return number
+
+
+def _parse_price(value):
+    number = float(value)
+    if number != number or number in (float('inf'), float('-inf')):
+        raise ValueError(value)
+    # Normalized so 10, 10.0 and 10.00 share a cache entry
+    return int(number) if number == int(number) else round(number, 2)
+
+
+def _parse_values(args, name, split=False):
+    values = args.getlist(name)
+    if split:
+        values = [part for value in values for part in value.split(',')]
+    values = sorted({value.strip() for value in values if value.strip()})
+    if len(values) > MAX_BROWSE_VALUES:
+        raise ValueError(f"At most {MAX_BROWSE_VALUES} {name} values")
+    return tuple(values)
+
+
+def parse_browse_args(args, default_limit=24, max_limit=100):
+    """
+    Validate the /api/products/browse parameters. Returns
+    (filters, sort, limit, after), where filters is the tuple
+    (categories, authors, price_min, price_max, year_min, year_max)
+    normalized so equivalent requests share a cache entry; raises ValueError
+    on bad input.
+
+        category: category ids, repeated or comma separated
+        author: author names, repeated (names may contain commas)
+        price_min, price_max: price range, price_max exclusive
+        year_min, year_max: publication year range, both inclusive
+        sort: one of BROWSE_SORTS
+    """
+    filters = (
+        _parse_values(args, 'category', split=True),
+        _parse_values(args, 'author'),
+        _parse_number(args, 'price_min', _parse_price),
+        _parse_number(args, 'price_max', _parse_price),
+        _parse_number(args, 'year_min', int),
+        _parse_number(args, 'year_max', int),
+    )
+    sort = args.get('sort') or DEFAULT_BROWSE_SORT
+    if sort not in BROWSE_SORTS:
+        raise ValueError(f"sort must be one of {', '.join(BROWSE_SORTS)}")
+    limit = parse_limit(args.get('limit'), default=default_limit, maximum=max_limit)
+    after = None
+    if args.get('after'):
+        value, last_id = decode_cursor(args['after'], size=2)
+        expected = {'': str, '::int': int, '::numeric': (int, float)}[BROWSE_SORTS[sort].cast]
+        if (not isinstance(value, expected) or isinstance(value, bool)
+                or not isinstance(last_id, str)):
+            raise ValueError("Invalid cursor")
+        after = (value, last_id)
+    return filters, sort, limit, after
+
+
+def _bucket_high(bucket):
+    """Exclusive upper bound of a price bucket (None for the last, open-ended one)."""
+    return PRICE_BUCKETS[bucket + 1] if bucket + 1 < len(PRICE_BUCKETS) else None
+
+
+def _price_cover(price_min, price_max):
+    """Price buckets lying wholly inside [price_min, price_max), as (first, last), or None."""
+    covered = [bucket for bucket, low in enumerate(PRICE_BUCKETS)
+               if (price_min is None or low >= price_min)
+               and (price_max is None or (_bucket_high(bucket) or float('inf')) <= price_max)]
+    return (covered[0], covered[-1]) if covered else None
+
+
+def _decade_cover(year_min, year_max):
+    """
+    Decades lying wholly inside [year_min, year_max], as (first, last), or
+    None; last is None when there is no upper bound.
+    """
+    first = 0 if year_min is None else -(-year_min // 10) * 10
+    last = None if year_max is None else (year_max + 1) // 10 * 10 - 10
+    if last is not None and last < first:
+        return None
+    return first, last
+
+
+def _browse_conditions(filters, exclude=None):
+    """
+    WHERE conditions and parameters for the filters over products (alias p);
+    `exclude` leaves out one facet's own filter.
+    """
+    categories, authors, price_min, price_max, year_min, year_max = filters
+    conditions, params = [], []
+    if categories and exclude != 'category':
+        conditions.append('p.category_id = ANY(%s)')
+        params.append(list(categories))
+    if authors and exclude != 'author':
+        conditions.append('p.author = ANY(%s)')
+        params.append(list(authors))
+    if exclude != 'price':
+        if price_min is not None:
+            conditions.append('p.price >= %s::numeric')
+            params.append(price_min)
+        if price_max is not None:
+            conditions.append('p.price < %s::numeric')
+            params.append(price_max)
+    if exclude != 'decade':
+        if year_min is not None:
+            conditions.append('p.published >= %s')
+            params.append(year_min)
+        if year_max is not None:
+            conditions.append('p.published <= %s')
+            params.append(year_max)
+    return conditions, params
+
+
+def _facet_sources(filters, exclude):
+    """
+    Split the rows one facet counts into two parts. Summary rows whose price
+    bucket and decade lie wholly inside the price/year ranges are summed from
+    product_facets: (conditions, params) over alias f, or None when no
+    bucket does. Products in the partially covered buckets at the edges of
+    the ranges are counted from products: (conditions, params) over alias p,
+    or None when the ranges fall on bucket bounds. The edge conditions are
+    index ranges no wider than those buckets, so no range scans the whole
+    table.
+    """
+    categories, authors, price_min, price_max, year_min, year_max = filters
+    summary, summary_params = [], []
+    if categories and exclude != 'category':
+        summary.append('f.category_id = ANY(%s)')
+        summary_params.append(list(categories))
+    if authors and exclude != 'author':
+        summary.append('f.author = ANY(%s)')
+        summary_params.append(list(authors))
+
+    # Edge buckets: products in any of them (OR) are counted from products.
+    # A range covering no whole bucket makes every match an edge match, and
+    # is itself the (AND) condition.
+    edges, edge_params = [], []
+    narrow, narrow_params = [], []
+    partial = False
+    if exclude != 'price' and (price_min is not None or price_max is not None):
+        cover = _price_cover(price_min, price_max)
+        if cover is None:
+            # The price filter itself is already an indexable range
+            partial = True
+        else:
+            first, last = cover
+            summary.append('f.price_bucket BETWEEN %s AND %s')
+            summary_params.extend(cover)
+            low, high = PRICE_BUCKETS[first], _bucket_high(last)
+            if price_min is not None and price_min < low:
+                edges.append('(p.price >= %s::numeric AND p.price < %s::numeric)')
+                edge_params.extend((price_min, low))
+            if price_max is not None and high < price_max:
+                edges.append('(p.price >= %s::numeric AND p.price < %s::numeric)')
+                edge_params.extend((high, price_max))
+    if exclude != 'decade' and (year_min is not None or year_max is not None):
+        # Year conditions on coalesce(published, 0), which the year index is
+        # on; the year filter itself still excludes unknown years
+        cover = _decade_cover(year_min, year_max)
+        if cover is None:
+            partial = True
+            narrow.append('coalesce(p.published, 0) BETWEEN %s AND %s')
+            narrow_params.extend((year_min or 0, year_max))
+        else:
+            first, last = cover
+            # Unknown years (decade -1) never match a year range
+            if last is None:
+                summary.append('f.decade >= %s')
+                summary_params.append(first)
+            else:
+                summary.append('f.decade BETWEEN %s AND %s')
+                summary_params.extend(cover)
+            if year_min is not None and year_min < first:
+                edges.append('(coalesce(p.published, 0) BETWEEN %s AND %s)')
+                edge_params.extend((year_min, first - 1))
+            if last is not None and last + 9 < year_max:
+                edges.append('(coalesce(p.published, 0) BETWEEN %s AND %s)')
+                edge_params.extend((last + 10, year_max))
+
+    if partial:
+        conditions, params = _browse_conditions(filters, exclude=exclude)
+        conditions.extend(narrow)
+        params.extend(narrow_params)
+        return None, (conditions, params)
+    if not edges:
+        return (summary, summary_params), None
+    conditions, params = _browse_conditions(filters, exclude=exclude)
+    conditions.append(f"({' OR '.join(edges)})")
+    params.extend(edge_params)
+    return (summary, summary_params), (conditions, params)
+
+
+def browse_query(filters, sort, limit, after=None):
+    """
+    One page of products matching the filters, in the requested order,
+    keyset-paginated on (sort key, id).
+    """
+    order = BROWSE_SORTS[sort]
+    conditions, params = _browse_conditions(filters)
+    direction = 'DESC' if order.descending else 'ASC'
+    if after is not None:
+        comparison = '<' if order.descending else '>'
+        conditions.append(f'({order.expression}, p.id) {comparison} (%s{order.cast}, %s)')
+        params.extend(after)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    # One extra row tells us whether there is a next page
+    params.append(limit + 1)
+    sql = f'''
+        SELECT {PRODUCT_COLUMNS_P} FROM products p
+        {where}
+        ORDER BY {order.expression} {direction}, p.id {direction}
+        LIMIT %s
+    '''
+
+    def shape(rows):
+        products = prepare_products(rows)
+        next_cursor = None
+        if len(products) > limit:
+            products = products[:limit]
+            next_cursor = encode_cursor([order.value(products[-1]), products[-1]['id']])
+        return {"products": products, "next": next_cursor}
+
+    return CatalogQuery(sql, params, shape=shape)
+
+
+def browse_facets_query(filters, author_limit=AUTHOR_FACET_LIMIT):
+    """
+    Facet counts for the filters: books per category, author (the top
+    `author_limit`), price bucket and decade. Each facet is counted with
+    every filter except its own, so the counts show what selecting another
+    value would give. The result is {"facets": {...}, "total": matches}.
+
+    Counts are sums over the trigger-maintained product_facets summary. When
+    a price or year range doesn't fall on bucket bounds, only the products in
+    the partially covered buckets at its edges are counted from products
+    (see _facet_sources()).
+    """
+    dimensions = {
+        'category': ('f.category_id', "coalesce(p.category_id, '')"),
+        'author': ('f.author', 'p.author'),
+        'price': ('f.price_bucket', 'price_bucket(p.price)'),
+        'decade': ('f.decade', 'publication_decade(p.published)'),
+    }
+
+    # One statement, one round trip: a grouped count per facet
+    parts, params = [], []
+    for facet, (summary_dimension, product_dimension) in dimensions.items():
+        summary, edge = _facet_sources(filters, exclude=facet)
+        sources = []
+        for source, dimension, measure, part in (
+                ('product_facets f', summary_dimension, 'sum(f.products)', summary),
+                ('products p', product_dimension, 'count(*)', edge)):
+            if part is None:
+                continue
+            conditions, source_params = part
+            where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+            sources.append(f'SELECT {dimension}::text AS value, {measure} AS count '
+                           f'FROM {source} {where} GROUP BY 1')
+            params.extend(source_params)
+        top = ''
+        if facet == 'author':
+            top = 'ORDER BY 3 DESC, 2 LIMIT %s'
+            params.append(author_limit)
+        parts.append(f'''(
+            SELECT '{facet}' AS facet, value, sum(count)::bigint AS count
+            FROM ({' UNION ALL '.join(sources)}) counts
+            GROUP BY value
+            HAVING sum(count) > 0
+            {top}
+        )''')
+    sql = ' UNION ALL '.join(parts)
+    categories = filters[0]
+
+    def shape(rows):
+        counts = {facet: {} for facet in dimensions}
+        for row in rows:
+            counts[row['facet']][row['value']] = row['count']
+        # The category facet ignores only the category filter, so the total
+        # is the sum over the selected categories (or all of them)
+        total = sum(count for category_id, count in counts['category'].items()
+                    if not categories or category_id in categories)
+        price = []
+        for bucket, low in enumerate(PRICE_BUCKETS):
+            count = counts['price'].get(str(bucket))
+            if count:
+                price.append({"min": low, "max": _bucket_high(bucket), "count": count})
+        return {
+            "facets": {
+                "category": sorted(({"id": value or None, "count": count}
+                                    for value, count in counts['category'].items()),
+                                   key=lambda c: (-c['count'], c['id'] or '')),
+                "author": sorted(({"name": value, "count": count}
+                                  for value, count in counts['author'].items()),
+                                 key=lambda a: (-a['count'], a['name'])),
+                "price": price,
+                "decade": sorted(({"decade": int(value) if value != '-1' else None, "count": count}
+                                  for value, count in counts['decade'].items()),
+                                 key=lambda d: (d['decade'] is None, d['decade'] or 0)),
+            },
+            "total": total,
+        }
+
+    return CatalogQuery(sql, params, shape=shape)
@@ -1,77 +1,220 @@
 #!/usr/bin/env python3
 """
-Script to check and update the database schema to ensure image_url fields exist.
+Schema upgrade steps for databases created before the migration runner
+(see migrate.py), used by migration 0002. Running this script applies any
+pending migrations.
 """
 import os
 import sys
-import psycopg2
-from psycopg2 import sql
-from config import DB_CONFIG
 
-# Database configuration
-DB_HOST = DB_CONFIG['host']
-DB_PORT = DB_CONFIG['port'] 
-DB_NAME = DB_CONFIG['database']
-DB_USER = DB_CONFIG['user']
-DB_PASSWORD = DB_CONFIG['password']
+CATALOG_TABLES = ('categories', 'products', 'featured_products')
 
-def get_db_connection():
-    """Create a database connection and return it"""
-    conn = psycopg2.connect(
-        host=DB_HOST,
-        port=DB_PORT,
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD
-    )
-    conn.autocommit = False
-    return conn
+def ensure_catalog_notify_triggers(cur):
+    """
+    Install statement-level triggers that NOTIFY 'catalog_changed' whenever
+    the catalog tables are written, so API workers can drop cached data.
+    """
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION notify_catalog_changed() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('catalog_changed', TG_TABLE_NAME);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    for table in CATALOG_TABLES:
+        cur.execute(f"DROP TRIGGER IF EXISTS {table}_notify_catalog_changed ON {table}")
+        cur.execute(f"""
+            CREATE TRIGGER {table}_notify_catalog_changed
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_catalog_changed()
+        """)
+
+# Tables whose image_url is normalized on write
+IMAGE_URL_TABLES = ('products', 'cart_items')
+
+def ensure_image_url_normalization(cur):
+    """
+    Store cover URLs in their served form (/api/images/books/<file>) by
+    normalizing image_url in a BEFORE INSERT/UPDATE trigger, whoever the
+    writer is, and fix up rows written before the trigger existed. The API
+    then reads image_url as-is instead of rewriting it for every row.
+    External (http...) URLs are left alone.
+    """
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION normalize_image_url() RETURNS trigger AS $$
+        BEGIN
+            IF NEW.image_url <> '' AND NEW.image_url NOT LIKE 'http%' THEN
+                NEW.image_url := '/api/images/books/' ||
+                    regexp_replace(split_part(NEW.image_url, '?', 1), '^.*/', '');
+            END IF;
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    for table in IMAGE_URL_TABLES:
+        cur.execute(f"DROP TRIGGER IF EXISTS {table}_normalize_image_url ON {table}")
+        cur.execute(f"""
+            CREATE TRIGGER {table}_normalize_image_url
+            BEFORE INSERT OR UPDATE OF image_url ON {table}
+            FOR EACH ROW EXECUTE FUNCTION normalize_image_url()
+        """)
+        # Re-assigning the column runs it through the trigger
+        cur.execute(f"""
+            UPDATE {table} SET image_url = image_url
+            WHERE image_url <> '' AND image_url NOT LIKE 'http%'
+              AND image_url !~ '^/api/images/books/[^/?]+$'
+        """)
+
+# Indexes the API relies on: name -> CREATE INDEX body
+INDEXES = {
+    # Category listings filter on category_id and keyset-paginate on id
+    'idx_products_category_id': 'ON products (category_id, id)',
+    # Full-text search and fuzzy (trigram) typeahead on name and author
+    'idx_products_search': 'ON products USING GIN (search_vector)',
+    'idx_products_name_trgm': 'ON products USING GIN (name gin_trgm_ops)',
+    'idx_products_author_trgm': 'ON products USING GIN (author gin_trgm_ops)',
+    # Finds abandoned cart lines for the expiry sweep
+    'idx_cart_items_updated_at': 'ON cart_items (updated_at)',
+}
+
+def ensure_indexes(cur):
+    """Create any missing indexes from INDEXES."""
+    for name, definition in INDEXES.items():
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {name} {definition}")
+
+# Weighted full-text document for /api/search (same as 0001_initial_schema.sql)
+SEARCH_VECTOR_SQL = """
+    setweight(to_tsvector('english', coalesce(name, '')), 'A') ||
+    setweight(to_tsvector('english', coalesce(author, '')), 'B') ||
+    setweight(to_tsvector('english', coalesce(description, '')), 'C')
+"""
+
+def ensure_search_schema(cur):
+    """
+    Add what product search needs: the pg_trgm extension and the generated
+    search_vector column. Its indexes are created by ensure_indexes().
+    """
+    cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    cur.execute(f"""
+        ALTER TABLE products
+        ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS ({SEARCH_VECTOR_SQL}) STORED
+    """)
+
+# Featured list seeded into an empty featured_products table
+DEFAULT_FEATURED_IDS = ["1", "3", "7", "11", "8"]
+
+def ensure_featured_products(cur):
+    """Create the featured_products table if needed and seed the defaults."""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS featured_products (
+            product_id VARCHAR(50) PRIMARY KEY,
+            position INTEGER NOT NULL,
+            starts_at TIMESTAMPTZ,
+            ends_at TIMESTAMPTZ
+        )
+    """)
+    cur.execute("SELECT EXISTS (SELECT 1 FROM featured_products)")
+    if not cur.fetchone()[0]:
+        print("Seeding featured_products with the default featured list")
+        for position, product_id in enumerate(DEFAULT_FEATURED_IDS, start=1):
+            cur.execute(
+                "INSERT INTO featured_products (product_id, position) VALUES (%s, %s)",
+                (product_id, position)
+            )
+
+def ensure_cart_schema(cur):
+    """
+    Bring cart_items up to per-session carts: an updated_at column for
+    expiring abandoned carts and a unique (user_id, product_id) index that
+    serves cart lookups and lets adds upsert with ON CONFLICT. Duplicate
+    lines left by older code are merged into one line first.
+    """
+    cur.execute("""
+        ALTER TABLE cart_items
+        ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    """)
+    cur.execute("SELECT 1 FROM pg_indexes WHERE indexname = 'cart_items_user_product_key'")
+    if cur.fetchone():
+        return
+    print("Merging duplicate cart lines and adding unique (user_id, product_id) index")
+    cur.execute("""
+        UPDATE cart_items c SET quantity = d.total
+        FROM (
+            SELECT MIN(id) AS keep_id, SUM(quantity) AS total
+            FROM cart_items
+            GROUP BY user_id, product_id
+            HAVING COUNT(*) > 1
+        ) d
+        WHERE c.id = d.keep_id
+    """)
+    cur.execute("""
+        DELETE FROM cart_items c USING cart_items keep
+        WHERE c.user_id IS NOT DISTINCT FROM keep.user_id
+          AND c.product_id = keep.product_id
+          AND c.id > keep.id
+    """)
+    cur.execute("CREATE UNIQUE INDEX cart_items_user_product_key ON cart_items (user_id, product_id)")
+    # Superseded expression index from the single global cart
+    cur.execute("DROP INDEX IF EXISTS cart_items_cart_product_key")
+
+def upgrade_legacy_schema(cur):
+    """
+    Bring a database created by older versions of db_setup.sql up to the
+    current schema: image_url columns, featured products, catalog and image
+    URL triggers, per-session carts, search and indexes. Every step is
+    idempotent, so on a fresh database this only installs the triggers.
+    Run as migration 0002.
+    """
+    # Check products table
+    cur.execute("""
+        SELECT column_name 
+        FROM information_schema.columns 
+        WHERE table_name='products' AND column_name='image_url'
+    """)
+    if not cur.fetchone():
+        print("Adding image_url column to products table")
+        cur.execute("""
+            ALTER TABLE products 
+            ADD COLUMN image_url VARCHAR(255)
+        """)
+    
+    # Check cart_items table
+    cur.execute("""
+        SELECT column_name 
+        FROM information_schema.columns 
+        WHERE table_name='cart_items' AND column_name='image_url'
+    """)
+    if not cur.fetchone():
+        print("Adding image_url column to cart_items table")
+        cur.execute("""
+            ALTER TABLE cart_items 
+            ADD COLUMN image_url VARCHAR(255)
+        """)
+    
+    # Update existing products to ensure image_url is properly set
+    cur.execute("""
+        UPDATE products SET image_url = '/api/images/books/book-' || id || '.jpg'
+        WHERE image_url IS NULL OR image_url = ''
+    """)
+    
+    ensure_featured_products(cur)
+    ensure_catalog_notify_triggers(cur)
+    ensure_image_url_normalization(cur)
+    ensure_cart_schema(cur)
+    ensure_search_schema(cur)
+    ensure_indexes(cur)
 
 def check_image_url_columns():
-    """Check if image_url columns exist in products and cart_items tables, add them if missing."""
-    conn = get_db_connection()
+    """Bring the database schema up to date (now done by the migration runner)."""
+    from migrate import migrate
     try:
-        with conn.cursor() as cur:
-            # Check products table
-            cur.execute("""
-                SELECT column_name 
-                FROM information_schema.columns 
-                WHERE table_name='products' AND column_name='image_url'
-            """)
-            if not cur.fetchone():
-                print("Adding image_url column to products table")
-                cur.execute("""
-                    ALTER TABLE products 
-                    ADD COLUMN image_url VARCHAR(255)
-                """)
-            
-            # Check cart_items table
-            cur.execute("""
-                SELECT column_name 
-                FROM information_schema.columns 
-                WHERE table_name='cart_items' AND column_name='image_url'
-            """)
-            if not cur.fetchone():
-                print("Adding image_url column to cart_items table")
-                cur.execute("""
-                    ALTER TABLE cart_items 
-                    ADD COLUMN image_url VARCHAR(255)
-                """)
-            
-            # Update existing products to ensure image_url is properly set
-            cur.execute("""
-                UPDATE products SET image_url = '/api/images/books/book-' || id || '.jpg'
-                WHERE image_url IS NULL OR image_url = ''
-            """)
-            
-            conn.commit()
-            print("Database schema checked and updated if needed")
+        migrate()
+        print("Database schema checked and updated if needed")
     except Exception as e:
         print(f"Error checking database schema: {e}")
-        conn.rollback()
         sys.exit(1)
-    finally:
-        conn.close()
 
 if __name__ == "__main__":
     check_image_url_columns()
@@ -0,0 +1,100 @@
+"""
+Negotiated compression (zstd, brotli, gzip) for JSON responses.
+
+Catalog bodies are compressed once per encoding and kept on the cached
+entry (http_cache.CachedBody.encoded), at a higher level than would be
+affordable per request, so repeat requests send precompressed bytes
+without spending any CPU. Other JSON responses above the size threshold are
+compressed on the fly at a fast level (init_app).
+
+gzip is always available; brotli and zstd are used when their packages are
+installed (they are in requirements.txt). Each encoded representation gets
+its own strong ETag (<etag>-<encoding>), as caches require.
+"""
+import gzip
+
+from flask import request
+from werkzeug.http import parse_accept_header
+
+from config import COMPRESSION
+
+try:
+    import brotli
+except ImportError:  # brotli is optional
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional
+    zstandard = None
+
+# Encoding -> (on-the-fly level, precompressed level)
+LEVELS = {
+    'gzip': (6, 9),
+    'br': (4, 9),
+    'zstd': (3, 12),
+}
+
+
+def _gzip(body, level):
+    # mtime=0: the same body always compresses to the same bytes
+    return gzip.compress(body, compresslevel=level, mtime=0)
+
+
+def _brotli(body, level):
+    return brotli.compress(body, mode=brotli.MODE_TEXT, quality=level)
+
+
+def _zstd(body, level):
+    return zstandard.ZstdCompressor(level=level).compress(body)
+
+
+_COMPRESSORS = {'gzip': _gzip}
+if brotli is not None:
+    _COMPRESSORS['br'] = _brotli
+if zstandard is not None:
+    _COMPRESSORS['zstd'] = _zstd
+
+# Server preference among the encodings that can actually be produced
+ENCODINGS = [e for e in COMPRESSION['encodings'] if e in _COMPRESSORS]
+
+
+def negotiate(accept_encoding, size):
+    """
+    The encoding to send a body of `size` bytes with, given the request's
+    Accept-Encoding header, or None to send it uncompressed.
+    """
+    if not COMPRESSION['enabled'] or not accept_encoding or size < COMPRESSION['min_size']:
+        return None
+    # Highest client q-value wins; ties go to the first in ENCODINGS
+    return parse_accept_header(accept_encoding).best_match(ENCODINGS)
+
+
+def compress(body, encoding, precompressed=False):
+    """Compress body; `precompressed` selects the slower, smaller level used for cached bodies."""
+    return _COMPRESSORS[encoding](body, LEVELS[encoding][1 if precompressed else 0])
+
+
+def init_app(app):
+    """Compress other JSON responses of a Flask app on the fly."""
+    if not COMPRESSION['enabled'] or not ENCODINGS:
+        return
+
+    @app.after_request
+    def compress_response(response):
+        if response.mimetype != 'application/json':
+            return response
+        response.vary.add('Accept-Encoding')
+        if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+                or 'Content-Encoding' in response.headers):
+            return response
+        body = response.get_data()
+        encoding = negotiate(request.headers.get('Accept-Encoding'), len(body))
+        if encoding is None:
+            return response
+        response.set_data(compress(body, encoding))
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag(f"{etag}-{encoding}", weak)
+        return response
@@ -13,5 +13,189 @@ DB_CONFIG = {
 }
 
 # Additional configuration
-DEBUG = os.environ.get('DEBUG', 'True').lower() in ('true', '1', 't')
+DEBUG = os.environ.get('DEBUG', 'False').lower() in ('true', '1', 't')
 PORT = int(os.environ.get('PORT', 5000))
+
+# Connection pool settings (see db.py)
+DB_POOL = {
+    'min_size': int(os.environ.get('DB_POOL_MIN', 1)),
+    'max_size': int(os.environ.get('DB_POOL_MAX', 10)),
+    # Seconds to wait for a free connection before giving up
+    'timeout': float(os.environ.get('DB_POOL_TIMEOUT', 5)),
+    # Recycle connections after this many borrows / seconds (0 disables)
+    'max_uses': int(os.environ.get('DB_POOL_MAX_USES', 5000)),
+    'max_age': float(os.environ.get('DB_POOL_MAX_AGE', 1800)),
+    # Ping connections that sat idle longer than this before handing them out
+    'validate_after': float(os.environ.get('DB_POOL_VALIDATE_AFTER', 30)),
+}
+
+# Read replicas for catalog reads (see replicas.py): comma separated
+# host[:port] list, using DB_CONFIG's database, user and password. Empty:
+# everything goes to the primary.
+DB_REPLICAS = [
+    (host, port or DB_CONFIG['port'])
+    for host, _, port in (
+        entry.strip().partition(':') for entry in os.environ.get('DB_REPLICAS', '').split(',')
+    )
+    if host
+]
+REPLICAS = {
+    # Replicas further behind than this many seconds get no reads
+    'max_lag': float(os.environ.get('DB_REPLICA_MAX_LAG', 5)),
+    # Seconds between health/lag checks
+    'check_interval': float(os.environ.get('DB_REPLICA_CHECK_INTERVAL', 1)),
+    'connect_timeout': int(os.environ.get('DB_REPLICA_CONNECT_TIMEOUT', 2)),
+}
+
+# In-process catalog cache (see cache.py)
+CATALOG_CACHE = {
+    'max_entries': int(os.environ.get('CATALOG_CACHE_MAX_ENTRIES', 1024)),
+    # Safety-net expiry in seconds; normal invalidation is via LISTEN/NOTIFY
+    'ttl': float(os.environ.get('CATALOG_CACHE_TTL', 300)),
+    'listen': os.environ.get('CATALOG_CACHE_LISTEN', 'True').lower() in ('true', '1', 't'),
+}
+
+# Coalescing of concurrent catalog cache misses (see singleflight.py)
+SINGLE_FLIGHT = {
+    'enabled': os.environ.get('SINGLE_FLIGHT_ENABLED', 'True').lower() in ('true', '1', 't'),
+    # Directory for lock files that also coalesce misses across worker
+    # processes (e.g. /dev/shm/bookstore-singleflight); must be private to
+    # the API's user (mode 0700). Empty: per process only
+    'lock_dir': os.environ.get('SINGLE_FLIGHT_LOCK_DIR', ''),
+    # Longest a request waits for someone else's load before loading itself
+    'wait_timeout': float(os.environ.get('SINGLE_FLIGHT_WAIT_TIMEOUT', 5)),
+}
+
+# Cache-Control for catalog responses; clients revalidate with ETags afterwards
+HTTP_CACHE = {
+    'max_age': int(os.environ.get('CATALOG_MAX_AGE', 60)),
+    'stale_while_revalidate': int(os.environ.get('CATALOG_STALE_WHILE_REVALIDATE', 30)),
+}
+
+# Response compression (see compression.py)
+COMPRESSION = {
+    'enabled': os.environ.get('COMPRESSION_ENABLED', 'True').lower() in ('true', '1', 't'),
+    # JSON bodies smaller than this many bytes are sent uncompressed
+    'min_size': int(os.environ.get('COMPRESSION_MIN_SIZE', 1024)),
+    # Preference order when the client accepts several
+    'encodings': [e.strip() for e in os.environ.get('COMPRESSION_ENCODINGS', 'zstd,br,gzip').split(',')],
+}
+
+# Featured products come from the featured_products table; scheduled
+# start/end times are picked up within this many seconds
+FEATURED_REFRESH = float(os.environ.get('FEATURED_REFRESH', 60))
+
+# Static catalog snapshots for nginx/CDN serving (see snapshot.py)
+SNAPSHOT = {
+    # Snapshot root; versions go in timestamped directories, `current` links the newest
+    'dir': os.environ.get('SNAPSHOT_DIR', ''),
+    # Versions kept after an export (older ones are deleted)
+    'keep': int(os.environ.get('SNAPSHOT_KEEP', 3)),
+}
+
+# Book cover serving (see images.py)
+IMAGES = {
+    'dir': os.environ.get('IMAGE_DIR', os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), '..', 'ui', 'public', 'images', 'books')),
+    # Cache-Control max-age for unversioned image URLs (versioned ones are immutable)
+    'max_age': int(os.environ.get('IMAGE_MAX_AGE', 86400)),
+    # Seconds between checks of the image directory for added/changed files
+    'manifest_check': float(os.environ.get('IMAGE_MANIFEST_CHECK', 2)),
+    # In-memory cache for small covers
+    'memory_bytes': int(os.environ.get('IMAGE_MEMORY_BYTES', 32 * 1024 * 1024)),
+    'memory_max_file': int(os.environ.get('IMAGE_MEMORY_MAX_FILE', 256 * 1024)),
+    # Fraction of image requests written to the access log
+    'access_log_sample': float(os.environ.get('IMAGE_ACCESS_LOG_SAMPLE', 0.01)),
+    # Disk cache for resized / re-encoded variants (0 bytes disables variants)
+    'variant_dir': os.environ.get('IMAGE_VARIANT_DIR', os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), '.image_cache')),
+    'variant_max_bytes': int(os.environ.get('IMAGE_VARIANT_MAX_BYTES', 512 * 1024 * 1024)),
+    # Widths variants are rendered at; requested widths are rounded up to one of these
+    'variant_widths': [int(w) for w in os.environ.get(
+        'IMAGE_VARIANT_WIDTHS', '100,200,300,400,600,800').split(',')],
+}
+
+# 'wsgi' runs the Flask app directly; 'asgi' serves it through asgi.py with
+# async catalog handlers (needs requirements-asgi.txt)
+SERVER_MODE = os.environ.get('SERVER_MODE', 'wsgi').lower()
+
+# Production server (gunicorn.conf.py): pre-forked worker processes, each
+# with its own pool, cache and background threads
+SERVER = {
+    'workers': int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 1)),
+    # Threads per worker; more than 1 uses gunicorn's gthread worker
+    'threads': int(os.environ.get('WORKER_THREADS', 4)),
+    # Seconds a request may take before its worker is killed and replaced
+    'timeout': int(os.environ.get('WORKER_TIMEOUT', 30)),
+    # Seconds workers get to finish in-flight requests on shutdown/reload
+    'graceful_timeout': int(os.environ.get('GRACEFUL_TIMEOUT', 30)),
+    'keepalive': int(os.environ.get('KEEPALIVE', 5)),
+    # Replace a worker after this many requests (0 disables), plus up to
+    # `jitter` more so workers don't all restart at once
+    'max_requests': int(os.environ.get('WORKER_MAX_REQUESTS', 10000)),
+    'max_requests_jitter': int(os.environ.get('WORKER_MAX_REQUESTS_JITTER', 1000)),
+}
+
+# Per-session carts (see carts.py)
+CARTS = {
+    'cookie': os.environ.get('CART_COOKIE', 'cart_id'),
+    'header': os.environ.get('CART_HEADER', 'X-Cart-Id'),
+    # Carts with no activity for this many days are deleted
+    'ttl_days': int(os.environ.get('CART_TTL_DAYS', 30)),
+    # Seconds between abandoned-cart sweeps (0 disables the sweep)
+    'sweep_interval': float(os.environ.get('CART_SWEEP_INTERVAL', 3600)),
+}
+
+# Checkout (see orders.py)
+ORDERS = {
+    # Longest a checkout waits for another checkout's stock locks before
+    # giving up with 503 (the client retries with the same Idempotency-Key)
+    'lock_timeout_ms': int(os.environ.get('CHECKOUT_LOCK_TIMEOUT_MS', 2000)),
+}
+
+# Admission control (see admission.py); limits apply per worker process
+ADMISSION = {
+    'enabled': os.environ.get('ADMISSION_ENABLED', 'True').lower() in ('true', '1', 't'),
+    # Per-client token bucket: sustained requests per second and burst size
+    # (rate 0 disables rate limiting)
+    'rate': float(os.environ.get('RATE_LIMIT_RATE', 50)),
+    'burst': float(os.environ.get('RATE_LIMIT_BURST', 100)),
+    # Header holding the client address behind a proxy (e.g. X-Forwarded-For);
+    # empty uses the connection's remote address
+    'client_header': os.environ.get('RATE_LIMIT_CLIENT_HEADER', ''),
+    # Trusted proxies in front of the API that append to that header; the
+    # client is the entry this many from the right (earlier ones are client
+    # controlled)
+    'trusted_hops': max(1, int(os.environ.get('RATE_LIMIT_TRUSTED_HOPS', 1))),
+    'max_clients': int(os.environ.get('RATE_LIMIT_MAX_CLIENTS', 10000)),
+    # Requests holding database connections at once, and how many more may
+    # wait (for at most max_wait seconds) before requests are shed with 503
+    'max_concurrent': int(os.environ.get('ADMISSION_MAX_CONCURRENT', DB_POOL['max_size'])),
+    'queue_size': int(os.environ.get('ADMISSION_QUEUE_SIZE', 20)),
+    'max_wait': float(os.environ.get('ADMISSION_MAX_WAIT', 0.5)),
+    # Retry-After seconds sent with 503s
+    'retry_after': int(os.environ.get('ADMISSION_RETRY_AFTER', 1)),
+}
+
+# Prometheus metrics at /metrics and the Server-Timing header (see metrics.py)
+METRICS = {
+    'enabled': os.environ.get('METRICS_ENABLED', 'True').lower() in ('true', '1', 't'),
+    'server_timing': os.environ.get('SERVER_TIMING', 'True').lower() in ('true', '1', 't'),
+}
+
+# Per-statement stats and slow-query log with sampled EXPLAIN (see query_log.py)
+QUERY_LOG = {
+    'enabled': os.environ.get('QUERY_LOG_ENABLED', 'True').lower() in ('true', '1', 't'),
+    # Statements at least this slow are logged and may have their plan captured
+    'slow_ms': float(os.environ.get('SLOW_QUERY_MS', 200)),
+    'explain': os.environ.get('SLOW_QUERY_EXPLAIN', 'True').lower() in ('true', '1', 't'),
+    # Fraction of slow statements explained, and minimum seconds between
+    # plans for the same statement
+    'explain_sample': float(os.environ.get('SLOW_QUERY_EXPLAIN_SAMPLE', 1.0)),
+    'explain_interval': float(os.environ.get('SLOW_QUERY_EXPLAIN_INTERVAL', 300)),
+    'max_fingerprints': int(os.environ.get('QUERY_LOG_MAX_STATEMENTS', 500)),
+}
+
+# Token required by protected debug endpoints (X-Debug-Token header). When
+# unset they are only served in DEBUG mode.
+DEBUG_TOKEN = os.environ.get('DEBUG_TOKEN', '')
@@ -5,27 +5,17 @@ Run this before starting the Flask app.
 """
 import os
 import sys
-import psycopg2
 from psycopg2 import sql
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from config import DB_CONFIG
+from db import connect
 
-# Database configuration from environment variables
-DB_HOST = os.environ.get('DB_HOST', 'localhost')
-DB_PORT = os.environ.get('DB_PORT', '5432')
-DB_NAME = os.environ.get('DB_NAME', 'bookstore')
-DB_USER = os.environ.get('DB_USER', 'postgres')
-DB_PASSWORD = os.environ.get('DB_PASSWORD', 'postgres')
+DB_NAME = DB_CONFIG['database']
 
 def create_database():
     """Create the database if it doesn't exist."""
     # Connect to the default PostgreSQL database
-    conn = psycopg2.connect(
-        host=DB_HOST,
-        port=DB_PORT,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        database="postgres"
-    )
+    conn = connect(database="postgres")
     conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
     
     try:
@@ -0,0 +1,496 @@
+"""
+Database connection pool shared by the Flask API and the helper scripts.
+
+Connections are borrowed with get_db_connection() and handed back by calling
+close() on them, so code written against a plain psycopg2 connection keeps
+working unchanged.
+"""
+import os
+import threading
+import time
+import logging
+from collections import deque
+
+import psycopg2
+from psycopg2 import extensions
+
+import admission
+import metrics
+from config import DB_CONFIG, DB_POOL, QUERY_LOG
+from query_log import query_log
+
+logger = logging.getLogger(__name__)
+
+# NUMERIC columns (prices) are read as float instead of Decimal, so rows can
+# go straight to the JSON encoder without a conversion pass per row
+DEC2FLOAT = extensions.new_type(
+    extensions.DECIMAL.values, 'DEC2FLOAT',
+    lambda value, cur: float(value) if value is not None else None
+)
+extensions.register_type(DEC2FLOAT)
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection became available within the borrow timeout."""
+
+
+class _TimedCursorMixin:
+    """
+    Reports the duration of every execute() to metrics.observe_query() and
+    the slow-query log (query_log.py).
+    """
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = super().execute(query, vars)
+            failed = False
+            return result
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.observe_query(elapsed)
+            if QUERY_LOG['enabled']:
+                query_log.record(self, query, vars, elapsed, error=failed)
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            metrics.observe_query(time.perf_counter() - started)
+
+
+_timed_cursor_classes = {}
+
+
+def _timed_cursor_class(base):
+    cls = _timed_cursor_classes.get(base)
+    if cls is None:
+        cls = type(f'Timed{base.__name__}', (_TimedCursorMixin, base), {})
+        _timed_cursor_classes[base] = cls
+    return cls
+
+
+class InstrumentedConnection(extensions.connection):
+    """
+    psycopg2 connection whose cursors (of whatever cursor_factory the caller
+    asks for, e.g. RealDictCursor) time their queries.
+    """
+
+    def cursor(self, *args, **kwargs):
+        factory = kwargs.get('cursor_factory') or self.cursor_factory or extensions.cursor
+        kwargs['cursor_factory'] = _timed_cursor_class(factory)
+        return super().cursor(*args, **kwargs)
+
+
+def connect(database=None, **overrides):
+    """
+    Open a new, unpooled connection (e.g. to the 'postgres' maintenance db).
+    `overrides` replace connection parameters, e.g. host/port for a replica.
+    """
+    params = dict(
+        host=DB_CONFIG['host'],
+        port=DB_CONFIG['port'],
+        dbname=database or DB_CONFIG['database'],
+        user=DB_CONFIG['user'],
+        password=DB_CONFIG['password'],
+        connection_factory=InstrumentedConnection
+    )
+    params.update(overrides)
+    return psycopg2.connect(**params)
+
+
+class _PoolEntry:
+    """Bookkeeping for one physical connection owned by the pool."""
+    __slots__ = ('conn', 'pid', 'created_at', 'last_used', 'uses')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.pid = os.getpid()
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.uses = 0
+
+
+class PooledConnection:
+    """
+    Thin proxy around a psycopg2 connection borrowed from a ConnectionPool.
+    Everything is delegated to the real connection except close(), which
+    returns the connection to the pool instead of closing the socket.
+    """
+
+    def __init__(self, pool, entry):
+        object.__setattr__(self, '_pool', pool)
+        object.__setattr__(self, '_entry', entry)
+
+    @property
+    def raw(self):
+        entry = self._entry
+        if entry is None:
+            raise psycopg2.InterfaceError("connection already returned to the pool")
+        return entry.conn
+
+    def close(self):
+        entry = self._entry
+        if entry is not None:
+            object.__setattr__(self, '_entry', None)
+            self._pool._return(entry)
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.raw, name, value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Same semantics as psycopg2: commit or roll back, but keep the connection
+        return self.raw.__exit__(exc_type, exc, tb)
+
+
+class ConnectionPool:
+    """
+    Thread-safe, fork-aware pool of psycopg2 connections.
+
+    Args:
+        minconn: Connections opened up front and kept around when idle
+        maxconn: Hard cap on open connections
+        timeout: Seconds to wait for a free connection before PoolTimeout
+        max_uses: Recycle a connection after this many borrows (0 = never)
+        max_age: Recycle a connection after this many seconds (0 = never)
+        validate_after: Ping connections idle longer than this before reuse
+        connect_fn: Callable returning a new psycopg2 connection
+    """
+
+    def __init__(self, minconn, maxconn, timeout=5.0, max_uses=0, max_age=0,
+                 validate_after=30.0, connect_fn=connect):
+        if maxconn < 1 or minconn > maxconn:
+            raise ValueError("pool size must satisfy 0 <= minconn <= maxconn, maxconn >= 1")
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_uses = max_uses
+        self.max_age = max_age
+        self.validate_after = validate_after
+        self._connect = connect_fn
+        self._cond = threading.Condition(threading.Lock())
+        self._reset_state()
+
+    def _reset_state(self):
+        self._pid = os.getpid()
+        self._idle = deque()
+        self._in_use = 0
+        self._opening = 0
+        self._waiting = 0
+        self._filled = False
+        self._closed = False
+        self._stats = {
+            'borrowed': 0,
+            'created': 0,
+            'recycled': 0,
+            'discarded': 0,
+            'failed_validations': 0,
+            'timeouts': 0,
+            'waits': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+        }
+
+    # -- lifecycle -------------------------------------------------------
+
+    def _check_fork(self):
+        """Drop connections inherited from a parent process without closing them."""
+        if self._pid != os.getpid():
+            self.reset_after_fork()
+
+    def reset_after_fork(self):
+        """
+        Forget every connection inherited from the parent process. The sockets
+        still belong to the parent, so they must not be closed (that would
+        send a Terminate message on the parent's session); they are kept
+        referenced so garbage collection never finalizes them either.
+        """
+        inherited = [entry.conn for entry in self._idle]
+        _fork_orphans.extend(inherited)
+        self._cond = threading.Condition(threading.Lock())
+        self._reset_state()
+
+    def _reserve_fill(self):
+        """
+        On first use, reserve slots for the minimum number of connections.
+        Called with the lock held; returns how many _fill() should open.
+        """
+        if self._filled:
+            return 0
+        self._filled = True
+        missing = self.minconn - (len(self._idle) + self._in_use + self._opening)
+        if missing <= 0:
+            return 0
+        self._opening += missing
+        return missing
+
+    def _fill(self, count):
+        """
+        Open `count` connections reserved by _reserve_fill(), without holding
+        the lock, so a slow or unreachable server doesn't block every
+        getconn()/putconn() behind connection timeouts.
+        """
+        for opened in range(count):
+            try:
+                conn = self._connect()
+            except psycopg2.Error as e:
+                logger.warning(f"Could not pre-open pooled connection: {e}")
+                with self._cond:
+                    self._opening -= count - opened
+                    self._cond.notify_all()
+                return
+            with self._cond:
+                self._opening -= 1
+                self._stats['created'] += 1
+                if self._closed:
+                    self._close_entry(_PoolEntry(conn))
+                    continue
+                self._idle.append(_PoolEntry(conn))
+                self._cond.notify()
+
+    def closeall(self):
+        """Close all idle connections; borrowed ones are closed when returned."""
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                self._close_entry(self._idle.pop())
+            self._cond.notify_all()
+
+    # -- borrow / return -------------------------------------------------
+
+    def getconn(self, timeout=None):
+        """Borrow a connection, waiting up to `timeout` seconds for one to free up."""
+        # The request's first borrow waits for a database slot (admission.py)
+        admission.admit()
+        self._check_fork()
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        waited_since = None
+
+        with self._cond:
+            if self._closed:
+                raise psycopg2.InterfaceError("connection pool is closed")
+            to_open = self._reserve_fill()
+        if to_open:
+            self._fill(to_open)
+
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise psycopg2.InterfaceError("connection pool is closed")
+                if self._idle:
+                    entry = self._idle.pop()
+                    self._in_use += 1
+                    break
+                if self._in_use + self._opening + len(self._idle) < self.maxconn:
+                    entry = None
+                    self._opening += 1
+                    break
+
+                if waited_since is None:
+                    waited_since = time.monotonic()
+                    self._stats['waits'] += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    self._record_wait(waited_since)
+                    metrics.observe_pool_wait(time.monotonic() - started)
+                    raise PoolTimeout(
+                        f"no database connection available within {timeout:.1f}s "
+                        f"({self._in_use} in use, max {self.maxconn})"
+                    )
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+
+            if waited_since is not None:
+                self._record_wait(waited_since)
+
+        if entry is None:
+            entry = self._open_entry()
+        else:
+            entry = self._validate(entry)
+
+        entry.uses += 1
+        entry.last_used = time.monotonic()
+        with self._cond:
+            self._stats['borrowed'] += 1
+        # Includes opening/validating the connection, not just queueing
+        metrics.observe_pool_wait(entry.last_used - started)
+        return PooledConnection(self, entry)
+
+    def _open_entry(self):
+        """Open a new connection for a slot reserved by getconn()."""
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._opening -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._opening -= 1
+            self._in_use += 1
+            self._stats['created'] += 1
+        return _PoolEntry(conn)
+
+    def _validate(self, entry):
+        """Make sure a reused connection is still alive, replacing it if not."""
+        stale = entry.conn.closed
+        if not stale and time.monotonic() - entry.last_used > self.validate_after:
+            try:
+                with entry.conn.cursor() as cur:
+                    cur.execute('SELECT 1')
+                entry.conn.rollback()
+            except psycopg2.Error:
+                stale = True
+        if not stale:
+            return entry
+
+        logger.info("Discarding stale pooled database connection")
+        self._close_entry(entry)
+        with self._cond:
+            self._stats['failed_validations'] += 1
+            self._stats['discarded'] += 1
+            self._in_use -= 1
+            self._opening += 1
+        return self._open_entry()
+
+    def _return(self, entry):
+        """Called by PooledConnection.close()."""
+        if entry.pid != os.getpid():
+            # Opened before a fork: the connection belongs to the parent
+            _fork_orphans.append(entry.conn)
+            return
+
+        conn = entry.conn
+        keep = not conn.closed
+        if keep:
+            try:
+                if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+            except psycopg2.Error:
+                keep = False
+
+        now = time.monotonic()
+        recycle = keep and (
+            (self.max_uses and entry.uses >= self.max_uses) or
+            (self.max_age and now - entry.created_at >= self.max_age)
+        )
+
+        with self._cond:
+            self._in_use -= 1
+            if keep and not recycle and not self._closed:
+                entry.last_used = now
+                self._idle.append(entry)
+            else:
+                self._stats['recycled' if recycle else 'discarded'] += 1
+                self._close_entry(entry)
+            self._cond.notify()
+
+    @staticmethod
+    def _close_entry(entry):
+        try:
+            entry.conn.close()
+        except Exception:
+            pass
+
+    def _record_wait(self, waited_since):
+        waited = time.monotonic() - waited_since
+        self._stats['wait_time_total'] += waited
+        if waited > self._stats['wait_time_max']:
+            self._stats['wait_time_max'] = waited
+
+    # -- monitoring ------------------------------------------------------
+
+    def stats(self):
+        """Snapshot of pool usage suitable for JSON serialization."""
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                'pid': self._pid,
+                'min_size': self.minconn,
+                'max_size': self.maxconn,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'opening': self._opening,
+                'waiting': self._waiting,
+                'size': self._in_use + len(self._idle) + self._opening,
+            })
+        stats['wait_time_avg'] = (
+            stats['wait_time_total'] / stats['waits'] if stats['waits'] else 0.0
+        )
+        return stats
+
+
+# Connections inherited across fork(); kept alive so they are never finalized
+_fork_orphans = []
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the process-wide pool, creating it from config on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    minconn=DB_POOL['min_size'],
+                    maxconn=DB_POOL['max_size'],
+                    timeout=DB_POOL['timeout'],
+                    max_uses=DB_POOL['max_uses'],
+                    max_age=DB_POOL['max_age'],
+                    validate_after=DB_POOL['validate_after'],
+                )
+    return _pool
+
+
+def get_db_connection():
+    """Borrow a connection from the pool; call close() on it to give it back"""
+    return get_pool().getconn()
+
+
+def open_pool():
+    """Create the pool and open its minimum connections now instead of on the first request."""
+    try:
+        get_pool().getconn().close()
+    except (psycopg2.Error, PoolTimeout) as e:
+        # Not fatal: requests retry, and readiness reports it meanwhile
+        logger.warning(f"Could not open database pool: {e}")
+
+
+def close_pool():
+    """Close this process's pooled connections (e.g. when a server worker exits)."""
+    if _pool is not None:
+        _pool.closeall()
+
+
+def pool_stats():
+    """Stats for the process-wide pool (empty until it has been used)"""
+    return _pool.stats() if _pool is not None else {}
+
+
+def _after_fork_in_child():
+    global _pool_lock
+    _pool_lock = threading.Lock()
+    if _pool is not None:
+        _pool.reset_after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
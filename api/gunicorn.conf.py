@@ -0,0 +1,47 @@
+"""
+Gunicorn configuration for serving the API in production:
+
+    gunicorn -c gunicorn.conf.py main:app
+
+The app is imported once in the master (preload_app) and forked into one
+worker per core, so workers start in milliseconds and share the imported
+code and image manifest copy-on-write. Migrations run once in the master
+before any worker starts; each worker then opens its own connection pool
+and starts its cache invalidation listener and cart sweeper after fork
+(main.init_worker), since connections and threads don't survive fork().
+
+Signals (to the master):
+    TERM  graceful shutdown: stop accepting, finish in-flight requests
+          within graceful_timeout, close pools
+    HUP   replace all workers gracefully (picks up config changes; code is
+          preloaded, so deploy new code with USR2 and then TERM the old master)
+    TTIN / TTOU  add / remove a worker
+"""
+from config import PORT, SERVER
+
+bind = f"0.0.0.0:{PORT}"
+workers = SERVER['workers']
+threads = SERVER['threads']
+worker_class = 'gthread' if threads > 1 else 'sync'
+preload_app = True
+timeout = SERVER['timeout']
+graceful_timeout = SERVER['graceful_timeout']
+keepalive = SERVER['keepalive']
+max_requests = SERVER['max_requests']
+max_requests_jitter = SERVER['max_requests_jitter']
+accesslog = '-'
+
+
+def on_starting(server):
+    from main import init_db
+    init_db()
+
+
+def post_worker_init(worker):
+    from main import init_worker
+    init_worker()
+
+
+def worker_exit(server, worker):
+    from main import shutdown_worker
+    shutdown_worker()
@@ -0,0 +1,102 @@
+"""
+HTTP caching for catalog endpoints.
+
+Catalog responses are serialized once per catalog version and stored in the
+catalog cache together with a strong ETag (a hash of the body) and the time
+they were built. Requests carrying a matching If-None-Match (or a recent
+enough If-Modified-Since) get a 304 straight from the cache, without any
+database work or JSON encoding. Compressed variants of a body are built on
+first request and kept on the same entry (see compression.py).
+"""
+import hashlib
+from datetime import datetime, timezone
+
+from flask import current_app, request
+
+import compression
+import metrics
+from cache import cached, catalog_cache
+from config import HTTP_CACHE
+
+
+CACHE_CONTROL = f"public, max-age={HTTP_CACHE['max_age']}"
+if HTTP_CACHE['stale_while_revalidate']:
+    CACHE_CONTROL += f", stale-while-revalidate={HTTP_CACHE['stale_while_revalidate']}"
+
+
+class CachedBody:
+    """A serialized response body plus the validators that describe it."""
+    __slots__ = ('body', 'status', 'etag', 'last_modified', '_encoded')
+
+    def __init__(self, body, status=200, last_modified=None):
+        self.body = body
+        self.status = status
+        self.etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        # HTTP dates have one-second resolution; catalog responses pass
+        # catalog_cache.last_modified() so a newer version is always later
+        self.last_modified = last_modified or datetime.now(timezone.utc).replace(microsecond=0)
+        self._encoded = {}
+
+    def encoded(self, encoding):
+        """The body compressed with `encoding`; compressed once, then kept with the entry."""
+        body = self._encoded.get(encoding)
+        if body is None:
+            # Two threads may race to build it; both produce the same bytes
+            body = self._encoded[encoding] = compression.compress(self.body, encoding, precompressed=True)
+        return body
+
+    def negotiate(self, accept_encoding):
+        """(body, etag, encoding) of the representation to send for an Accept-Encoding header."""
+        encoding = compression.negotiate(accept_encoding, len(self.body))
+        if encoding is None:
+            return self.body, self.etag, None
+        return self.encoded(encoding), f"{self.etag}-{encoding}", encoding
+
+
+def build_cached_body(data, status=200, json_provider=None, last_modified=None):
+    """
+    Serialize data the same way jsonify() would and wrap it for caching.
+    Outside a Flask request (the ASGI app) pass the app's json provider.
+    """
+    provider = json_provider or current_app.json
+    dumps_bytes = getattr(provider, 'dumps_bytes', None)
+    if dumps_bytes is not None:
+        return CachedBody(dumps_bytes(data) + b"\n", status, last_modified)
+    return CachedBody(f"{provider.dumps(data)}\n".encode('utf-8'), status, last_modified)
+
+
+def conditional_response(entry):
+    """
+    Build a response for a cached body, answering 304 Not Modified when the
+    client's validators still match.
+    """
+    body, etag, encoding = entry.negotiate(request.headers.get('Accept-Encoding'))
+    response = current_app.response_class(
+        body, status=entry.status, mimetype='application/json'
+    )
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    if entry.status != 200:
+        return response
+    response.set_etag(etag)
+    response.last_modified = entry.last_modified
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    return response.make_conditional(request)
+
+
+def catalog_response(key, loader, not_found="Not found", ttl=None):
+    """
+    Serve a catalog endpoint through the catalog cache with conditional GET
+    support. `loader` returns the JSON-ready data, or None for a 404.
+    `ttl` overrides the cache TTL for data that changes on a schedule.
+    """
+    def load():
+        metrics.mark_cache('miss')
+        last_modified = catalog_cache.last_modified()
+        data = loader()
+        if data is None:
+            return build_cached_body({"error": not_found}, status=404)
+        return build_cached_body(data, last_modified=last_modified)
+
+    metrics.mark_cache('hit')
+    return conditional_response(cached(key, load, ttl=ttl))
@@ -0,0 +1,532 @@
+"""
+Book cover serving.
+
+The image directory is scanned into a manifest (filename -> size, mtime,
+content hash) once at startup and re-scanned at most every few seconds, so
+requests never touch the filesystem just to find out whether a cover
+exists. Covers are served with strong ETags and Last-Modified; URLs
+carrying the content hash (?v=<hash>, as produced by versioned_url()) are
+marked immutable so browsers never re-download them. Small, hot covers are
+kept in a bounded in-memory cache; everything else goes out through
+send_file, which hands the file to the server's wsgi.file_wrapper
+(sendfile(2) under gunicorn) instead of copying it through Python.
+"""
+import os
+import random
+import hashlib
+import logging
+import mimetypes
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from flask import abort, current_app, request, send_file
+
+from cache import catalog_cache
+from config import IMAGES
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # Pillow is optional; without it only originals are served
+    Image = None
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows; eviction is then unlocked
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+mimetypes.add_type('image/webp', '.webp')
+mimetypes.add_type('image/avif', '.avif')
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Variant output formats: name -> (Pillow format, mimetype, extension, save options)
+VARIANT_FORMATS = {
+    'avif': ('AVIF', 'image/avif', '.avif', {'quality': 50}),
+    'webp': ('WEBP', 'image/webp', '.webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'image/jpeg', '.jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+    'png': ('PNG', 'image/png', '.png', {'optimize': True}),
+}
+
+# Preferred formats when negotiating from the Accept header, best first
+NEGOTIATED_FORMATS = ('avif', 'webp')
+
+
+def _supported_formats():
+    if Image is None:
+        return set()
+    supported = {'jpeg', 'png'}
+    for name in ('webp', 'avif'):
+        try:
+            if features.check(name):
+                supported.add(name)
+        except ValueError:
+            pass
+    return supported
+
+
+SUPPORTED_FORMATS = _supported_formats()
+
+
+class ImageInfo:
+    """Manifest entry for one image file."""
+    __slots__ = ('path', 'size', 'mtime_ns', 'version', 'mimetype', 'last_modified')
+
+    def __init__(self, path, size, mtime_ns, version):
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.version = version
+        self.mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.last_modified = datetime.fromtimestamp(
+            mtime_ns // 1_000_000_000, tz=timezone.utc)
+
+
+def _hash_file(path):
+    digest = hashlib.blake2b(digest_size=8)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ByteLRU:
+    """LRU cache of file contents bounded by total size in bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            body = self._data.get(key)
+            if body is not None:
+                self._data.move_to_end(key)
+            return body
+
+    def set(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                return
+            self._data[key] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.size -= len(evicted)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class VariantUnavailable(Exception):
+    """The source image can't be decoded, so it has no variants; serve the original."""
+
+
+class VariantCache:
+    """
+    Content-addressed disk cache of rendered image variants, bounded by
+    total size. File names are a hash of (source content hash, width,
+    format), so a changed cover can never be served from a stale variant and
+    several worker processes can share the directory.
+
+    The size budget applies to the directory, not to one process: after
+    each render the directory is scanned under an exclusive lock file
+    (flock) and the least recently used variants (by mtime, which hits
+    refresh) are deleted until it fits. Variants are handed out as open
+    files, so one evicted by another worker meanwhile is still served.
+
+    Args:
+        directory: Where rendered variants are stored
+        max_bytes: Size budget; least recently used variants are deleted beyond it
+    """
+
+    # Hits refresh a variant's mtime at most this often (seconds)
+    TOUCH_INTERVAL = 60
+
+    def __init__(self, directory, max_bytes):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._building = {}
+        self._stats = {'hits': 0, 'renders': 0, 'evictions': 0, 'undecodable': 0}
+        # Content versions of sources Pillow couldn't decode; not retried
+        self._undecodable = set()
+        # Size of the directory at the last scan
+        self._scanned = {'variants': 0, 'bytes': 0}
+        os.makedirs(self.directory, exist_ok=True)
+        self._evict()
+
+    def open(self, info, width, fmt):
+        """Open file of the variant of `info` at `width` in `fmt`, rendering it if needed."""
+        for _ in range(3):
+            path = self.get_or_render(info, width, fmt)
+            try:
+                return open(path, 'rb')
+            except FileNotFoundError:
+                # Evicted by another worker between render and open
+                continue
+        raise FileNotFoundError(path)
+
+    def get_or_render(self, info, width, fmt):
+        """
+        Path of the variant of `info` at `width` in `fmt`, rendering it if
+        needed. Raises VariantUnavailable when the source can't be decoded.
+        """
+        if info.version in self._undecodable:
+            raise VariantUnavailable(info.path)
+        ext = VARIANT_FORMATS[fmt][2]
+        key = hashlib.blake2b(f"{info.version}:{width}:{fmt}".encode(),
+                              digest_size=16).hexdigest()
+        name = key + ext
+        path = os.path.join(self.directory, name)
+
+        if self._touch(path):
+            with self._lock:
+                self._stats['hits'] += 1
+            return path
+        with self._lock:
+            build_lock = self._building.setdefault(name, threading.Lock())
+
+        # One thread renders a given variant; concurrent requests wait for it
+        with build_lock:
+            try:
+                rendered = not os.path.exists(path)
+                if rendered:
+                    self._render(info, path, width, fmt)
+                # else rendered meanwhile by another thread or worker process
+            finally:
+                with self._lock:
+                    self._building.pop(name, None)
+        with self._lock:
+            self._stats['renders' if rendered else 'hits'] += 1
+        if rendered:
+            self._evict(keep=name)
+        return path
+
+    def _touch(self, path):
+        """Whether the variant exists; marks it recently used."""
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return False
+        if time.time() - mtime > self.TOUCH_INTERVAL:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                return False
+        return True
+
+    def _decode(self, info):
+        """Open and fully decode a source image, or raise VariantUnavailable."""
+        try:
+            img = Image.open(info.path)
+            img.load()
+            return img
+        except (OSError, Image.DecompressionBombError) as e:
+            # Unidentified, truncated or too large (decompression bomb)
+            with self._lock:
+                first = info.version not in self._undecodable
+                self._undecodable.add(info.version)
+                self._stats['undecodable'] += first
+            if first:
+                logger.warning(f"Cannot render variants of {os.path.basename(info.path)}, "
+                               f"serving the original: {e}")
+            raise VariantUnavailable(info.path) from e
+
+    def _render(self, info, path, width, fmt):
+        pil_format, _, _, options = VARIANT_FORMATS[fmt]
+        with self._decode(info) as img:
+            img = ImageOps.exif_transpose(img)
+            if width and width < img.width:
+                # Bound only the width; thumbnail() keeps the aspect ratio
+                img.thumbnail((width, img.height), Image.LANCZOS)
+            if pil_format == 'JPEG' and img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+            # Write to a temporary name and rename, so readers never see a partial file
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                img.save(tmp, format=pil_format, **options)
+                os.replace(tmp, path)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+
+    def _evict(self, keep=None):
+        """Delete the least recently used variants until the directory fits the budget."""
+        with open(os.path.join(self.directory, '.lock'), 'a') as lock_file:
+            if fcntl is not None:
+                # Serializes eviction across the workers sharing the directory
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            entries = []
+            total = 0
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.name.startswith('.') or entry.name.endswith('.tmp'):
+                        continue
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime, entry.name, st.st_size))
+                    total += st.st_size
+            evicted = 0
+            if total > self.max_bytes:
+                entries.sort()
+                for _, name, size in entries:
+                    if total <= self.max_bytes or len(entries) - evicted <= 1:
+                        break
+                    if name == keep:
+                        continue
+                    try:
+                        os.remove(os.path.join(self.directory, name))
+                    except FileNotFoundError:
+                        pass
+                    total -= size
+                    evicted += 1
+        with self._lock:
+            self._stats['evictions'] += evicted
+            self._scanned = {'variants': len(entries) - evicted, 'bytes': total}
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(self._scanned)
+        stats['max_bytes'] = self.max_bytes
+        return stats
+
+
+def snap_width(value, widths):
+    """
+    Round a requested width up to the next configured size, so clients
+    can't fill the cache with one variant per pixel.
+    """
+    try:
+        width = int(value)
+    except ValueError:
+        abort(400)
+    if width < 1:
+        abort(400)
+    for allowed in widths:
+        if width <= allowed:
+            return allowed
+    return widths[-1]
+
+
+def negotiate_format(requested, source_mimetype):
+    """
+    Output format for a variant. Returns (format, negotiated) where
+    negotiated means the choice depended on the Accept header.
+    """
+    if requested and requested != 'auto':
+        requested = 'jpeg' if requested == 'jpg' else requested
+        if requested not in SUPPORTED_FORMATS:
+            abort(400)
+        return requested, False
+
+    # Only honor explicit mentions; "*/*" alone must not get AVIF
+    accepted = {value for value, quality in request.accept_mimetypes if quality > 0}
+    for fmt in NEGOTIATED_FORMATS:
+        if fmt in SUPPORTED_FORMATS and VARIANT_FORMATS[fmt][1] in accepted:
+            return fmt, True
+    for fmt, (_, mimetype, _, _) in VARIANT_FORMATS.items():
+        if mimetype == source_mimetype and fmt in SUPPORTED_FORMATS:
+            return fmt, True
+    return 'jpeg', True
+
+
+class ImageStore:
+    """
+    Manifest-backed image directory.
+
+    Args:
+        directory: Folder holding the images (flat, no subdirectories)
+        check_interval: Minimum seconds between re-scans of the directory
+        memory_bytes: Budget for the in-memory cache of small images
+        memory_max_file: Largest file kept in memory
+        variants: VariantCache for resized/re-encoded covers (None disables them)
+        variant_widths: Sorted widths variants are rendered at
+    """
+
+    def __init__(self, directory, check_interval=2.0, memory_bytes=32 << 20,
+                 memory_max_file=256 << 10, variants=None, variant_widths=(200,)):
+        self.directory = os.path.abspath(directory)
+        self.check_interval = check_interval
+        self.memory_max_file = memory_max_file
+        self.memory = ByteLRU(memory_bytes)
+        self.variants = variants
+        self.variant_widths = tuple(sorted(variant_widths))
+        self._manifest = {}
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0, 'memory_hits': 0, 'not_modified': 0,
+                       'not_found': 0, 'rescans': 0}
+
+    def refresh(self):
+        """Re-scan the directory, re-hashing only files whose size or mtime changed."""
+        manifest = {}
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            entries = []
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            st = entry.stat()
+            old = self._manifest.get(entry.name)
+            if old and old.size == st.st_size and old.mtime_ns == st.st_mtime_ns:
+                manifest[entry.name] = old
+                continue
+            try:
+                version = _hash_file(entry.path)
+            except OSError as e:
+                logger.warning(f"Could not read image {entry.name}: {e}")
+                continue
+            manifest[entry.name] = ImageInfo(entry.path, st.st_size, st.st_mtime_ns, version)
+
+        changed = manifest.keys() != self._manifest.keys() or any(
+            manifest[name] is not self._manifest.get(name) for name in manifest)
+        first_scan = not self._checked_at
+        self._manifest = manifest
+        self._checked_at = time.monotonic()
+        self._stats['rescans'] += 1
+        if changed and not first_scan:
+            logger.info(f"Image directory changed, {len(manifest)} images in manifest")
+            # Catalog responses embed versioned image URLs
+            catalog_cache.invalidate()
+
+    def _maybe_refresh(self):
+        if time.monotonic() - self._checked_at < self.check_interval:
+            return
+        # Only one thread re-scans; the others keep using the current manifest
+        if self._lock.acquire(blocking=not self._checked_at):
+            try:
+                if time.monotonic() - self._checked_at >= self.check_interval:
+                    self.refresh()
+            finally:
+                self._lock.release()
+
+    def lookup(self, filename):
+        self._maybe_refresh()
+        return self._manifest.get(filename)
+
+    def filenames(self):
+        self._maybe_refresh()
+        return sorted(self._manifest)
+
+    def versioned_url(self, base_url, filename):
+        """URL for a cover that includes its content hash, if it is known."""
+        info = self.lookup(filename)
+        if info is None:
+            return f"{base_url}/{filename}"
+        return f"{base_url}/{filename}?v={info.version}"
+
+    def serve(self, filename):
+        """Flask response for an image in the manifest (404 otherwise)."""
+        self._stats['requests'] += 1
+        info = self.lookup(filename)
+        if info is None:
+            self._stats['not_found'] += 1
+            abort(404)
+
+        if 'w' in request.args or 'format' in request.args:
+            if self.variants is not None:
+                try:
+                    return self._serve_variant(filename, info)
+                except VariantUnavailable:
+                    pass
+            # No Pillow / variants disabled / undecodable: fall back to the original
+
+        key = (filename, info.version)
+        body = self.memory.get(key)
+        if body is None and info.size <= self.memory_max_file:
+            with open(info.path, 'rb') as f:
+                body = f.read()
+            self.memory.set(key, body)
+        elif body is not None:
+            self._stats['memory_hits'] += 1
+
+        if body is not None:
+            response = current_app.response_class(body, mimetype=info.mimetype)
+        else:
+            response = send_file(info.path, mimetype=info.mimetype,
+                                 conditional=False, etag=False)
+
+        response.set_etag(info.version)
+        response.last_modified = info.last_modified
+        if request.args.get('v') == info.version:
+            response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        else:
+            response.headers['Cache-Control'] = f"public, max-age={IMAGES['max_age']}"
+        response = response.make_conditional(request)
+        if response.status_code == 304:
+            self._stats['not_modified'] += 1
+
+        if random.random() < IMAGES['access_log_sample']:
+            logger.info(f"Image request: {filename} -> {response.status_code} "
+                        f"({'memory' if body is not None else 'file'})")
+        return response
+
+    def _serve_variant(self, filename, info):
+        width = None
+        if request.args.get('w'):
+            width = snap_width(request.args['w'], self.variant_widths)
+        fmt, negotiated = negotiate_format(request.args.get('format'), info.mimetype)
+
+        # Opened here, so a concurrent eviction can't remove it before it is sent
+        f = self.variants.open(info, width, fmt)
+        response = send_file(f, mimetype=VARIANT_FORMATS[fmt][1],
+                             conditional=False, etag=False)
+        response.content_length = os.fstat(f.fileno()).st_size
+        response.set_etag(f"{info.version}-{width or 0}-{fmt}")
+        response.last_modified = info.last_modified
+        if request.args.get('v') == info.version:
+            response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        else:
+            response.headers['Cache-Control'] = f"public, max-age={IMAGES['max_age']}"
+        if negotiated:
+            response.vary.add('Accept')
+        response = response.make_conditional(request)
+        if response.status_code == 304:
+            self._stats['not_modified'] += 1
+
+        if random.random() < IMAGES['access_log_sample']:
+            logger.info(f"Image request: {filename} w={width} format={fmt} "
+                        f"-> {response.status_code} (variant)")
+        return response
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats.update({
+            'images': len(self._manifest),
+            'memory_entries': len(self.memory),
+            'memory_bytes': self.memory.size,
+        })
+        if self.variants is not None:
+            stats['variants'] = self.variants.stats()
+        return stats
+
+
+def _create_variant_cache():
+    if Image is None:
+        logger.info("Pillow is not installed; image variants (?w=, ?format=) are disabled")
+        return None
+    if not IMAGES['variant_max_bytes']:
+        return None
+    return VariantCache(IMAGES['variant_dir'], IMAGES['variant_max_bytes'])
+
+
+image_store = ImageStore(
+    IMAGES['dir'],
+    check_interval=IMAGES['manifest_check'],
+    memory_bytes=IMAGES['memory_bytes'],
+    memory_max_file=IMAGES['memory_max_file'],
+    variants=_create_variant_cache(),
+    variant_widths=IMAGES['variant_widths'],
+)
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+"""
+Streaming product importer for catalog feeds.
+
+Reads a CSV or JSONL feed row by row and validates each row in Python. Good
+rows are collected into chunks of --batch-size. Each chunk is COPYed into a
+temporary staging table and merged into products with
+INSERT ... ON CONFLICT in its own transaction, so memory stays flat and a
+failure only affects one chunk. Bad rows are written to a reject file with
+the reason instead of aborting the run:
+- rows that fail validation
+- rows pointing at an unknown category
+- rows the database refuses; a failing chunk is bisected until the
+  offending rows are isolated
+
+    python import_products.py feed.csv
+    python import_products.py feed.jsonl --batch-size 5000 --rejects rejects.jsonl
+    zcat feed.jsonl.gz | python import_products.py - --format jsonl
+
+Columns may use the table's names or the camelCase keys of the UI's product
+objects (categoryId, imageUrl). Cover URLs are normalized by the database
+(see check_db_schema.ensure_image_url_normalization).
+"""
+import argparse
+import csv
+import io
+import json
+import sys
+import time
+from decimal import Decimal, InvalidOperation
+
+import psycopg2
+
+from db import connect
+
+# Target column -> accepted feed keys
+COLUMNS = {
+    'id': ('id',),
+    'name': ('name', 'title'),
+    'author': ('author',),
+    'price': ('price',),
+    'category_id': ('category_id', 'categoryId'),
+    'category': ('category',),
+    'description': ('description',),
+    'image_url': ('image_url', 'imageUrl'),
+    'pages': ('pages',),
+    'published': ('published',),
+}
+REQUIRED = ('id', 'name', 'author', 'price')
+# VARCHAR limits from migrations/0001_initial_schema.sql
+MAX_LENGTHS = {'id': 50, 'name': 255, 'author': 100, 'category_id': 50,
+               'category': 100, 'image_url': 255}
+INTEGER_COLUMNS = ('pages', 'published')
+
+STAGING_COLUMNS = ('line_no',) + tuple(COLUMNS)
+UPDATE_COLUMNS = tuple(c for c in COLUMNS if c != 'id')
+
+
+class RejectedRow(ValueError):
+    pass
+
+
+def clean_row(raw):
+    """Map a feed record onto product columns; raises RejectedRow if invalid."""
+    if not isinstance(raw, dict):
+        raise RejectedRow("record is not an object")
+    row = {}
+    for column, keys in COLUMNS.items():
+        value = None
+        for key in keys:
+            if raw.get(key) not in (None, ''):
+                value = raw[key]
+                break
+        if isinstance(value, str):
+            value = value.strip() or None
+        row[column] = value
+
+    missing = [c for c in REQUIRED if row[c] is None]
+    if missing:
+        raise RejectedRow(f"missing {', '.join(missing)}")
+    for column in ('id', 'name', 'author', 'category_id', 'category', 'description', 'image_url'):
+        if row[column] is not None:
+            row[column] = str(row[column])
+    for column, limit in MAX_LENGTHS.items():
+        if row[column] is not None and len(row[column]) > limit:
+            raise RejectedRow(f"{column} longer than {limit} characters")
+    try:
+        price = Decimal(str(row['price']))
+    except InvalidOperation:
+        raise RejectedRow(f"invalid price {row['price']!r}")
+    if not price.is_finite() or price < 0 or price >= Decimal('1e8'):
+        raise RejectedRow(f"price out of range: {row['price']!r}")
+    row['price'] = price.quantize(Decimal('0.01'))
+    for column in INTEGER_COLUMNS:
+        if row[column] is not None:
+            try:
+                row[column] = int(row[column])
+            except (TypeError, ValueError):
+                raise RejectedRow(f"invalid {column} {row[column]!r}")
+            if not -2**31 <= row[column] < 2**31:
+                raise RejectedRow(f"{column} out of range")
+    return row
+
+
+def read_feed(stream, fmt):
+    """Yield (line number, raw record or parse error) without reading ahead."""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+    else:
+        for line_no, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield line_no, json.loads(line)
+            except ValueError as e:
+                yield line_no, RejectedRow(f"invalid JSON: {e}")
+
+
+class Importer:
+    """
+    Args:
+        conn: Database connection (the importer commits on it)
+        batch_size: Rows per staging COPY / merge transaction
+        update: Update existing products (False: only insert new ones)
+        rejects: Writable text stream for rejected rows (JSONL), or None
+    """
+
+    def __init__(self, conn, batch_size=5000, update=True, rejects=None):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.update = update
+        self.rejects = rejects
+        self.counts = {'read': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0, 'rejected': 0}
+        self.started = time.monotonic()
+        self._create_staging()
+
+    def _create_staging(self):
+        with self.conn.cursor() as cur:
+            cur.execute('''
+                CREATE TEMP TABLE IF NOT EXISTS products_staging (
+                    line_no BIGINT NOT NULL,
+                    id VARCHAR(50) NOT NULL,
+                    name VARCHAR(255) NOT NULL,
+                    author VARCHAR(100) NOT NULL,
+                    price DECIMAL(10, 2) NOT NULL,
+                    category_id VARCHAR(50),
+                    category VARCHAR(100),
+                    description TEXT,
+                    image_url VARCHAR(255),
+                    pages INTEGER,
+                    published INTEGER
+                ) ON COMMIT DELETE ROWS
+            ''')
+        self.conn.commit()
+
+    def reject(self, line_no, reason, record=None):
+        self.counts['rejected'] += 1
+        if self.rejects is not None:
+            self.rejects.write(json.dumps({'line': line_no, 'reason': reason, 'record': record},
+                                          default=str, ensure_ascii=False) + '\n')
+
+    def run(self, records):
+        chunk = []
+        for line_no, raw in records:
+            self.counts['read'] += 1
+            if isinstance(raw, RejectedRow):
+                self.reject(line_no, str(raw))
+                continue
+            try:
+                chunk.append((line_no, clean_row(raw), raw))
+            except RejectedRow as e:
+                self.reject(line_no, str(e), raw)
+                continue
+            if len(chunk) >= self.batch_size:
+                self.merge(chunk)
+                chunk = []
+                self.progress()
+        if chunk:
+            self.merge(chunk)
+        self.progress(final=True)
+        return self.counts
+
+    def merge(self, chunk):
+        """Merge one chunk in its own transaction, bisecting it if the database refuses it."""
+        try:
+            self._merge(chunk)
+        except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+            self.conn.rollback()
+            if len(chunk) == 1:
+                line_no, _, raw = chunk[0]
+                self.reject(line_no, str(e).strip().split('\n')[0], raw)
+                return
+            middle = len(chunk) // 2
+            self.merge(chunk[:middle])
+            self.merge(chunk[middle:])
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def _merge(self, chunk):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for line_no, row, _ in chunk:
+            # Unquoted empty CSV fields are NULL to COPY
+            writer.writerow([line_no] + ['' if row[c] is None else row[c] for c in COLUMNS])
+        buffer.seek(0)
+        raw_by_line = {line_no: raw for line_no, _, raw in chunk}
+
+        with self.conn.cursor() as cur:
+            cur.copy_expert(
+                f"COPY products_staging ({', '.join(STAGING_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+                buffer)
+            # Rows for categories that don't exist would fail the foreign key
+            cur.execute('''
+                DELETE FROM products_staging s
+                WHERE s.category_id IS NOT NULL
+                  AND NOT EXISTS (SELECT 1 FROM categories c WHERE c.id = s.category_id)
+                RETURNING s.line_no, s.category_id
+            ''')
+            unknown_categories = cur.fetchall()
+
+            if self.update:
+                conflict = f'''
+                    DO UPDATE SET {', '.join(f'{c} = EXCLUDED.{c}' for c in UPDATE_COLUMNS)}
+                    WHERE ({', '.join(f'p.{c}' for c in UPDATE_COLUMNS)})
+                          IS DISTINCT FROM
+                          ({', '.join(f'EXCLUDED.{c}' for c in UPDATE_COLUMNS)})
+                '''
+            else:
+                conflict = 'DO NOTHING'
+            # DISTINCT ON: a feed may repeat an id; the last occurrence wins
+            # (ON CONFLICT can't touch the same row twice in one statement).
+            # Missing category names are filled in from categories.
+            cur.execute(f'''
+                WITH merged AS (
+                    INSERT INTO products AS p ({', '.join(COLUMNS)})
+                    SELECT DISTINCT ON (s.id)
+                           s.id, s.name, s.author, s.price, s.category_id,
+                           coalesce(s.category, c.name), s.description, s.image_url,
+                           s.pages, s.published
+                    FROM products_staging s
+                    LEFT JOIN categories c ON c.id = s.category_id
+                    ORDER BY s.id, s.line_no DESC
+                    ON CONFLICT (id) {conflict}
+                    RETURNING (xmax = 0) AS inserted
+                )
+                SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted)
+                FROM merged
+            ''')
+            inserted, updated = cur.fetchone()
+            cur.execute('SELECT count(DISTINCT id) FROM products_staging')
+            staged = cur.fetchone()[0]
+        self.conn.commit()
+        # Only now: if the chunk had failed it would be retried in halves
+        for line_no, category_id in unknown_categories:
+            self.reject(line_no, f"unknown category {category_id!r}", raw_by_line.get(line_no))
+        self.counts['inserted'] += inserted
+        self.counts['updated'] += updated
+        self.counts['unchanged'] += staged - inserted - updated
+
+    def progress(self, final=False):
+        elapsed = time.monotonic() - self.started
+        rate = self.counts['read'] / elapsed if elapsed else 0.0
+        counts = ', '.join(f"{k} {v}" for k, v in self.counts.items())
+        print(f"{'Done' if final else 'Progress'}: {counts} ({rate:.0f} rows/s)", flush=True)
+
+
+def import_feed(path, fmt=None, batch_size=5000, update=True, rejects_path=None):
+    """Import a feed file ('-' for stdin); returns the counts."""
+    if fmt is None:
+        fmt = 'csv' if path.endswith('.csv') else 'jsonl'
+    stream = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+    rejects = open(rejects_path, 'w', encoding='utf-8') if rejects_path else None
+    # A dedicated connection: the staging table is private to it
+    conn = connect()
+    try:
+        importer = Importer(conn, batch_size=batch_size, update=update, rejects=rejects)
+        return importer.run(read_feed(stream, fmt))
+    finally:
+        conn.close()
+        if rejects is not None:
+            rejects.close()
+        if stream is not sys.stdin:
+            stream.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import a CSV/JSONL product feed.")
+    parser.add_argument('feed', help="feed file, or - for stdin")
+    parser.add_argument('--format', choices=('csv', 'jsonl'),
+                        help="feed format (default: from the file extension)")
+    parser.add_argument('--batch-size', type=int, default=5000,
+                        help="rows per COPY/merge transaction (default 5000)")
+    parser.add_argument('--insert-only', action='store_true',
+                        help="only add new products, leave existing ones unchanged")
+    parser.add_argument('--rejects', help="write rejected rows with reasons to this JSONL file")
+    args = parser.parse_args()
+
+    counts = import_feed(args.feed, args.format, args.batch_size,
+                         update=not args.insert_only, rejects_path=args.rejects)
+    if counts['rejected']:
+        print(f"{counts['rejected']} rows rejected" +
+              (f", see {args.rejects}" if args.rejects else " (use --rejects to keep them)"))
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
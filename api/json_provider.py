@@ -0,0 +1,75 @@
+"""
+JSON encoding for API responses.
+
+OrjsonProvider replaces Flask's stdlib-json provider with orjson, which
+serializes rows in native code and produces bytes directly, so responses
+and cached catalog bodies skip the str -> bytes round trip. Output matches
+Flask's default provider: sorted keys, HTTP dates for datetimes and
+indentation in debug mode. Without orjson installed the app keeps Flask's
+default provider.
+"""
+import dataclasses
+import decimal
+import uuid
+from datetime import date
+
+from flask.json.provider import JSONProvider
+from werkzeug.http import http_date
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the stdlib encoder
+    orjson = None
+
+
+def _default(o):
+    """Types orjson does not serialize natively (or that Flask formats differently)."""
+    if isinstance(o, date):
+        return http_date(o)
+    if isinstance(o, decimal.Decimal):
+        return float(o)
+    if isinstance(o, uuid.UUID):
+        return str(o)
+    if dataclasses.is_dataclass(o) and not isinstance(o, type):
+        return dataclasses.asdict(o)
+    if hasattr(o, '__html__'):
+        return str(o.__html__())
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson."""
+
+    sort_keys = True
+    compact = None
+    mimetype = 'application/json'
+
+    def _options(self):
+        # Datetimes go through _default so they keep Flask's HTTP date format
+        options = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        if self.compact is False or (self.compact is None and self._app.debug):
+            options |= orjson.OPT_INDENT_2
+        return options
+
+    def dumps_bytes(self, obj):
+        """Serialize obj to UTF-8 encoded JSON bytes."""
+        return orjson.dumps(obj, default=_default, option=self._options())
+
+    def dumps(self, obj, **kwargs):
+        return self.dumps_bytes(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.dumps_bytes(obj) + b"\n", mimetype=self.mimetype)
+
+
+def init_json(app):
+    """Install the fastest available JSON provider on the app."""
+    if orjson is not None:
+        app.json = OrjsonProvider(app)
+    return app.json
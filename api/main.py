@@ -1,39 +1,58 @@
 # app.py
-from flask import Flask, jsonify, request
+from flask import Blueprint, Flask, current_app, jsonify, request
+import hmac
+import functools
 import os
 import sys
 import logging
 import psycopg2
 from psycopg2.extras import RealDictCursor
 from flask_cors import CORS
-from config import DB_CONFIG, DEBUG, PORT
+import admission
+from config import DEBUG, DEBUG_TOKEN, FEATURED_REFRESH, METRICS, PORT, SERVER_MODE
+from db import PoolTimeout, close_pool, get_db_connection, get_pool, open_pool, pool_stats
+from cache import cache_stats, ensure_invalidation_listener, flight_stats
+from carts import ensure_cart_sweeper, get_cart_id, parse_quantity
+from http_cache import catalog_response
+from images import image_store
+import compression
+from json_provider import init_json
+import metrics
+from migrate import current_version, latest_version, migrate
+import orders
+from pagination import parse_limit
+from query_log import query_log
+from replicas import close_replica_pools, ensure_replica_monitor, get_read_connection, replica_stats
+import catalog
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
-app = Flask(__name__)
-CORS(app)
-
-# Database connection configuration from config.py
-DB_HOST = DB_CONFIG['host']
-DB_PORT = DB_CONFIG['port']
-DB_NAME = DB_CONFIG['database']
-DB_USER = DB_CONFIG['user']
-DB_PASSWORD = DB_CONFIG['password']
-
-def get_db_connection():
-    """Create a database connection and return it"""
-    conn = psycopg2.connect(
-        host=DB_HOST,
-        port=DB_PORT,
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD
-    )
-    conn.autocommit = False
-    return conn
-
-# For backwards compatibility during transition - original mock data
+# Every route is registered on this blueprint; create_app() builds the app
+api = Blueprint('api', __name__)
+
+# Export the counters the pool, catalog cache and image store already keep
+metrics.register_stats('db_pool', pool_stats,
+                       counters=('borrowed', 'created', 'recycled', 'discarded', 'timeouts', 'waits'),
+                       gauges=('in_use', 'idle', 'waiting', 'size', 'max_size'))
+metrics.register_stats('admission', admission.stats,
+                       counters=('admitted', 'queued'),
+                       gauges=('active', 'limit', 'queue_depth', 'clients'))
+metrics.register_stats('db_replicas', replica_stats,
+                       counters=('fallbacks',), gauges=('configured', 'healthy'))
+metrics.register_stats('catalog_cache', cache_stats,
+                       counters=('hits', 'misses', 'evictions', 'expirations', 'invalidations'),
+                       gauges=('size', 'hit_ratio'))
+metrics.register_stats('catalog_singleflight', flight_stats,
+                       counters=('leaders', 'followers', 'follower_timeouts',
+                                 'shared_across_workers', 'lock_timeouts'),
+                       gauges=('in_flight',))
+metrics.register_stats('images', image_store.stats,
+                       counters=('requests', 'memory_hits', 'not_modified', 'not_found'),
+                       gauges=('images', 'memory_entries', 'memory_bytes'))
+
+# For backwards compatibility during transition - original mock data (the
+# mock products are now seed_products.jsonl, loaded by update_products.py)
 mock_categories = [
     {"id": "classics", "name": "Classics", "description": "Timeless masterpieces from renowned authors."},
     {"id": "modern", "name": "Modern Literature", "description": "Contemporary works from modern authors."},
@@ -43,479 +62,369 @@ mock_categories = [
     {"id": "science", "name": "Science", "description": "Scientific exploration and discovery."}
 ]
 
-mock_products = [
-    {
-        "id": "1", 
-        "name": "War and Peace", 
-        "author": "Leo Tolstoy",
-        "price": 24.99, 
-        "categoryId": "classics",
-        "category": "Classics",
-        "description": "War and Peace is a novel by Leo Tolstoy, published in 1869. It is regarded as one of Tolstoy's finest literary achievements and remains an internationally praised classic of world literature.",
-        "imageUrl": "/images/books/war-and-peace-leo-tolstoy.jpg",
-        "pages": 1225,
-        "published": 1869
-    },
-    {
-        "id": "2", 
-        "name": "Anna Karenina", 
-        "author": "Leo Tolstoy",
-        "price": 19.99, 
-        "categoryId": "classics",
-        "category": "Classics",
-        "description": "Anna Karenina is a novel by Leo Tolstoy, first published in book form in 1878. Widely considered a pinnacle in realist fiction, Tolstoy himself called it his first true novel.",
-        "imageUrl": "/images/books/anna-karenina-leo-tolstoy.jpg",
-        "pages": 864,
-        "published": 1878
-    },
-    {
-        "id": "3", 
-        "name": "Crime and Punishment", 
-        "author": "Fyodor Dostoevsky",
-        "price": 18.99, 
-        "categoryId": "classics",
-        "category": "Classics",
-        "description": "Crime and Punishment focuses on the mental anguish and moral dilemmas of Rodion Raskolnikov, an impoverished ex-student in Saint Petersburg who formulates a plan to kill an unscrupulous pawnbroker for her money.",
-        "imageUrl": "/images/books/crime-and-punishment-fyodor-dostoevsky.jpg",
-        "pages": 671,
-        "published": 1866
-    },
-    {
-        "id": "4", 
-        "name": "The Idiot", 
-        "author": "Fyodor Dostoevsky",
-        "price": 17.99, 
-        "categoryId": "classics",
-        "category": "Classics",
-        "description": "The Idiot is a novel by Fyodor Dostoevsky. It was first published serially in the journal The Russian Messenger in 1868–69. The title is an ironic reference to the central character of the novel, Prince Lev Nikolayevich Myshkin.",
-        "imageUrl": "/images/books/the-idiot-fyodor-dostoevsky.jpg",
-        "pages": 652,
-        "published": 1869
-    },
-    {
-        "id": "5", 
-        "name": "Eugene Onegin", 
-        "author": "Alexander Pushkin",
-        "price": 15.99, 
-        "categoryId": "poetry",
-        "category": "Poetry",
-        "description": "Eugene Onegin is a novel in verse written by Alexander Pushkin. Onegin is considered a classic of literature, and its eponymous protagonist has served as the model for a number of literary heroes.",
-        "imageUrl": "/images/books/eugene-onegin-alexander-pushkin.jpg",
-        "pages": 224,
-        "published": 1833
-    },
-    {
-        "id": "6", 
-        "name": "Fathers and Sons", 
-        "author": "Ivan Turgenev",
-        "price": 16.99, 
-        "categoryId": "classics",
-        "category": "Classics",
-        "description": "Fathers and Sons, also translated more literally as Fathers and Children, is an 1862 novel by Ivan Turgenev, published in Moscow by Grachev & Co. It is one of the most acclaimed novels of the 19th century.",
-        "imageUrl": "/images/books/fathers-and-sons-ivan-turgenev.jpg",
-        "pages": 226,
-        "published": 1862
-    },
-    {
-        "id": "7", 
-        "name": "The Master and Margarita", 
-        "author": "Mikhail Bulgakov",
-        "price": 21.99, 
-        "categoryId": "modern",
-        "category": "Modern Literature",
-        "description": "The Master and Margarita is a novel by Mikhail Bulgakov, written between 1928 and 1940 during Stalin's regime. A censored version was published in Moscow magazine in 1966–1967, after the writer's death.",
-        "imageUrl": "/images/books/master-and-margarita-mikhail-bulgakov.jpg",
-        "pages": 384,
-        "published": 1967
-    },
-    {
-        "id": "8", 
-        "name": "The Lower Depths", 
-        "author": "Maxim Gorky",
-        "price": 14.99, 
-        "categoryId": "classics",
-        "category": "Classics",
-        "description": "The Lower Depths is a play by Maxim Gorky, written in 1902. It was a sensation at the Moscow Art Theatre, and it established Gorky's reputation as one of the leading writers.",
-        "imageUrl": "/images/books/the-lower-depths-maxim-gorky.jpg",
-        "pages": 115,
-        "published": 1902
-    },
-    {
-        "id": "9", 
-        "name": "What Dreams May Come", 
-        "author": "Richard Matheson",
-        "price": 16.99, 
-        "categoryId": "modern",
-        "category": "Modern",
-        "description": "What Dreams May Come is a 1978 novel by Richard Matheson. The plot centers on Chris, a man who dies and goes to Heaven, but descends into Hell to rescue his wife. It was adapted into the 1998 film of the same name.",
-        "imageUrl": "/images/books/what-dreams-may-come-richard-matheson.jpg",
-        "pages": 288,
-        "published": 1978
-    },
-    {
-        "id": "10", 
-        "name": "Dracula", 
-        "author": "Bram Stoker",
-        "price": 14.99, 
-        "categoryId": "classics",
-        "category": "Classics",
-        "description": "Dracula is an 1897 Gothic horror novel by Irish author Bram Stoker. It introduced the character of Count Dracula and established many conventions of subsequent vampire fantasy.",
-        "imageUrl": "/images/books/bram-stoker-dracula.jpg",
-        "pages": 418,
-        "published": 1897
-    },
-    {
-        "id": "14", 
-        "name": "Pan's Labyrinth", 
-        "author": "Guillermo del Toro",
-        "price": 22.99, 
-        "categoryId": "fiction",
-        "category": "Fiction",
-        "description": "Pan's Labyrinth: The Labyrinth of the Faun is a dark fantasy novel written by Guillermo del Toro and Cornelia Funke, based on the acclaimed 2006 film. It takes place in Spain during the summer of 1944 and tells of a young girl who discovers a magical labyrinth.",
-        "imageUrl": "/images/books/pan-labyrinth.jpg",
-        "pages": 272,
-        "published": 2019
-    },
-    {
-        "id": "11", 
-        "name": "Harry Potter and the Chamber of Secrets", 
-        "author": "J.K. Rowling",
-        "price": 18.99, 
-        "categoryId": "fiction",
-        "category": "Fiction",
-        "description": "Harry Potter and the Chamber of Secrets is the second novel in the Harry Potter series, written by J. K. Rowling. The plot follows Harry's second year at Hogwarts School of Witchcraft and Wizardry, during which a series of messages on the walls of the school's corridors warn that the 'Chamber of Secrets' has been opened.",
-        "imageUrl": "/images/books/harry-potter-chamber-of-secrets.webp",
-        "pages": 352,
-        "published": 1998
-    },
-    {
-        "id": "12", 
-        "name": "Harry Potter and the Prisoner of Bab El Oued", 
-        "author": "J.K. Rowling",
-        "price": 19.99, 
-        "categoryId": "fiction",
-        "category": "Fiction",
-        "description": "Harry Potter and the Prisoner of Azkaban is the third novel in the Harry Potter series, written by J. K. Rowling. The book follows Harry Potter, a young wizard, in his third year at Hogwarts School of Witchcraft and Wizardry.",
-        "imageUrl": "/images/books/prisoner-of-azkaban.webp",
-        "pages": 448,
-        "published": 1999
-    },
-    {
-        "id": "13", 
-        "name": "Mysteries of the Universe", 
-        "author": "Will Gater",
-        "price": 27.99, 
-        "categoryId": "fiction",
-        "category": "Fiction",
-        "description": "Mysteries of the Universe explores the wonders of space, featuring stunning images and detailed explanations about galaxies, stars, planets, and cosmic phenomena.",
-        "imageUrl": "/images/books/mysteries-of-the-Universe-by-will-gater.jpg",
-        "pages": 224,
-        "published": 2020
-    }
-]
-
 # Mock cart data
 mock_cart = []
 
-@app.route('/api/categories', methods=['GET'])
-def get_categories():
-    conn = get_db_connection()
+# Catalog loaders: run the shared catalog queries (catalog.py) and return
+# JSON-ready data. Handlers serve them through catalog_response(), so these
+# only run on a cache miss.
+
+def database_error(e, message="Database error"):
+    """
+    Response for a request that failed in the database layer: 503 with
+    Retry-After when it didn't get a connection in time (overload), else a
+    500 that doesn't leak the error text to clients.
+    """
+    if isinstance(e, (admission.Overloaded, PoolTimeout)):
+        return admission.overloaded_response(e)
+    current_app.logger.error(f"{message}: {e}")
+    return jsonify({"error": "Internal server error"}), 500
+
+def run_catalog_query(query):
+    conn = get_read_connection()
     try:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute('SELECT * FROM categories')
-            categories = cur.fetchall()
-            return jsonify(categories)
-    except Exception as e:
-        app.logger.error(f"Database error: {e}")
-        return jsonify({"error": str(e)}), 500
+            cur.execute(query.sql, query.params)
+            rows = cur.fetchone() if query.one else cur.fetchall()
+            return query.shape(rows)
     finally:
         conn.close()
 
-@app.route('/api/categories/<category_id>', methods=['GET'])
+def load_categories():
+    return run_catalog_query(catalog.categories_query())
+
+def load_category(category_id):
+    return run_catalog_query(catalog.category_query(category_id))
+
+def load_products_by_category(category_id, fields=None, limit=None, after=None):
+    return run_catalog_query(
+        catalog.products_by_category_query(category_id, fields, limit, after))
+
+def load_featured_products():
+    return run_catalog_query(catalog.featured_products_query())
+
+def load_products_by_ids(product_ids):
+    return run_catalog_query(catalog.products_by_ids_query(product_ids))
+
+def load_product(product_id):
+    return run_catalog_query(catalog.product_query(product_id))
+
+def load_search_results(q, limit, after=None):
+    return run_catalog_query(catalog.search_query(q, limit, after))
+
+def load_search_suggestions(q, limit):
+    return run_catalog_query(catalog.suggest_query(q, limit))
+
+def load_browse(filters, sort, limit, after=None):
+    page = run_catalog_query(catalog.browse_query(filters, sort, limit, after))
+    if after is None:
+        # Facets only come with the first page; they don't change while paging
+        page.update(run_catalog_query(catalog.browse_facets_query(filters)))
+    return page
+
+@api.route('/api/categories', methods=['GET'])
+def get_categories():
+    try:
+        return catalog_response(('categories',), load_categories)
+    except Exception as e:
+        return database_error(e)
+
+@api.route('/api/categories/<category_id>', methods=['GET'])
 def get_category(category_id):
-    conn = get_db_connection()
     try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute('SELECT * FROM categories WHERE id = %s', (category_id,))
-            category = cur.fetchone()
-            if category:
-                return jsonify(category)
-            return jsonify({"error": "Category not found"}), 404
+        return catalog_response(('category', category_id),
+                                lambda: load_category(category_id),
+                                not_found="Category not found")
     except Exception as e:
-        app.logger.error(f"Database error: {e}")
-        return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
+        return database_error(e)
 
-@app.route('/api/categories/<category_id>/products', methods=['GET'])
+@api.route('/api/categories/<category_id>/products', methods=['GET'])
 def get_products_by_category(category_id):
-    conn = get_db_connection()
+    """
+    Products in a category. Optional query parameters:
+        limit: page size; enables keyset pagination
+        after: opaque cursor from the previous page's "next"
+        fields: comma separated columns to return (id is always included)
+    """
     try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute('SELECT * FROM products WHERE category_id = %s', (category_id,))
-            products = cur.fetchall()
-            
-            # Convert price from Decimal to float for JSON serialization
-            for product in products:
-                if product['price']:
-                    product['price'] = float(product['price'])
-            
-            # Normalize image URLs
-            products = normalize_product_image_urls(products, as_list=True)
-            
-            return jsonify(products)
+        fields, limit, after = catalog.parse_category_products_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    try:
+        return catalog_response(('category_products', category_id, fields, limit, after),
+                                lambda: load_products_by_category(category_id, fields, limit, after))
     except Exception as e:
-        app.logger.error(f"Database error: {e}")
-        return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
+        return database_error(e)
 
-@app.route('/api/products/featured', methods=['GET'])
+@api.route('/api/products/featured', methods=['GET'])
 def get_featured_products():
-    # Return a subset of products as featured
-    featured_ids = ["1", "3", "7", "11", "8"]
-    conn = get_db_connection()
     try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            placeholders = ', '.join(['%s'] * len(featured_ids))
-            cur.execute(f'SELECT * FROM products WHERE id IN ({placeholders})', featured_ids)
-            featured = cur.fetchall()
-            
-            # Convert price from Decimal to float for JSON serialization
-            for product in featured:
-                if product['price']:
-                    product['price'] = float(product['price'])
-            
-            # Normalize image URLs
-            featured = normalize_product_image_urls(featured, as_list=True)
-            
-            return jsonify(featured)
+        return catalog_response(('featured',), load_featured_products, ttl=FEATURED_REFRESH)
     except Exception as e:
-        app.logger.error(f"Database error: {e}")
-        return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
+        return database_error(e)
+
+@api.route('/api/products', methods=['GET'])
+def get_products_by_ids():
+    """Batch lookup: /api/products?ids=1,3,7 returns those products in that order."""
+    product_ids = catalog.parse_product_ids(request.args.get('ids'))
+    if not product_ids:
+        return jsonify({"error": "ids parameter is required"}), 400
+    
+    try:
+        return catalog_response(('products', product_ids),
+                                lambda: load_products_by_ids(product_ids))
+    except Exception as e:
+        return database_error(e)
+
+@api.route('/api/search', methods=['GET'])
+def search_products():
+    """
+    Ranked full-text search over title, author and description. Query parameters:
+        q: search text (web search syntax: "quoted phrase", -exclude, or)
+        limit: page size (default 20, max 100)
+        after: opaque cursor from the previous page's "next"
+    """
+    try:
+        q, limit, after = catalog.parse_search_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    try:
+        return catalog_response(('search', q, limit, after),
+                                lambda: load_search_results(q, limit, after))
+    except Exception as e:
+        return database_error(e)
+
+@api.route('/api/search/suggest', methods=['GET'])
+def suggest_products():
+    """Search-as-you-type suggestions for ?q= (prefix and typo tolerant)."""
+    try:
+        q, limit, _ = catalog.parse_search_args(request.args, default_limit=8, max_limit=20)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    try:
+        return catalog_response(('suggest', q, limit),
+                                lambda: load_search_suggestions(q, limit))
+    except Exception as e:
+        return database_error(e)
+
+@api.route('/api/products/browse', methods=['GET'])
+def browse_products():
+    """
+    Filtered, sorted product listing with facet counts. Query parameters:
+        category: category ids (repeated or comma separated)
+        author: author names (repeated)
+        price_min, price_max: price range (price_max exclusive)
+        year_min, year_max: publication year range (inclusive)
+        sort: name (default), price_asc, price_desc, newest or oldest
+        limit: page size (default 24, max 100)
+        after: opaque cursor from the previous page's "next"
+    The first page also carries "facets" (counts per category, author,
+    price bucket and decade) and "total".
+    """
+    try:
+        filters, sort, limit, after = catalog.parse_browse_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    try:
+        return catalog_response(('browse', filters, sort, limit, after),
+                                lambda: load_browse(filters, sort, limit, after))
+    except Exception as e:
+        return database_error(e)
 
-@app.route('/api/products/<product_id>', methods=['GET'])
+@api.route('/api/products/<product_id>', methods=['GET'])
 def get_product(product_id):
-    conn = get_db_connection()
     try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute('SELECT * FROM products WHERE id = %s', (product_id,))
-            product = cur.fetchone()
-            if product:
-                # Convert price from Decimal to float for JSON serialization
-                if product['price']:
-                    product['price'] = float(product['price'])
-                
-                # Normalize image URL
-                product = normalize_product_image_urls(product)
-                
-                return jsonify(product)
-            return jsonify({"error": "Product not found"}), 404
+        return catalog_response(('product', product_id),
+                                lambda: load_product(product_id),
+                                not_found="Product not found")
     except Exception as e:
-        app.logger.error(f"Database error: {e}")
-        return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
+        return database_error(e)
 
-@app.route('/api/cart', methods=['GET'])
+@api.route('/api/cart', methods=['GET'])
 def get_cart():
+    cart_id, is_new = get_cart_id()
+    if is_new:
+        # A cart that was just issued has no lines yet
+        return jsonify([])
+    
+    ensure_cart_sweeper()
     conn = get_db_connection()
     try:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            # For simplicity, we're not tracking users, but in a real app
-            # you'd filter by user_id
-            cur.execute('SELECT * FROM cart_items')
+            cur.execute('SELECT * FROM cart_items WHERE user_id = %s ORDER BY id', (cart_id,))
             cart_items = cur.fetchall()
             
-            # Convert price from Decimal to float for JSON serialization
-            for item in cart_items:
-                if item['price']:
-                    item['price'] = float(item['price'])
-            
-            # Normalize image URLs in cart items
-            for item in cart_items:
-                if item.get('image_url'):
-                    item = normalize_product_image_urls(item)
-            
-            return jsonify(cart_items)
+            # Add cover versions to the (already normalized) image URLs
+            return jsonify(catalog.prepare_products(cart_items))
     except Exception as e:
-        app.logger.error(f"Database error: {e}")
-        return jsonify({"error": str(e)}), 500
+        return database_error(e)
     finally:
         conn.close()
 
-@app.route('/api/cart/add', methods=['POST'])
+@api.route('/api/cart/add', methods=['POST'])
 def add_to_cart():
-    data = request.json
+    data = request.get_json(silent=True) or {}
     product_id = data.get('productId')
-    quantity = data.get('quantity', 1)
+    if product_id is None:
+        return jsonify({"error": "productId is required"}), 400
+    try:
+        quantity = parse_quantity(data.get('quantity', 1))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    cart_id, _ = get_cart_id()
     
+    ensure_cart_sweeper()
     conn = get_db_connection()
     try:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            # Get product details
-            cur.execute('SELECT * FROM products WHERE id = %s', (product_id,))
-            product = cur.fetchone()
+            # One statement: copy the product into the cart, or bump the
+            # quantity if it is already there. The unique index on
+            # (user_id, product_id) makes concurrent adds of the same book safe.
+            cur.execute('''
+                INSERT INTO cart_items (product_id, user_id, name, author, price, quantity, image_url)
+                SELECT p.id, %s, p.name, p.author, p.price, %s, p.image_url
+                FROM products p WHERE p.id = %s
+                ON CONFLICT (user_id, product_id)
+                DO UPDATE SET quantity = cart_items.quantity + EXCLUDED.quantity,
+                              updated_at = now()
+                RETURNING *
+            ''', (cart_id, quantity, product_id))
+            item = cur.fetchone()
             
-            if not product:
+            if not item:
+                conn.rollback()
                 return jsonify({"error": "Product not found"}), 404
             
-            # Check if the product is already in the cart
-            cur.execute('SELECT * FROM cart_items WHERE product_id = %s', (product_id,))
-            cart_item = cur.fetchone()
-            
-            if cart_item:
-                # Update quantity
-                cur.execute(
-                    'UPDATE cart_items SET quantity = quantity + %s WHERE product_id = %s',
-                    (quantity, product_id)
-                )
-            else:
-                # Add new item - normalize image URL before storing
-                image_url = product['image_url']
-                # If there is an image_url, normalize it for consistency
-                if image_url:
-                    normalized_product = normalize_product_image_urls({'image_url': image_url})
-                    image_url = normalized_product['image_url']
-                
-                cur.execute(
-                    '''INSERT INTO cart_items 
-                       (product_id, name, author, price, quantity, image_url) 
-                       VALUES (%s, %s, %s, %s, %s, %s)''',
-                    (product_id, product['name'], product['author'], product['price'], 
-                     quantity, image_url)
-                )
-            
             conn.commit()
-            return jsonify({"success": True})
+            return jsonify({"success": True, "item": catalog.prepare_product(item)})
     except Exception as e:
         conn.rollback()
-        app.logger.error(f"Database error: {e}")
-        return jsonify({"error": str(e)}), 500
+        return database_error(e)
     finally:
         conn.close()
 
-@app.route('/api/cart/update', methods=['POST'])
+@api.route('/api/cart/update', methods=['POST'])
 def update_cart():
-    data = request.json
+    """Set a cart line's quantity; 0 removes the line (and returns "item": null)."""
+    data = request.get_json(silent=True) or {}
     item_id = data.get('itemId')
-    quantity = data.get('quantity')
+    try:
+        quantity = parse_quantity(data.get('quantity'), allow_zero=True)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    cart_id, is_new = get_cart_id()
+    if is_new:
+        return jsonify({"error": "Item not found in cart"}), 404
     
     conn = get_db_connection()
     try:
-        with conn.cursor() as cur:
-            # First check if the item exists
-            cur.execute('SELECT * FROM cart_items WHERE product_id = %s', (item_id,))
-            if cur.fetchone() is None:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            if quantity == 0:
+                cur.execute('''
+                    DELETE FROM cart_items WHERE user_id = %s AND product_id = %s
+                    RETURNING id
+                ''', (cart_id, item_id))
+            else:
+                cur.execute('''
+                    UPDATE cart_items SET quantity = %s, updated_at = now()
+                    WHERE user_id = %s AND product_id = %s
+                    RETURNING *
+                ''', (quantity, cart_id, item_id))
+            item = cur.fetchone()
+            if item is None:
+                conn.rollback()
                 return jsonify({"error": "Item not found in cart"}), 404
             
-            # Update the quantity
-            cur.execute('UPDATE cart_items SET quantity = %s WHERE product_id = %s', 
-                       (quantity, item_id))
             conn.commit()
-            return jsonify({"success": True})
+            if quantity == 0:
+                return jsonify({"success": True, "item": None})
+            return jsonify({"success": True, "item": catalog.prepare_product(item)})
     except Exception as e:
         conn.rollback()
-        app.logger.error(f"Database error: {e}")
-        return jsonify({"error": str(e)}), 500
+        return database_error(e)
     finally:
         conn.close()
 
-@app.route('/api/cart/remove/<item_id>', methods=['DELETE'])
+@api.route('/api/cart/remove/<item_id>', methods=['DELETE'])
 def remove_from_cart(item_id):
+    cart_id, is_new = get_cart_id()
+    if is_new:
+        return jsonify({"success": True})
+    
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
-            cur.execute('DELETE FROM cart_items WHERE product_id = %s', (item_id,))
+            cur.execute('DELETE FROM cart_items WHERE user_id = %s AND product_id = %s',
+                        (cart_id, item_id))
             conn.commit()
             return jsonify({"success": True})
     except Exception as e:
         conn.rollback()
-        app.logger.error(f"Database error: {e}")
-        return jsonify({"error": str(e)}), 500
+        return database_error(e)
     finally:
         conn.close()
 
-@app.route('/api/cart/checkout', methods=['POST'])
+@api.route('/api/cart/checkout', methods=['POST'])
 def checkout():
-    conn = get_db_connection()
+    """
+    Place an order for the cart's contents and empty it. Send an
+    Idempotency-Key header to make retries safe: a repeated key returns the
+    order it created instead of ordering again.
+    """
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if idempotency_key is not None and not orders.valid_idempotency_key(idempotency_key):
+        return jsonify({"error": "Idempotency-Key must be 1-100 printable ASCII characters"}), 400
+    cart_id, is_new = get_cart_id()
+    if is_new:
+        return jsonify({"error": "Cart is empty"}), 400
+    
     try:
-        with conn.cursor() as cur:
-            # In a real app, we would process payment, create order, etc.
-            cur.execute('DELETE FROM cart_items')
-            conn.commit()
-            return jsonify({"success": True})
+        order, created = orders.place_order(cart_id, idempotency_key)
+    except orders.CheckoutError as e:
+        response = jsonify({"error": str(e), **e.details})
+        response.status_code = e.status
+        if isinstance(e, orders.CheckoutBusy):
+            response.headers['Retry-After'] = '1'
+        return response
     except Exception as e:
-        conn.rollback()
-        app.logger.error(f"Database error: {e}")
-        return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
+        return database_error(e)
+    
+    response = jsonify({"success": True, "order": order})
+    if created:
+        response.status_code = 201
+    else:
+        response.headers['Idempotent-Replayed'] = 'true'
+    return response
 
 # Function to initialize the database
 def init_db():
-    """Initialize the database tables if they don't exist"""
+    """Create the database if needed and apply pending migrations (see migrate.py)"""
     try:
-        # First, ensure the database exists
-        from create_db import create_database
-        create_database()
-        
-        conn = get_db_connection()
-        try:
-            with conn.cursor() as cur:
-                # Check if tables exist
-                cur.execute("""
-                    SELECT EXISTS (
-                        SELECT FROM information_schema.tables 
-                        WHERE table_name = 'categories'
-                    );
-                """)
-                tables_exist = cur.fetchone()[0]
-                
-                if not tables_exist:
-                    app.logger.info("Tables don't exist. Creating them...")
-                    # Read and execute the SQL from db_setup.sql
-                    with open('db_setup.sql', 'r') as f:
-                        # Split the SQL statements by semicolon
-                        sql_statements = f.read().split(';')
-                        
-                        # Execute each statement
-                        for statement in sql_statements:
-                            if statement.strip():  # Skip empty statements
-                                cur.execute(statement)
-                
-                conn.commit()
-                app.logger.info("Database initialized successfully")
-        except Exception as e:
-            conn.rollback()
-            app.logger.error(f"Error initializing database tables: {e}")
-        finally:
-            conn.close()
+        applied = migrate()
+        if applied:
+            app.logger.info(f"Applied database migrations: {', '.join(f'{v:04d}' for v in applied)}")
     except Exception as e:
-        app.logger.error(f"Error ensuring database exists: {e}")
+        app.logger.error(f"Error initializing database: {e}")
 
 # New endpoint for debugging image access
-@app.route('/api/debug/images', methods=['GET'])
+@api.route('/api/debug/images', methods=['GET'])
 def debug_images():
     """
     Debug endpoint to help troubleshoot image loading issues.
     Returns information about image paths and availability.
     """
-    import os
-    from flask import send_file
-    
     # Base directory for images
-    img_dir = os.path.join(os.path.dirname(__file__), '..', 'ui', 'public', 'images', 'books')
+    img_dir = image_store.directory
     
     # Get all book images
-    image_files = []
-    if os.path.exists(img_dir):
-        image_files = os.listdir(img_dir)
+    image_files = image_store.filenames()
     
     # Get all products and their image paths
-    conn = get_db_connection()
+    conn = get_read_connection()
     try:
         products_with_images = []
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
@@ -525,7 +434,7 @@ def debug_images():
             for product in products:
                 # Extract just the filename from the path
                 if product['image_url']:
-                    filename = os.path.basename(product['image_url'])
+                    filename = os.path.basename(product['image_url'].split('?', 1)[0])
                     exists = filename in image_files
                 else:
                     filename = None
@@ -543,43 +452,113 @@ def debug_images():
             'image_dir': img_dir,
             'total_images': len(image_files),
             'image_files': image_files,
-            'products': products_with_images
+            'products': products_with_images,
+            'serving': image_store.stats()
         })
     except Exception as e:
-        app.logger.error(f"Error in debug endpoint: {e}")
-        return jsonify({"error": str(e)}), 500
+        return database_error(e, "Error in debug endpoint")
     finally:
         conn.close()
 
-# Image serving endpoint
-@app.route('/api/images/books/<image_filename>', methods=['GET'])
-def serve_book_image(image_filename):
+@api.route('/api/debug/pool', methods=['GET'])
+def debug_pool():
+    """Connection pool statistics (in-use, idle, wait time) for monitoring."""
+    return jsonify(pool_stats())
+
+@api.route('/api/debug/replicas', methods=['GET'])
+def debug_replicas():
+    """Read replica health, replication lag and pools, and reads that fell back to the primary."""
+    return jsonify(replica_stats())
+
+@api.route('/api/debug/admission', methods=['GET'])
+def debug_admission():
+    """Database slots in use, admission queue depth, shed and rate limited requests."""
+    return jsonify(admission.stats())
+
+@api.route('/api/debug/cache', methods=['GET'])
+def debug_cache():
+    """Catalog cache statistics (hits, misses, evictions, invalidations) and coalesced misses."""
+    return jsonify({**cache_stats(), 'singleflight': flight_stats()})
+
+@api.route('/api/health/live', methods=['GET'])
+def liveness():
+    """The process is up and serving requests."""
+    return jsonify({"status": "ok"})
+
+@api.route('/api/health/ready', methods=['GET'])
+def readiness():
     """
-    Serve book images directly from the API.
-    This can be helpful when the frontend might not have direct access to image files,
-    or for tracking image access.
+    Whether this worker can take traffic: a pooled connection answers within
+    a second and the schema is at the newest migration. Unlike init_db() it
+    changes nothing, so load balancers can poll it.
     """
-    import os
-    from flask import send_from_directory, abort
-    
-    # Base directory for images - using a consistent location
-    img_dir = os.path.join(os.path.dirname(__file__), '..', 'ui', 'public', 'images', 'books')
-    
-    app.logger.info(f"Request for image: {image_filename}")
-    
     try:
-        if os.path.exists(os.path.join(img_dir, image_filename)):
-            return send_from_directory(img_dir, image_filename)
-        else:
-            app.logger.error(f"Image not found: {image_filename}")
-            abort(404)
-    except Exception as e:
-        app.logger.error(f"Error serving image {image_filename}: {e}")
-        abort(500)
+        conn = get_pool().getconn(timeout=1.0)
+    except (PoolTimeout, psycopg2.Error) as e:
+        return jsonify({"status": "unavailable", "reason": f"database: {e}"}), 503
+    try:
+        version = current_version(conn)
+    except psycopg2.Error as e:
+        return jsonify({"status": "unavailable", "reason": f"database: {e}"}), 503
+    finally:
+        conn.close()
+    if version != latest_version():
+        return jsonify({"status": "unavailable", "reason": "schema not migrated",
+                        "schema_version": version, "latest_version": latest_version()}), 503
+    return jsonify({"status": "ready", "schema_version": version})
+
+def protected_debug(view):
+    """
+    Require the DEBUG_TOKEN (X-Debug-Token header) for a debug endpoint. If
+    no token is configured the endpoint only exists in DEBUG mode.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not DEBUG_TOKEN:
+            if not DEBUG:
+                return jsonify({"error": "Not found"}), 404
+        elif not hmac.compare_digest(request.headers.get('X-Debug-Token', ''), DEBUG_TOKEN):
+            return jsonify({"error": "Forbidden"}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+@api.route('/api/debug/queries', methods=['GET'])
+@protected_debug
+def debug_queries():
+    """
+    Per-statement stats (calls, total/max time, rows), recent slow queries
+    and their captured plans. ?sort=total|mean|max|calls, ?limit=N
+    """
+    try:
+        limit = parse_limit(request.args.get('limit'), default=50, maximum=500)
+        return jsonify(query_log.report(request.args.get('sort', 'total'), limit))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+@api.route('/api/debug/queries/reset', methods=['POST'])
+@protected_debug
+def reset_debug_queries():
+    query_log.reset()
+    return jsonify({"success": True})
+
+@api.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus scrape endpoint (metrics of this worker process)."""
+    if not METRICS['enabled']:
+        return jsonify({"error": "Not found"}), 404
+    return current_app.response_class(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@api.route('/api/images/books/<image_filename>', methods=['GET'])
+def serve_book_image(image_filename):
+    """
+    Serve book images directly from the API, with ETag/Last-Modified
+    validators and immutable caching for content-hashed (?v=) URLs.
+    """
+    return image_store.serve(image_filename)
 
 # Catch-all route to handle frontend routing
-@app.route('/', defaults={'path': ''})
-@app.route('/<path:path>')
+@api.route('/', defaults={'path': ''})
+@api.route('/<path:path>')
 def catch_all(path):
     # If the requested path doesn't match any API routes,
     # it's likely a frontend route. Since this is a SPA,
@@ -592,37 +571,48 @@ def catch_all(path):
         }), 404
     return jsonify({"error": "Not found"}), 404
 
-def normalize_product_image_urls(product_data, as_list=False):
+def create_app():
     """
-    Utility function to normalize image URLs in product data.
-    This ensures image URLs from the database are properly formatted for frontend use.
-    
-    Args:
-        product_data: A single product dict or a list of products
-        as_list: Whether the input is a list of products
-        
-    Returns:
-        The product data with normalized image URLs
+    Build the Flask app. Safe to call before forking workers (gunicorn
+    preload): it opens no database connections and starts no threads, those
+    happen per worker in init_worker() or lazily on first use.
     """
-    base_url = '/api/images'  # Use the new API endpoint
-    
-    def normalize_single_product(product):
-        if product and 'image_url' in product and product['image_url']:
-            # If the URL doesn't already start with our base URL or http
-            if not (product['image_url'].startswith(base_url) or 
-                    product['image_url'].startswith('http')):
-                # Extract the filename from the path
-                filename = os.path.basename(product['image_url'])
-                # Build the new URL using our API endpoint
-                product['image_url'] = f"{base_url}/books/{filename}"
-        return product
-    
-    if as_list:
-        return [normalize_single_product(p) for p in product_data]
-    else:
-        return normalize_single_product(product_data)
+    app = Flask(__name__)
+    init_json(app)
+    CORS(app)
+    metrics.init_app(app)
+    admission.init_app(app)
+    # Requests that borrow outside a try block still get a 503, not a 500
+    app.register_error_handler(PoolTimeout, admission.overloaded_response)
+    compression.init_app(app)
+    app.register_blueprint(api)
+    # Build the cover image manifest once at startup (inherited by forked workers)
+    image_store.refresh()
+    return app
+
+def init_worker():
+    """Per-process startup after fork: open the pool and start background threads."""
+    open_pool()
+    ensure_replica_monitor()
+    ensure_invalidation_listener()
+    ensure_cart_sweeper()
+
+def shutdown_worker():
+    """Close this process's pooled connections once it has drained its requests."""
+    close_pool()
+    close_replica_pools()
+
+app = create_app()
 
 if __name__ == '__main__':
     # Initialize the database before starting the app
     init_db()
-    app.run(host='0.0.0.0', port=PORT, debug=DEBUG)
\ No newline at end of file
+    if SERVER_MODE == 'asgi':
+        import uvicorn
+        # asgi.py imports this module as `main`; let it find this one rather
+        # than load a second copy (duplicate routes, stats and metrics)
+        sys.modules.setdefault('main', sys.modules[__name__])
+        from asgi import app as asgi_app
+        uvicorn.run(asgi_app, host='0.0.0.0', port=PORT)
+    else:
+        app.run(host='0.0.0.0', port=PORT, debug=DEBUG)
@@ -0,0 +1,290 @@
+"""
+Request, database and cache metrics in Prometheus text format.
+
+Every Flask request is timed (init_app) and recorded in a latency histogram
+labelled by route pattern, method and status. Every cursor execute() on a
+pooled connection (see db.InstrumentedConnection) and every pool borrow
+reports here too. Their time is added to the current request, which gives
+the per-request query count and DB time histograms and a Server-Timing
+response header:
+
+    Server-Timing: db;dur=3.1;desc="4 queries", pool;dur=0.0, cache;desc="hit", app;dur=1.2, total;dur=4.3
+
+Subsystems that already keep counters (pool, catalog cache, images) are
+exported by register_stats() collectors that read their stats() dicts at
+scrape time. Metrics are per process; with several worker processes each
+worker reports its own.
+"""
+import threading
+import time
+from contextvars import ContextVar
+
+from flask import g, request
+
+from config import METRICS
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter, optionally labelled."""
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *labelvalues):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [(self.name, _format_labels(self.labelnames, values), value)
+                for values, value in items]
+
+
+class Histogram:
+    """Cumulative-bucket histogram, optionally labelled."""
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=REQUEST_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            series = self._values.get(labelvalues)
+            if series is None:
+                # Per-bucket (non-cumulative) counts, then sum and count
+                series = self._values[labelvalues] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        with self._lock:
+            items = [(values, (list(s[0]), s[1], s[2])) for values, s in self._values.items()]
+        samples = []
+        for values, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, values, [('le', _format_value(float(bound)))])
+                samples.append((f'{self.name}_bucket', labels, cumulative))
+            labels = _format_labels(self.labelnames, values, [('le', '+Inf')])
+            samples.append((f'{self.name}_bucket', labels, count))
+            labels = _format_labels(self.labelnames, values)
+            samples.append((f'{self.name}_sum', labels, total))
+            samples.append((f'{self.name}_count', labels, count))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        # key -> collector; registering a key again replaces its collector
+        self._collectors = {}
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector, key=None):
+        """
+        collector() returns [(name, type, help, [(labels dict, value)])]. A
+        collector registered under an existing key replaces it, so a module
+        imported twice (e.g. main.py run as __main__) doesn't export its
+        families twice.
+        """
+        self._collectors[collector if key is None else key] = collector
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {_format_value(value)}')
+        for collector in list(self._collectors.values()):
+            for name, metric_type, help, samples in collector():
+                lines.append(f'# HELP {name} {help}')
+                lines.append(f'# TYPE {name} {metric_type}')
+                for labels, value in samples:
+                    label_text = _format_labels(labels.keys(), labels.values())
+                    lines.append(f'{name}{label_text} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+REQUEST_SECONDS = registry.register(Histogram(
+    'http_request_duration_seconds', 'Request latency by route, method and status.',
+    ('route', 'method', 'status')))
+REQUEST_DB_SECONDS = registry.register(Histogram(
+    'http_request_db_seconds', 'Time spent in database queries per request.',
+    ('route',), QUERY_BUCKETS))
+REQUEST_DB_QUERIES = registry.register(Histogram(
+    'http_request_db_queries', 'Database queries executed per request.',
+    ('route',), COUNT_BUCKETS))
+QUERY_SECONDS = registry.register(Histogram(
+    'db_query_duration_seconds', 'Duration of individual database queries.',
+    buckets=QUERY_BUCKETS))
+POOL_WAIT_SECONDS = registry.register(Histogram(
+    'db_pool_wait_seconds', 'Time spent borrowing a connection from the pool.',
+    buckets=QUERY_BUCKETS))
+CACHE_LOOKUPS = registry.register(Counter(
+    'catalog_cache_requests_total', 'Catalog responses served, by cache result.',
+    ('route', 'result')))
+
+
+def register_stats(prefix, stats_fn, counters=(), gauges=()):
+    """
+    Export numeric fields of a stats() dict: `counters` as <prefix>_<field>_total,
+    `gauges` as <prefix>_<field>. Read at scrape time, so nothing is counted twice.
+    Registering a prefix again replaces its earlier collector.
+    """
+    def collect():
+        stats = stats_fn() or {}
+        families = []
+        for field in counters:
+            if field in stats:
+                families.append((f'{prefix}_{field}_total', 'counter',
+                                 f"{prefix.replace('_', ' ')} {field.replace('_', ' ')}", [({}, stats[field])]))
+        for field in gauges:
+            if field in stats:
+                families.append((f'{prefix}_{field}', 'gauge',
+                                 f"{prefix.replace('_', ' ')} {field.replace('_', ' ')}", [({}, stats[field])]))
+        return families
+
+    registry.register_collector(collect, key=prefix)
+
+
+# Per-request accounting ---------------------------------------------------
+
+class RequestTimings:
+    __slots__ = ('started', 'db_time', 'db_queries', 'pool_wait', 'cache')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.db_time = 0.0
+        self.db_queries = 0
+        self.pool_wait = 0.0
+        self.cache = None
+
+
+# A ContextVar rather than a thread-local so async (ASGI) handlers get their own
+_current = ContextVar('request_timings', default=None)
+
+
+def start_request():
+    """Begin accounting for a request; returns a token for finish_request()."""
+    return _current.set(RequestTimings())
+
+
+def observe_query(seconds):
+    QUERY_SECONDS.observe(seconds)
+    timings = _current.get()
+    if timings is not None:
+        timings.db_time += seconds
+        timings.db_queries += 1
+
+
+def observe_pool_wait(seconds):
+    POOL_WAIT_SECONDS.observe(seconds)
+    timings = _current.get()
+    if timings is not None:
+        timings.pool_wait += seconds
+
+
+def mark_cache(result):
+    """Record whether the current request was served from the catalog cache ('hit'/'miss')."""
+    timings = _current.get()
+    if timings is not None:
+        timings.cache = result
+
+
+def finish_request(token, route, method, status):
+    """Record the request's metrics; returns its Server-Timing header value."""
+    timings = _current.get()
+    try:
+        _current.reset(token)
+    except ValueError:
+        # Token from another context; the request's own value is still reported
+        pass
+    if timings is None:
+        return None
+    total = time.perf_counter() - timings.started
+    REQUEST_SECONDS.observe(total, route, method, str(status))
+    REQUEST_DB_SECONDS.observe(timings.db_time, route)
+    REQUEST_DB_QUERIES.observe(timings.db_queries, route)
+    if timings.cache is not None:
+        CACHE_LOOKUPS.inc(1, route, timings.cache)
+
+    parts = [f'db;dur={timings.db_time * 1000:.1f};desc="{timings.db_queries} queries"',
+             f'pool;dur={timings.pool_wait * 1000:.1f}']
+    if timings.cache is not None:
+        parts.append(f'cache;desc="{timings.cache}"')
+    app_time = max(0.0, total - timings.db_time - timings.pool_wait)
+    parts.append(f'app;dur={app_time * 1000:.1f}')
+    parts.append(f'total;dur={total * 1000:.1f}')
+    return ', '.join(parts)
+
+
+def init_app(app):
+    """Time every request of a Flask app."""
+    if not METRICS['enabled']:
+        return
+
+    @app.before_request
+    def start_metrics():
+        g._metrics_token = start_request()
+
+    @app.after_request
+    def record_metrics(response):
+        token = g.pop('_metrics_token', None)
+        if token is None:
+            return response
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        server_timing = finish_request(token, route, request.method, response.status_code)
+        if server_timing and METRICS['server_timing']:
+            response.headers['Server-Timing'] = server_timing
+        return response
+
+
+def render():
+    return registry.render()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+Versioned schema migrations.
+
+Migrations live in migrations/ as NNNN_name.sql or NNNN_name.py (a module
+defining upgrade(cur)) and are applied in version order, each in its own
+transaction, and recorded in the schema_version table. A database that is
+already current costs one connection and one query:
+
+    SELECT max(version) FROM schema_version
+
+Only when that is behind the newest file (or the table or database is
+missing) does the runner take an advisory lock, so concurrent workers don't
+race, and apply what is pending. Databases created before migrations existed
+(tables present, no schema_version) are recorded as being at 0001.
+
+    python migrate.py           # create the database if needed and migrate
+    python migrate.py --status  # list migrations and whether they're applied
+"""
+import argparse
+import functools
+import hashlib
+import importlib.util
+import os
+import re
+import sys
+import time
+
+import psycopg2
+from psycopg2 import errors
+
+from db import connect
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATION_RE = re.compile(r'^(\d{4})_(\w+)\.(sql|py)$')
+# pg_advisory_lock key shared by every process running migrations ('migr')
+LOCK_KEY = 0x6d696772
+
+
+class Migration:
+    def __init__(self, version, name, path):
+        self.version = version
+        self.name = name
+        self.path = path
+
+    def checksum(self):
+        with open(self.path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    def apply(self, cur):
+        if self.path.endswith('.sql'):
+            with open(self.path, encoding='utf-8') as f:
+                # One execute: without parameters psycopg2 sends the file as a
+                # single simple query, so function bodies with ; are fine
+                cur.execute(f.read())
+        else:
+            spec = importlib.util.spec_from_file_location(f'migration_{self.version:04d}', self.path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            module.upgrade(cur)
+
+
+def discover(directory=MIGRATIONS_DIR):
+    """Migrations in version order; raises ValueError on duplicate versions."""
+    migrations = {}
+    for filename in sorted(os.listdir(directory)):
+        match = MIGRATION_RE.match(filename)
+        if not match:
+            continue
+        version = int(match.group(1))
+        if version in migrations:
+            raise ValueError(f"Duplicate migration version {version:04d}: "
+                             f"{os.path.basename(migrations[version].path)}, {filename}")
+        migrations[version] = Migration(version, match.group(2), os.path.join(directory, filename))
+    return [migrations[v] for v in sorted(migrations)]
+
+
+@functools.lru_cache(maxsize=None)
+def latest_version():
+    """Version of the newest migration file (read once per process)."""
+    migrations = discover()
+    return migrations[-1].version if migrations else 0
+
+
+def current_version(conn):
+    """Applied schema version, or None when schema_version doesn't exist yet."""
+    with conn.cursor() as cur:
+        try:
+            cur.execute('SELECT max(version) FROM schema_version')
+        except errors.UndefinedTable:
+            conn.rollback()
+            return None
+        version = cur.fetchone()[0]
+    conn.rollback()
+    return version or 0
+
+
+def _connect():
+    try:
+        return connect()
+    except psycopg2.OperationalError as e:
+        # Only a missing database is ours to fix
+        if 'does not exist' not in str(e):
+            raise
+    from create_db import create_database
+    create_database()
+    return connect()
+
+
+def _apply_pending(conn, migrations):
+    applied = []
+    with conn.cursor() as cur:
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name VARCHAR(255) NOT NULL,
+                checksum VARCHAR(64) NOT NULL,
+                applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+                duration_ms INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        cur.execute('SELECT version FROM schema_version')
+        done = {row[0] for row in cur.fetchall()}
+        if not done and migrations and migrations[0].version == 1:
+            cur.execute("SELECT to_regclass('public.categories') IS NOT NULL")
+            if cur.fetchone()[0]:
+                # Created by db_setup.sql before migrations existed
+                print("Existing schema found; recording it as migration 0001")
+                cur.execute('INSERT INTO schema_version (version, name, checksum) VALUES (%s, %s, %s)',
+                            (1, migrations[0].name, migrations[0].checksum()))
+                done.add(1)
+    conn.commit()
+
+    for migration in migrations:
+        if migration.version in done:
+            continue
+        print(f"Applying migration {migration.version:04d}_{migration.name}...")
+        started = time.monotonic()
+        try:
+            with conn.cursor() as cur:
+                migration.apply(cur)
+                cur.execute('''
+                    INSERT INTO schema_version (version, name, checksum, duration_ms)
+                    VALUES (%s, %s, %s, %s)
+                ''', (migration.version, migration.name, migration.checksum(),
+                      int((time.monotonic() - started) * 1000)))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append(migration.version)
+    return applied
+
+
+def migrate(migrations=None):
+    """
+    Bring the database up to the newest migration.
+
+    Returns the versions applied by this call (empty when already current).
+    """
+    if migrations is None:
+        migrations = discover()
+    latest = migrations[-1].version if migrations else 0
+    conn = _connect()
+    try:
+        if current_version(conn) == latest:
+            return []
+        with conn.cursor() as cur:
+            cur.execute('SELECT pg_advisory_lock(%s)', (LOCK_KEY,))
+        conn.commit()
+        try:
+            # Another process may have migrated while we waited for the lock
+            return _apply_pending(conn, migrations)
+        finally:
+            with conn.cursor() as cur:
+                cur.execute('SELECT pg_advisory_unlock(%s)', (LOCK_KEY,))
+            conn.commit()
+    finally:
+        conn.close()
+
+
+def status():
+    migrations = discover()
+    conn = _connect()
+    try:
+        if current_version(conn) is None:
+            applied = {}
+        else:
+            with conn.cursor() as cur:
+                cur.execute('SELECT version, checksum, applied_at FROM schema_version')
+                applied = {row[0]: row[1:] for row in cur.fetchall()}
+    finally:
+        conn.close()
+    for migration in migrations:
+        if migration.version not in applied:
+            state = 'pending'
+        else:
+            checksum, applied_at = applied[migration.version]
+            state = f"applied {applied_at:%Y-%m-%d %H:%M:%S}"
+            if checksum != migration.checksum():
+                state += " (file changed since)"
+        print(f"{migration.version:04d}_{migration.name}: {state}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply pending database migrations.")
+    parser.add_argument('--status', action='store_true', help="list migrations and exit")
+    args = parser.parse_args()
+    if args.status:
+        status()
+        return
+    started = time.monotonic()
+    try:
+        applied = migrate()
+    except Exception as e:
+        print(f"Error migrating database: {e}")
+        sys.exit(1)
+    elapsed = (time.monotonic() - started) * 1000
+    if applied:
+        print(f"Applied {len(applied)} migration(s) in {elapsed:.0f} ms")
+    else:
+        print(f"Database schema is up to date ({elapsed:.0f} ms)")
+
+
+if __name__ == '__main__':
+    main()
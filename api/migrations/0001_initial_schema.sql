@@ -1,5 +1,9 @@
--- db_setup.sql
--- Database schema for the bookstore application
+-- migrations/0001_initial_schema.sql
+-- Database schema for the bookstore application (fresh databases; databases
+-- created before migrations existed are baselined at this version)
+
+-- Trigram matching for fuzzy search suggestions
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
 
 -- Categories table
 CREATE TABLE categories (
@@ -19,21 +23,52 @@ CREATE TABLE products (
     description TEXT,
     image_url VARCHAR(255),
     pages INTEGER,
-    published INTEGER
+    published INTEGER,
+    -- Weighted full-text document for /api/search: name (A), author (B),
+    -- description (C). Kept up to date by Postgres itself.
+    search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(name, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(author, '')), 'B') ||
+        setweight(to_tsvector('english', coalesce(description, '')), 'C')
+    ) STORED
 );
 
 -- Cart table (optional, could be managed in memory or with sessions)
 CREATE TABLE cart_items (
     id SERIAL PRIMARY KEY,
     product_id VARCHAR(50) REFERENCES products(id),
-    user_id VARCHAR(100), -- Could be a session ID or user ID
+    user_id VARCHAR(100), -- Cart id (session cookie / X-Cart-Id header)
     name VARCHAR(255) NOT NULL,
     author VARCHAR(100) NOT NULL,
     price DECIMAL(10, 2) NOT NULL,
     quantity INTEGER NOT NULL,
-    image_url VARCHAR(255)
+    image_url VARCHAR(255),
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now() -- Last activity, for expiring abandoned carts
+);
+
+-- Featured products shown on the home page, in position order.
+-- starts_at/ends_at (optional) schedule a feature; product_id has no foreign
+-- key so a feature can be set up before update_products.py adds the book.
+CREATE TABLE featured_products (
+    product_id VARCHAR(50) PRIMARY KEY,
+    position INTEGER NOT NULL,
+    starts_at TIMESTAMPTZ,
+    ends_at TIMESTAMPTZ
 );
 
+-- Indexes
+-- Category listings filter on category_id and keyset-paginate on id
+CREATE INDEX idx_products_category_id ON products (category_id, id);
+-- Full-text search and fuzzy (trigram) typeahead on name and author
+CREATE INDEX idx_products_search ON products USING GIN (search_vector);
+CREATE INDEX idx_products_name_trgm ON products USING GIN (name gin_trgm_ops);
+CREATE INDEX idx_products_author_trgm ON products USING GIN (author gin_trgm_ops);
+-- One line per product per cart, so adds can upsert with ON CONFLICT; also
+-- serves every per-cart lookup
+CREATE UNIQUE INDEX cart_items_user_product_key ON cart_items (user_id, product_id);
+-- Finds abandoned cart lines for the expiry sweep
+CREATE INDEX idx_cart_items_updated_at ON cart_items (updated_at);
+
 -- Insert initial category data
 INSERT INTO categories (id, name, description) VALUES
     ('classics', 'Classics', 'Timeless masterpieces from renowned authors.'),
@@ -46,16 +81,24 @@ INSERT INTO categories (id, name, description) VALUES
 -- Insert sample books
 -- Classics
 INSERT INTO products (id, name, author, price, category_id, category, description, image_url, pages, published) VALUES
-    ('1', 'War and Peace', 'Leo Tolstoy', 24.99, 'classics', 'Classics', 'War and Peace is a novel by Leo Tolstoy, published in 1869. It is regarded as one of Tolstoy''s finest literary achievements and remains an internationally praised classic of world literature.', '/images/books/war-and-peace-leo-tolstoy.jpg', 1225, 1869),
-    ('2', 'Anna Karenina', 'Leo Tolstoy', 19.99, 'classics', 'Classics', 'Anna Karenina is a novel by Leo Tolstoy, first published in book form in 1878. Widely considered a pinnacle in realist fiction, Tolstoy himself called it his first true novel.', '/images/books/anna-karenina-leo-tolstoy.jpg', 864, 1878),
-    ('3', 'Crime and Punishment', 'Fyodor Dostoevsky', 18.99, 'classics', 'Classics', 'Crime and Punishment focuses on the mental anguish and moral dilemmas of Rodion Raskolnikov, an impoverished ex-student in Saint Petersburg who formulates a plan to kill an unscrupulous pawnbroker for her money.', '/images/books/crime-and-punishment-fyodor-dostoevsky.jpg', 671, 1866);
+    ('1', 'War and Peace', 'Leo Tolstoy', 24.99, 'classics', 'Classics', 'War and Peace is a novel by Leo Tolstoy, published in 1869. It is regarded as one of Tolstoy''s finest literary achievements and remains an internationally praised classic of world literature.', '/api/images/books/war-and-peace-leo-tolstoy.jpg', 1225, 1869),
+    ('2', 'Anna Karenina', 'Leo Tolstoy', 19.99, 'classics', 'Classics', 'Anna Karenina is a novel by Leo Tolstoy, first published in book form in 1878. Widely considered a pinnacle in realist fiction, Tolstoy himself called it his first true novel.', '/api/images/books/anna-karenina-leo-tolstoy.jpg', 864, 1878),
+    ('3', 'Crime and Punishment', 'Fyodor Dostoevsky', 18.99, 'classics', 'Classics', 'Crime and Punishment focuses on the mental anguish and moral dilemmas of Rodion Raskolnikov, an impoverished ex-student in Saint Petersburg who formulates a plan to kill an unscrupulous pawnbroker for her money.', '/api/images/books/crime-and-punishment-fyodor-dostoevsky.jpg', 671, 1866);
 
 -- Add more sample books from your mock data
 INSERT INTO products (id, name, author, price, category_id, category, description, image_url, pages, published) VALUES
-    ('4', 'The Idiot', 'Fyodor Dostoevsky', 17.99, 'classics', 'Classics', 'The Idiot is a novel by Fyodor Dostoevsky. It was first published serially in the journal The Russian Messenger in 1868–69. The title is an ironic reference to the central character of the novel, Prince Lev Nikolayevich Myshkin.', '/images/books/the-idiot-fyodor-dostoevsky.jpg', 652, 1869),
-    ('5', 'Eugene Onegin', 'Alexander Pushkin', 15.99, 'poetry', 'Poetry', 'Eugene Onegin is a novel in verse written by Alexander Pushkin. Onegin is considered a classic of literature, and its eponymous protagonist has served as the model for a number of literary heroes.', '/images/books/eugene-onegin-alexander-pushkin.jpg', 224, 1833),
-    ('6', 'Fathers and Sons', 'Ivan Turgenev', 16.99, 'classics', 'Classics', 'Fathers and Sons, also translated more literally as Fathers and Children, is an 1862 novel by Ivan Turgenev, published in Moscow by Grachev & Co. It is one of the most acclaimed novels of the 19th century.', '/images/books/fathers-and-sons-ivan-turgenev.jpg', 226, 1862),
-    ('7', 'The Master and Margarita', 'Mikhail Bulgakov', 21.99, 'modern', 'Modern Literature', 'The Master and Margarita is a novel by Mikhail Bulgakov, written between 1928 and 1940 during Stalin''s regime. A censored version was published in Moscow magazine in 1966–1967, after the writer''s death.', '/images/books/master-and-margarita-mikhail-bulgakov.jpg', 384, 1967),
-    ('8', 'The Lower Depths', 'Maxim Gorky', 14.99, 'classics', 'Classics', 'The Lower Depths is a play by Maxim Gorky, written in 1902. It was a sensation at the Moscow Art Theatre, and it established Gorky''s reputation as one of the leading writers.', '/images/books/the-lower-depths-maxim-gorky.jpg', 115, 1902),
-    ('9', 'What Dreams May Come', 'Richard Matheson', 16.99, 'modern', 'Modern', 'What Dreams May Come is a 1978 novel by Richard Matheson. The plot centers on Chris, a man who dies and goes to Heaven, but descends into Hell to rescue his wife. It was adapted into the 1998 film of the same name.', '/images/books/what-dreams-may-come-richard-matheson.jpg', 288, 1978),
-    ('10', 'Dracula', 'Bram Stoker', 14.99, 'classics', 'Classics', 'Dracula is an 1897 Gothic horror novel by Irish author Bram Stoker. It introduced the character of Count Dracula and established many conventions of subsequent vampire fantasy.', '/images/books/bram-stoker-dracula.jpg', 418, 1897);
+    ('4', 'The Idiot', 'Fyodor Dostoevsky', 17.99, 'classics', 'Classics', 'The Idiot is a novel by Fyodor Dostoevsky. It was first published serially in the journal The Russian Messenger in 1868–69. The title is an ironic reference to the central character of the novel, Prince Lev Nikolayevich Myshkin.', '/api/images/books/the-idiot-fyodor-dostoevsky.jpg', 652, 1869),
+    ('5', 'Eugene Onegin', 'Alexander Pushkin', 15.99, 'poetry', 'Poetry', 'Eugene Onegin is a novel in verse written by Alexander Pushkin. Onegin is considered a classic of literature, and its eponymous protagonist has served as the model for a number of literary heroes.', '/api/images/books/eugene-onegin-alexander-pushkin.jpg', 224, 1833),
+    ('6', 'Fathers and Sons', 'Ivan Turgenev', 16.99, 'classics', 'Classics', 'Fathers and Sons, also translated more literally as Fathers and Children, is an 1862 novel by Ivan Turgenev, published in Moscow by Grachev & Co. It is one of the most acclaimed novels of the 19th century.', '/api/images/books/fathers-and-sons-ivan-turgenev.jpg', 226, 1862),
+    ('7', 'The Master and Margarita', 'Mikhail Bulgakov', 21.99, 'modern', 'Modern Literature', 'The Master and Margarita is a novel by Mikhail Bulgakov, written between 1928 and 1940 during Stalin''s regime. A censored version was published in Moscow magazine in 1966–1967, after the writer''s death.', '/api/images/books/master-and-margarita-mikhail-bulgakov.jpg', 384, 1967),
+    ('8', 'The Lower Depths', 'Maxim Gorky', 14.99, 'classics', 'Classics', 'The Lower Depths is a play by Maxim Gorky, written in 1902. It was a sensation at the Moscow Art Theatre, and it established Gorky''s reputation as one of the leading writers.', '/api/images/books/the-lower-depths-maxim-gorky.jpg', 115, 1902),
+    ('9', 'What Dreams May Come', 'Richard Matheson', 16.99, 'modern', 'Modern', 'What Dreams May Come is a 1978 novel by Richard Matheson. The plot centers on Chris, a man who dies and goes to Heaven, but descends into Hell to rescue his wife. It was adapted into the 1998 film of the same name.', '/api/images/books/what-dreams-may-come-richard-matheson.jpg', 288, 1978),
+    ('10', 'Dracula', 'Bram Stoker', 14.99, 'classics', 'Classics', 'Dracula is an 1897 Gothic horror novel by Irish author Bram Stoker. It introduced the character of Count Dracula and established many conventions of subsequent vampire fantasy.', '/api/images/books/bram-stoker-dracula.jpg', 418, 1897);
+
+-- Home page featured books
+INSERT INTO featured_products (product_id, position) VALUES
+    ('1', 1),
+    ('3', 2),
+    ('7', 3),
+    ('11', 4),
+    ('8', 5);
@@ -0,0 +1,9 @@
+"""
+Bring databases created by older versions of db_setup.sql up to date and
+install the catalog triggers (see check_db_schema.upgrade_legacy_schema).
+"""
+from check_db_schema import upgrade_legacy_schema
+
+
+def upgrade(cur):
+    upgrade_legacy_schema(cur)
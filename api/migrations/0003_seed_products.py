@@ -0,0 +1,22 @@
+"""
+Insert the seed catalog (seed_products.jsonl); existing products are left
+as they are.
+"""
+import json
+import os
+
+from psycopg2.extras import execute_values
+
+from import_products import COLUMNS, clean_row
+
+SEED_FEED = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                         'seed_products.jsonl')
+
+
+def upgrade(cur):
+    with open(SEED_FEED, encoding='utf-8') as f:
+        rows = [clean_row(json.loads(line)) for line in f if line.strip()]
+    execute_values(cur, f'''
+        INSERT INTO products ({', '.join(COLUMNS)}) VALUES %s
+        ON CONFLICT (id) DO NOTHING
+    ''', [tuple(row[c] for c in COLUMNS) for row in rows])
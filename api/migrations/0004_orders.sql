@@ -0,0 +1,43 @@
+-- migrations/0004_orders.sql
+-- Orders placed at checkout, and per-product stock
+
+-- Stock lives apart from products: checkouts update it constantly, and
+-- writes to products invalidate every worker's catalog cache (and rewrite
+-- the row's search_vector and GIN entries). Products without a row here
+-- are not stock-tracked. The low fillfactor leaves room on each page for
+-- HOT updates of hot titles.
+CREATE TABLE inventory (
+    product_id VARCHAR(50) PRIMARY KEY REFERENCES products(id) ON DELETE CASCADE,
+    stock INTEGER NOT NULL CHECK (stock >= 0),
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+) WITH (fillfactor = 50);
+
+INSERT INTO inventory (product_id, stock)
+SELECT id, 100 FROM products
+ON CONFLICT (product_id) DO NOTHING;
+
+CREATE TABLE orders (
+    id BIGSERIAL PRIMARY KEY,
+    cart_id VARCHAR(100) NOT NULL,
+    -- Client-chosen Idempotency-Key header; a retried checkout with the same
+    -- key gets the original order back instead of a second one
+    idempotency_key VARCHAR(100),
+    status VARCHAR(20) NOT NULL DEFAULT 'placed',
+    total DECIMAL(12, 2) NOT NULL,
+    item_count INTEGER NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    UNIQUE (cart_id, idempotency_key)
+);
+
+-- Name, author and price as they were when the order was placed
+CREATE TABLE order_items (
+    order_id BIGINT NOT NULL REFERENCES orders(id) ON DELETE CASCADE,
+    product_id VARCHAR(50) NOT NULL REFERENCES products(id),
+    name VARCHAR(255) NOT NULL,
+    author VARCHAR(100) NOT NULL,
+    price DECIMAL(10, 2) NOT NULL,
+    quantity INTEGER NOT NULL CHECK (quantity > 0),
+    PRIMARY KEY (order_id, product_id)
+);
+
+CREATE INDEX idx_order_items_product_id ON order_items (product_id);
@@ -0,0 +1,118 @@
+-- migrations/0005_browse.sql
+-- Faceted browsing (/api/products/browse): sort/filter indexes and the
+-- product_facets summary that facet counts are read from
+
+-- Price bucket of a price: 0 = under 5, 1 = 5-10, ... 6 = 50 and up.
+-- The bounds must match catalog.PRICE_BUCKETS.
+CREATE FUNCTION price_bucket(price numeric) RETURNS smallint
+LANGUAGE sql IMMUTABLE PARALLEL SAFE
+AS $$ SELECT width_bucket(price, ARRAY[5, 10, 15, 20, 30, 50]::numeric[])::smallint $$;
+
+-- First year of the decade a book was published in, -1 when unknown
+CREATE FUNCTION publication_decade(published integer) RETURNS smallint
+LANGUAGE sql IMMUTABLE PARALLEL SAFE
+AS $$ SELECT coalesce(published / 10 * 10, -1)::smallint $$;
+
+-- Number of products per (category, author, price bucket, decade). Facet
+-- counts for any combination of category/author filters and bucket-aligned
+-- price/year ranges are sums over this table, which is far smaller than
+-- products. '' stands for no category. Rows that drop to 0 are kept (and
+-- skipped by the facet queries) so the triggers never have to delete.
+CREATE TABLE product_facets (
+    category_id VARCHAR(50) NOT NULL,
+    author VARCHAR(100) NOT NULL,
+    price_bucket SMALLINT NOT NULL,
+    decade SMALLINT NOT NULL,
+    products INTEGER NOT NULL,
+    PRIMARY KEY (category_id, author, price_bucket, decade)
+);
+CREATE INDEX idx_product_facets_author ON product_facets (author);
+
+INSERT INTO product_facets (category_id, author, price_bucket, decade, products)
+SELECT coalesce(category_id, ''), author, price_bucket(price), publication_decade(published), count(*)
+FROM products
+GROUP BY 1, 2, 3, 4;
+
+-- Kept up to date per statement from the transition tables: one upsert of
+-- the net change per key, however many rows the statement touched (the
+-- importer merges thousands at a time). Keys are upserted in sorted order
+-- so concurrent writers lock summary rows in the same order.
+CREATE FUNCTION product_facets_apply() RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO product_facets AS f (category_id, author, price_bucket, decade, products)
+        SELECT coalesce(category_id, ''), author, price_bucket(price), publication_decade(published), count(*)
+        FROM new_rows
+        GROUP BY 1, 2, 3, 4
+        ORDER BY 1, 2, 3, 4
+        ON CONFLICT (category_id, author, price_bucket, decade)
+        DO UPDATE SET products = f.products + EXCLUDED.products;
+    ELSIF TG_OP = 'DELETE' THEN
+        UPDATE product_facets f SET products = f.products - d.n
+        FROM (
+            SELECT coalesce(category_id, '') AS category_id, author, price_bucket(price) AS price_bucket,
+                   publication_decade(published) AS decade, count(*) AS n
+            FROM old_rows
+            GROUP BY 1, 2, 3, 4
+        ) d
+        WHERE (f.category_id, f.author, f.price_bucket, f.decade) = (d.category_id, d.author, d.price_bucket, d.decade);
+    ELSE
+        -- Only rows whose facet values changed contribute a non-zero delta
+        INSERT INTO product_facets AS f (category_id, author, price_bucket, decade, products)
+        SELECT category_id, author, price_bucket, decade, sum(n)
+        FROM (
+            SELECT coalesce(category_id, '') AS category_id, author, price_bucket(price) AS price_bucket,
+                   publication_decade(published) AS decade, 1 AS n
+            FROM new_rows
+            UNION ALL
+            SELECT coalesce(category_id, ''), author, price_bucket(price),
+                   publication_decade(published), -1
+            FROM old_rows
+        ) changes
+        GROUP BY 1, 2, 3, 4
+        HAVING sum(n) <> 0
+        ORDER BY 1, 2, 3, 4
+        ON CONFLICT (category_id, author, price_bucket, decade)
+        DO UPDATE SET products = f.products + EXCLUDED.products;
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER products_facets_insert AFTER INSERT ON products
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION product_facets_apply();
+
+CREATE TRIGGER products_facets_update AFTER UPDATE ON products
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION product_facets_apply();
+
+CREATE TRIGGER products_facets_delete AFTER DELETE ON products
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION product_facets_apply();
+
+CREATE FUNCTION product_facets_truncate() RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    TRUNCATE product_facets;
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER products_facets_truncate AFTER TRUNCATE ON products
+FOR EACH STATEMENT EXECUTE FUNCTION product_facets_truncate();
+
+-- Browse sorts and filters. Each sort has a global index and one led by
+-- category_id (the common filter), both ending in id for keyset paging, so
+-- a page is an index range scan even with a million books. Year sorts use
+-- coalesce(published, 0), so books without a year sort as oldest.
+CREATE INDEX idx_products_name_id ON products (name, id);
+CREATE INDEX idx_products_price_id ON products (price, id);
+CREATE INDEX idx_products_year_id ON products ((coalesce(published, 0)), id);
+CREATE INDEX idx_products_category_name ON products (category_id, name, id);
+CREATE INDEX idx_products_category_price ON products (category_id, price, id);
+CREATE INDEX idx_products_category_year ON products (category_id, (coalesce(published, 0)), id);
+CREATE INDEX idx_products_author_id ON products (author, id);
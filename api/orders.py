@@ -0,0 +1,173 @@
+"""
+Checkout: turn a cart into an order.
+
+place_order() does everything in one transaction:
+
+1. lock the cart's lines (FOR UPDATE), so a concurrent checkout of the same
+   cart waits and then finds it empty;
+2. insert the order; with an Idempotency-Key a retried checkout finds the
+   original order (unique on cart_id, idempotency_key) and gets it back
+   instead of ordering twice;
+3. write the order lines and delete the cart lines;
+4. lock the inventory rows of the ordered products, check and decrement the
+   stock.
+
+Every checkout locks inventory rows in product id order, so two orders for
+overlapping titles can't deadlock. The locks on hot titles are taken last
+and held only for the decrement and the commit, and lock waits are bounded
+by ORDERS['lock_timeout_ms'], so a burst of checkouts for one book queues
+briefly instead of piling up. Products without an inventory row are not
+stock-tracked.
+"""
+import logging
+import re
+from decimal import Decimal
+
+from psycopg2 import errors
+from psycopg2.extras import RealDictCursor, execute_values
+
+from config import ORDERS
+from db import get_db_connection
+
+logger = logging.getLogger(__name__)
+
+_IDEMPOTENCY_KEY_RE = re.compile(r'^[\x21-\x7e]{1,100}$')
+
+
+class CheckoutError(Exception):
+    """A checkout that was not placed; `status` is the HTTP status to answer with."""
+    status = 400
+
+    def __init__(self, message, **details):
+        super().__init__(message)
+        self.details = details
+
+
+class EmptyCart(CheckoutError):
+    status = 400
+
+
+class OutOfStock(CheckoutError):
+    status = 409
+
+
+class CheckoutBusy(CheckoutError):
+    """Stock locks could not be taken in time; the client should retry."""
+    status = 503
+
+
+def valid_idempotency_key(key):
+    return bool(_IDEMPOTENCY_KEY_RE.match(key))
+
+
+def _load_order(cur, order):
+    cur.execute('''
+        SELECT product_id, name, author, price, quantity
+        FROM order_items WHERE order_id = %s ORDER BY product_id
+    ''', (order['id'],))
+    order['items'] = cur.fetchall()
+    return order
+
+
+def _find_order(cur, cart_id, idempotency_key):
+    cur.execute('SELECT * FROM orders WHERE cart_id = %s AND idempotency_key = %s',
+                (cart_id, idempotency_key))
+    order = cur.fetchone()
+    return _load_order(cur, order) if order is not None else None
+
+
+def place_order(cart_id, idempotency_key=None):
+    """
+    Check out a cart. Returns (order, created); created is False when an
+    earlier order placed with the same idempotency key is returned.
+    Raises EmptyCart, OutOfStock or CheckoutBusy.
+    """
+    conn = get_db_connection()
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("SELECT set_config('lock_timeout', %s, true)",
+                        (f"{ORDERS['lock_timeout_ms']}ms",))
+            if idempotency_key:
+                order = _find_order(cur, cart_id, idempotency_key)
+                if order is not None:
+                    conn.rollback()
+                    return order, False
+
+            cur.execute('''
+                SELECT c.product_id, c.quantity, p.name, p.author, p.price
+                FROM cart_items c JOIN products p ON p.id = c.product_id
+                WHERE c.user_id = %s
+                ORDER BY c.product_id
+                FOR UPDATE OF c
+            ''', (cart_id,))
+            cart_lines = cur.fetchall()
+            lines = [line for line in cart_lines if line['quantity'] > 0]
+            if not lines:
+                # A concurrent retry with our key may have just checked the cart out
+                order = _find_order(cur, cart_id, idempotency_key) if idempotency_key else None
+                conn.rollback()
+                if order is not None:
+                    return order, False
+                raise EmptyCart("Cart is empty")
+
+            total = sum(Decimal(str(line['price'])) * line['quantity'] for line in lines)
+            cur.execute('''
+                INSERT INTO orders (cart_id, idempotency_key, total, item_count)
+                VALUES (%s, %s, %s, %s)
+                RETURNING *
+            ''', (cart_id, idempotency_key, total, sum(line['quantity'] for line in lines)))
+            order = cur.fetchone()
+            execute_values(cur, '''
+                INSERT INTO order_items (order_id, product_id, name, author, price, quantity)
+                VALUES %s
+            ''', [(order['id'], line['product_id'], line['name'], line['author'],
+                   line['price'], line['quantity']) for line in lines])
+            cur.execute('DELETE FROM cart_items WHERE user_id = %s AND product_id = ANY(%s)',
+                        (cart_id, [line['product_id'] for line in cart_lines]))
+
+            # Stock last: the locks every checkout of a hot title waits for are
+            # held only from here to the commit. Always in product id order.
+            cur.execute('''
+                SELECT product_id, stock FROM inventory
+                WHERE product_id = ANY(%s)
+                ORDER BY product_id
+                FOR UPDATE
+            ''', ([line['product_id'] for line in lines],))
+            stock = {row['product_id']: row['stock'] for row in cur.fetchall()}
+            short = [{'product_id': line['product_id'], 'requested': line['quantity'],
+                      'available': stock[line['product_id']]}
+                     for line in lines
+                     if line['product_id'] in stock and stock[line['product_id']] < line['quantity']]
+            if short:
+                conn.rollback()
+                raise OutOfStock("Insufficient stock", items=short)
+            if stock:
+                execute_values(cur, '''
+                    UPDATE inventory i SET stock = i.stock - v.quantity, updated_at = now()
+                    FROM (VALUES %s) AS v (product_id, quantity)
+                    WHERE i.product_id = v.product_id
+                ''', [(line['product_id'], line['quantity'])
+                      for line in lines if line['product_id'] in stock])
+            conn.commit()
+            order['items'] = [{'product_id': line['product_id'], 'name': line['name'],
+                               'author': line['author'], 'price': line['price'],
+                               'quantity': line['quantity']} for line in lines]
+            return order, True
+    except errors.LockNotAvailable:
+        conn.rollback()
+        logger.warning(f"Checkout of cart {cart_id} timed out waiting for stock locks")
+        raise CheckoutBusy("Checkout is busy, please retry")
+    except errors.UniqueViolation:
+        # The same idempotency key was committed by a concurrent request
+        conn.rollback()
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            order = _find_order(cur, cart_id, idempotency_key)
+        conn.rollback()
+        if order is None:
+            raise
+        return order, False
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
@@ -0,0 +1,83 @@
+"""
+Helpers for keyset-paginated list endpoints.
+
+Cursors are opaque to clients: a url-safe base64 encoding of the sort key
+values of the last row returned. The next page is fetched with
+`WHERE (sort key) > (cursor values)`, which stays an index range scan no
+matter how deep the client pages (unlike OFFSET).
+"""
+import base64
+import json
+
+# Columns of the products table that may be requested with ?fields=
+PRODUCT_FIELDS = (
+    'id', 'name', 'author', 'price', 'category_id', 'category',
+    'description', 'image_url', 'pages', 'published',
+)
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+
+
+def encode_cursor(values):
+    """Encode the sort key values of the last row on a page."""
+    raw = json.dumps(list(values), separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, size=1):
+    """Decode a cursor produced by encode_cursor(); raises ValueError if invalid."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (ValueError, UnicodeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError("Invalid cursor")
+    return values
+
+
+def parse_limit(value, default=DEFAULT_LIMIT, maximum=MAX_LIMIT):
+    """Parse a ?limit= parameter, clamping it to `maximum`."""
+    if value is None or value == '':
+        return default
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    return min(limit, maximum)
+
+
+def parse_fields(value, allowed=PRODUCT_FIELDS, required=('id',)):
+    """
+    Parse a comma separated ?fields= projection. Returns None when no
+    projection was requested (select every column).
+    """
+    if not value:
+        return None
+    fields = [f.strip() for f in value.split(',') if f.strip()]
+    unknown = [f for f in fields if f not in allowed]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    # Always include the columns the cursor (or the client) depends on
+    for column in reversed(required):
+        if column not in fields:
+            fields.insert(0, column)
+    return tuple(fields)
+
+
+def select_list(fields, allowed=PRODUCT_FIELDS, table=None):
+    """
+    SQL for the projected column list; every allowed column when fields is
+    None. Plain text so it works with any driver; only whitelisted column
+    names get through. `table` qualifies the columns with a table alias.
+    """
+    if fields is None:
+        fields = allowed
+    for field in fields:
+        if field not in allowed:
+            raise ValueError(f"Unknown field: {field}")
+    prefix = f"{table}." if table else ''
+    return ', '.join(f'{prefix}"{field}"' for field in fields)
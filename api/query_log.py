@@ -0,0 +1,257 @@
+"""
+Per-statement query statistics and a slow-query log with captured plans.
+
+Every statement executed through a pooled connection (see
+db._TimedCursorMixin) is reduced to a fingerprint: literals and parameters
+become ?, so `... WHERE id = '7'` and `... WHERE id = %s` aggregate
+together, like pg_stat_statements. For each fingerprint we keep calls,
+total/max time and rows.
+
+Statements slower than QUERY_LOG['slow_ms'] are logged and kept in a short
+list of recent slow queries. At most once per fingerprint every
+QUERY_LOG['explain_interval'] seconds, and only for a QUERY_LOG['explain_sample']
+fraction of those, the plan is captured on the same connection:
+EXPLAIN (ANALYZE, BUFFERS) for queries that only read tables, plain EXPLAIN
+for anything else (ANALYZE runs the statement again, so writes, row locks
+and calls such as pg_advisory_lock() or set_config() would repeat). Fast statements cost a timer and a
+dict update; only slow ones can pay for an EXPLAIN.
+"""
+import json
+import random
+import re
+import threading
+import time
+import logging
+from collections import deque
+
+from psycopg2 import extensions
+
+from config import QUERY_LOG
+
+logger = logging.getLogger(__name__)
+
+_COMMENT_RE = re.compile(r'--[^\n]*|/\*.*?\*/', re.S)
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_PARAM_RE = re.compile(r'%\(\w+\)s|%s|\$\d+')
+_NUMBER_RE = re.compile(r'(?<![\w.])\d+(?:\.\d+)?\b')
+_LIST_RE = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_SPACE_RE = re.compile(r'\s+')
+_READ_ONLY_RE = re.compile(r'^\s*(select|with)\b', re.I)
+_FROM_RE = re.compile(r'\bfrom\b', re.I)
+# Writes, row locks, SELECT INTO, and functions with side effects (advisory
+# locks and other pg_* admin functions, set_config, sequences): ANALYZE would
+# run them a second time
+_SIDE_EFFECT_RE = re.compile(
+    r'\b(insert|update|delete|merge|into|for\s+(no\s+key\s+)?update|for\s+(key\s+)?share)\b'
+    r'|\b(pg_\w+|set_config|nextval|setval|lo_\w+|dblink\w*)\s*\(', re.I)
+
+OTHER = '<other statements>'
+MAX_CACHED_FINGERPRINTS = 2048
+
+
+def fingerprint(sql):
+    """Normalize a statement: no comments or literals, single spaces."""
+    sql = _COMMENT_RE.sub(' ', sql)
+    sql = _STRING_RE.sub('?', sql)
+    sql = _PARAM_RE.sub('?', sql)
+    sql = _NUMBER_RE.sub('?', sql)
+    sql = _SPACE_RE.sub(' ', sql).strip()
+    return _LIST_RE.sub('(?, ...)', sql)
+
+
+class StatementStats:
+    __slots__ = ('calls', 'errors', 'total_time', 'max_time', 'rows', 'slow_calls',
+                 'plan', 'plan_analyzed', 'plan_duration', 'plan_captured_at', 'last_explain')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.rows = 0
+        self.slow_calls = 0
+        self.plan = None
+        self.plan_analyzed = False
+        self.plan_duration = None
+        self.plan_captured_at = None
+        self.last_explain = 0.0
+
+    def as_dict(self, include_plan=True):
+        data = {
+            'calls': self.calls,
+            'errors': self.errors,
+            'total_ms': round(self.total_time * 1000, 3),
+            'mean_ms': round(self.total_time * 1000 / self.calls, 3) if self.calls else 0.0,
+            'max_ms': round(self.max_time * 1000, 3),
+            'rows': self.rows,
+            'slow_calls': self.slow_calls,
+        }
+        if include_plan and self.plan is not None:
+            data['plan'] = {
+                'analyzed': self.plan_analyzed,
+                'duration_ms': round(self.plan_duration * 1000, 3),
+                'captured_at': self.plan_captured_at,
+                'explain': self.plan,
+            }
+        return data
+
+
+class QueryLog:
+    """
+    Args:
+        slow_ms: Statements at least this slow are logged (and may be explained)
+        explain: Capture plans for slow statements
+        explain_sample: Fraction of eligible slow statements that are explained
+        explain_interval: Minimum seconds between plans for one fingerprint
+        max_fingerprints: Distinct statements tracked before lumping the rest together
+        recent_slow: Number of recent slow statements kept
+    """
+
+    def __init__(self, slow_ms=200, explain=True, explain_sample=1.0, explain_interval=300,
+                 max_fingerprints=500, recent_slow=100):
+        self.slow = slow_ms / 1000.0
+        self.explain = explain
+        self.explain_sample = explain_sample
+        self.explain_interval = explain_interval
+        self.max_fingerprints = max_fingerprints
+        self._stats = {}
+        self._fingerprints = {}
+        self._recent = deque(maxlen=recent_slow)
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+
+    def _fingerprint(self, sql):
+        key = self._fingerprints.get(sql)
+        if key is None:
+            key = fingerprint(sql)
+            if len(self._fingerprints) >= MAX_CACHED_FINGERPRINTS:
+                self._fingerprints.clear()
+            self._fingerprints[sql] = key
+        return key
+
+    def observe(self, sql, seconds, rows=-1, error=False):
+        """
+        Account one execution. Returns (fingerprint, stats) when the
+        statement was slow and is due for a plan, otherwise None.
+        """
+        key = self._fingerprint(sql)
+        slow = seconds >= self.slow
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                if len(self._stats) >= self.max_fingerprints:
+                    key = OTHER
+                    stats = self._stats.get(key)
+                if stats is None:
+                    stats = self._stats[key] = StatementStats()
+            stats.calls += 1
+            stats.total_time += seconds
+            if seconds > stats.max_time:
+                stats.max_time = seconds
+            if error:
+                stats.errors += 1
+            elif rows > 0:
+                stats.rows += rows
+            if not slow:
+                return None
+            stats.slow_calls += 1
+            self._recent.append({
+                'at': time.time(),
+                'duration_ms': round(seconds * 1000, 3),
+                'fingerprint': key,
+                'error': error,
+            })
+            due = (self.explain and not error and key != OTHER
+                   and time.monotonic() - stats.last_explain >= self.explain_interval
+                   and random.random() < self.explain_sample)
+            if due:
+                # Claim it now so concurrent slow calls don't all explain
+                stats.last_explain = time.monotonic()
+
+        logger.warning(f"Slow query ({seconds * 1000:.1f} ms): {key}")
+        return (key, stats) if due else None
+
+    def record(self, cursor, sql, params, seconds, error=False):
+        """Called by instrumented cursors after every execute()."""
+        if isinstance(sql, bytes):
+            sql = sql.decode('utf-8', 'replace')
+        elif not isinstance(sql, str):
+            # psycopg2.sql.Composable
+            sql = sql.as_string(cursor)
+        due = self.observe(sql, seconds, cursor.rowcount, error)
+        if due is not None and cursor.name is None:
+            self._capture_plan(cursor.connection, sql, params, seconds, *due)
+
+    def _capture_plan(self, conn, sql, params, seconds, key, stats):
+        analyze = (bool(_READ_ONLY_RE.match(sql)) and bool(_FROM_RE.search(sql))
+                   and not _SIDE_EFFECT_RE.search(_STRING_RE.sub("''", sql)))
+        options = 'ANALYZE, BUFFERS, FORMAT JSON' if analyze else 'FORMAT JSON'
+        in_transaction = conn.get_transaction_status() == extensions.TRANSACTION_STATUS_INTRANS
+        # A plain cursor, so the EXPLAIN itself is not timed or logged
+        cur = extensions.cursor(conn)
+        try:
+            if in_transaction:
+                # Keep a failing EXPLAIN from aborting the caller's transaction
+                cur.execute('SAVEPOINT query_log_explain')
+            try:
+                cur.execute(f'EXPLAIN ({options}) {sql}', params)
+                plan = cur.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+            except Exception as e:
+                if in_transaction:
+                    cur.execute('ROLLBACK TO SAVEPOINT query_log_explain')
+                logger.info(f"Could not explain slow query: {e}")
+                return
+            finally:
+                if in_transaction and conn.get_transaction_status() == extensions.TRANSACTION_STATUS_INTRANS:
+                    cur.execute('RELEASE SAVEPOINT query_log_explain')
+        except Exception as e:
+            logger.info(f"Could not explain slow query: {e}")
+            return
+        finally:
+            cur.close()
+
+        with self._lock:
+            stats.plan = plan
+            stats.plan_analyzed = analyze
+            stats.plan_duration = seconds
+            stats.plan_captured_at = time.time()
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self._recent.clear()
+            self.started_at = time.time()
+
+    def report(self, sort='total', limit=50):
+        """Top statements by `sort` (total, mean, max, calls), recent slow queries and plans."""
+        sort_keys = {
+            'total': lambda item: item[1].total_time,
+            'mean': lambda item: item[1].total_time / item[1].calls if item[1].calls else 0,
+            'max': lambda item: item[1].max_time,
+            'calls': lambda item: item[1].calls,
+        }
+        if sort not in sort_keys:
+            raise ValueError(f"sort must be one of: {', '.join(sort_keys)}")
+        with self._lock:
+            items = sorted(self._stats.items(), key=sort_keys[sort], reverse=True)[:limit]
+            statements = [dict(fingerprint=key, **stats.as_dict()) for key, stats in items]
+            recent = list(self._recent)
+            tracked = len(self._stats)
+        return {
+            'since': self.started_at,
+            'slow_ms': self.slow * 1000,
+            'tracked_statements': tracked,
+            'statements': statements,
+            'recent_slow': recent[::-1],
+        }
+
+
+query_log = QueryLog(
+    slow_ms=QUERY_LOG['slow_ms'],
+    explain=QUERY_LOG['explain'],
+    explain_sample=QUERY_LOG['explain_sample'],
+    explain_interval=QUERY_LOG['explain_interval'],
+    max_fingerprints=QUERY_LOG['max_fingerprints'],
+)
@@ -0,0 +1,237 @@
+"""
+Read-replica routing for catalog reads.
+
+With DB_REPLICAS configured, read-only catalog queries borrow from a pool on
+one of the replicas (round robin) and everything else (carts, checkout, the
+cart page, which must see the visitor's own writes) stays on the primary.
+A background ReplicaMonitor checks each replica every
+REPLICAS['check_interval'] seconds over its own connection: reachable, in
+recovery, and how far replay is behind. A replica that is down or more than
+REPLICAS['max_lag'] seconds behind gets no reads until it catches up;
+with no usable replica, reads fall back to the primary.
+
+Catalog changes are announced by NOTIFY from the primary (cache.py), and the
+cache reloads right away. So that the reload can't read the old rows from a
+replica that hasn't replayed the change yet, the listener records the
+primary's WAL position at the time (require_lsn()), and until a replica has
+replayed past it reads go to the primary.
+"""
+import functools
+import itertools
+import os
+import threading
+import time
+import logging
+
+import psycopg2
+from psycopg2 import extensions
+
+from config import DB_POOL, DB_REPLICAS, REPLICAS
+from db import ConnectionPool, PoolTimeout, connect, get_db_connection
+
+logger = logging.getLogger(__name__)
+
+
+def parse_lsn(text):
+    """'16/B374D848' -> integer WAL position (None stays None)."""
+    if not text:
+        return None
+    high, low = text.split('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+class Replica:
+    """A read replica's pool and the health last seen by the monitor."""
+
+    def __init__(self, host, port):
+        self.name = f"{host}:{port}"
+        self.pool = ConnectionPool(
+            minconn=DB_POOL['min_size'],
+            maxconn=DB_POOL['max_size'],
+            timeout=DB_POOL['timeout'],
+            max_uses=DB_POOL['max_uses'],
+            max_age=DB_POOL['max_age'],
+            validate_after=DB_POOL['validate_after'],
+            connect_fn=functools.partial(connect, host=host, port=port,
+                                         connect_timeout=REPLICAS['connect_timeout']),
+        )
+        self.host = host
+        self.port = port
+        # No reads until the first check has passed
+        self.healthy = False
+        self.in_recovery = None
+        self.lag = None
+        self.replay_lsn = None
+        self.error = None
+        self.checked_at = None
+
+    def usable(self, required_lsn):
+        if not self.healthy:
+            return False
+        # Not in recovery: not streaming from the primary, nothing to wait for
+        return not self.in_recovery or (self.replay_lsn or 0) >= required_lsn
+
+    def mark_down(self, error):
+        if self.healthy:
+            logger.warning(f"Replica {self.name} is unavailable, reading from the primary: {error}")
+        self.healthy = False
+        self.error = str(error)
+
+    def stats(self):
+        return {
+            'name': self.name,
+            'healthy': self.healthy,
+            'in_recovery': self.in_recovery,
+            'lag': self.lag,
+            'replay_lsn': self.replay_lsn,
+            'error': self.error,
+            'checked_at': self.checked_at,
+            'pool': self.pool.stats(),
+        }
+
+
+class ReplicaMonitor(threading.Thread):
+    """Background thread checking replica health and replication lag."""
+
+    def __init__(self, replicas, interval, max_lag):
+        super().__init__(name='replica-monitor', daemon=True)
+        self.replicas = replicas
+        self.interval = interval
+        self.max_lag = max_lag
+        self._conns = {}
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            for replica in self.replicas:
+                self.check(replica)
+            self._stop_event.wait(self.interval)
+        for conn in self._conns.values():
+            conn.close()
+
+    def check(self, replica):
+        conn = self._conns.get(replica.name)
+        try:
+            if conn is None or conn.closed:
+                # Uninstrumented, so health checks don't show up in the query stats
+                conn = self._conns[replica.name] = connect(
+                    host=replica.host, port=replica.port,
+                    connect_timeout=REPLICAS['connect_timeout'],
+                    connection_factory=extensions.connection)
+                conn.autocommit = True
+            with conn.cursor() as cur:
+                # Idle primary: nothing left to replay means no lag, however
+                # old the last replayed transaction is
+                cur.execute('''
+                    SELECT pg_is_in_recovery(),
+                           pg_last_wal_replay_lsn()::text,
+                           CASE WHEN NOT pg_is_in_recovery()
+                                  OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                                ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0)
+                           END
+                ''')
+                in_recovery, replay_lsn, lag = cur.fetchone()
+        except psycopg2.Error as e:
+            self._conns.pop(replica.name, None)
+            if conn is not None:
+                conn.close()
+            replica.checked_at = time.time()
+            replica.mark_down(e)
+            return
+
+        replica.in_recovery = in_recovery
+        replica.replay_lsn = parse_lsn(replay_lsn)
+        replica.lag = float(lag)
+        replica.checked_at = time.time()
+        healthy = replica.lag <= self.max_lag
+        if healthy and not replica.healthy:
+            logger.info(f"Replica {replica.name} is serving reads (lag {replica.lag:.1f}s)")
+            if not in_recovery:
+                logger.warning(f"Replica {replica.name} is not in recovery (not replicating)")
+        elif not healthy and replica.healthy:
+            logger.warning(f"Replica {replica.name} is {replica.lag:.1f}s behind, reading from the primary")
+        replica.error = None if healthy else f"replication lag {replica.lag:.1f}s"
+        replica.healthy = healthy
+
+
+_replicas = [Replica(host, port) for host, port in DB_REPLICAS]
+_round_robin = itertools.count()
+_required_lsn = 0
+_fallbacks = 0
+
+_monitor = None
+_monitor_pid = None
+_monitor_lock = threading.Lock()
+
+
+def ensure_replica_monitor():
+    """Start the health-check thread for this process if it isn't running yet."""
+    global _monitor, _monitor_pid
+    if not _replicas:
+        return
+    pid = os.getpid()
+    if _monitor_pid == pid and _monitor.is_alive():
+        return
+    with _monitor_lock:
+        if _monitor_pid == pid and _monitor.is_alive():
+            return
+        if _monitor_pid is not None and _monitor_pid != pid:
+            # Forked: health seen by the parent may be stale
+            for replica in _replicas:
+                replica.healthy = False
+        _monitor = ReplicaMonitor(_replicas, REPLICAS['check_interval'], REPLICAS['max_lag'])
+        _monitor.start()
+        _monitor_pid = pid
+
+
+def replicas_configured():
+    return bool(_replicas)
+
+
+def require_lsn(lsn):
+    """Only read from replicas that have replayed the primary up to `lsn` ('X/Y')."""
+    global _required_lsn
+    _required_lsn = max(_required_lsn, parse_lsn(lsn) or 0)
+
+
+def get_read_connection():
+    """
+    Borrow a connection for read-only queries: from a healthy, caught-up
+    replica if there is one, otherwise from the primary pool.
+    """
+    global _fallbacks
+    if not _replicas:
+        return get_db_connection()
+    ensure_replica_monitor()
+    candidates = [r for r in _replicas if r.usable(_required_lsn)]
+    if candidates:
+        start = next(_round_robin)
+        for i in range(len(candidates)):
+            replica = candidates[(start + i) % len(candidates)]
+            try:
+                return replica.pool.getconn()
+            except PoolTimeout:
+                # Busy, not broken: try the next one
+                continue
+            except psycopg2.OperationalError as e:
+                replica.mark_down(e)
+    _fallbacks += 1
+    return get_db_connection()
+
+
+def close_replica_pools():
+    for replica in _replicas:
+        replica.pool.closeall()
+
+
+def replica_stats():
+    return {
+        'configured': len(_replicas),
+        'healthy': sum(1 for r in _replicas if r.healthy),
+        'fallbacks': _fallbacks,
+        'required_lsn': _required_lsn,
+        'replicas': [r.stats() for r in _replicas],
+    }
@@ -0,0 +1,267 @@
+"""
+Single-flight coalescing of catalog cache misses.
+
+When a hot key is missing from the catalog cache (after a deploy, an
+invalidation or expiry), every request for it would run the same query at
+the same time. SingleFlight lets the first request (the leader) load it
+while identical concurrent requests (followers) wait for its result, or its
+exception, and share it. Keys are catalog cache keys, i.e. the endpoint and
+its normalized parameters, plus the cache version: a request that arrives
+after an invalidation never joins a load that started before it.
+
+Worker processes have separate caches. With SINGLE_FLIGHT['lock_dir'] set,
+a leader also takes an exclusive lock file (flock) for its key and leaves
+the result next to it, so a leader in another worker that was waiting for
+the lock takes that result instead of querying again. Results are only
+shared with requests that started before the load did, so they are never
+staler than a load of their own. Without fcntl (Windows), coalescing is per
+process only.
+
+Shared results are plain data, never pickles: a JSON header line followed by
+the raw response body, converted by the `dump`/`load` functions the owner
+passes in. The lock directory must belong to this user and be closed to
+everyone else, since other workers act on what they read from it.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import stat
+import tempfile
+import threading
+import time
+
+import metrics
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+# Keys map onto this many lock files, so the lock directory stays bounded
+# however many distinct keys (search queries...) there are
+LOCK_STRIPES = 1024
+
+
+# Longest header line read from a result file
+MAX_HEADER_BYTES = 64 * 1024
+
+
+def check_private_dir(path):
+    """
+    Raise unless path is a directory owned by this user with no group or
+    other permissions. makedirs() doesn't change an existing directory's mode,
+    so one created beforehand by someone else is refused rather than trusted.
+    """
+    st = os.stat(path)
+    if not stat.S_ISDIR(st.st_mode):
+        raise RuntimeError(f"{path} is not a directory")
+    if st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise RuntimeError(f"{path} must be owned by uid {os.getuid()} with mode 0700 "
+                           f"(is uid {st.st_uid}, mode {stat.S_IMODE(st.st_mode):04o})")
+
+
+class _Flight:
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Args:
+        wait_timeout: Longest a follower waits for the leader (or another
+            worker's lock) before loading on its own
+        lock_dir: Directory for cross-worker lock and result files (None:
+            coalesce within this process only)
+        dump: Callable turning a result into (JSON-able header dict, bytes)
+            for other workers; required with lock_dir
+        load: Callable rebuilding a result from dump()'s header and bytes
+    """
+
+    def __init__(self, wait_timeout=5.0, lock_dir=None, dump=None, load=None):
+        self.wait_timeout = wait_timeout
+        self.lock_dir = lock_dir if lock_dir and fcntl is not None else None
+        self.dump = dump
+        self.load = load
+        self._flights = {}
+        self._async_flights = {}
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._stats = {
+            'leaders': 0,
+            'followers': 0,
+            'follower_timeouts': 0,
+            'shared_across_workers': 0,
+            'lock_timeouts': 0,
+        }
+        if self.lock_dir:
+            if dump is None or load is None:
+                raise ValueError("Sharing results across workers needs dump and load functions")
+            os.makedirs(self.lock_dir, mode=0o700, exist_ok=True)
+            check_private_dir(self.lock_dir)
+
+    def do(self, key, fn, generation=None):
+        """Return fn(), sharing one call among concurrent callers with the same key."""
+        flight_key = (generation, key)
+        with self._lock:
+            flight = self._flights.get(flight_key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[flight_key] = _Flight()
+                self._stats['leaders'] += 1
+            else:
+                self._stats['followers'] += 1
+
+        if not leader:
+            if flight.done.wait(self.wait_timeout):
+                metrics.mark_cache('coalesced')
+                if flight.error is not None:
+                    raise flight.error
+                return flight.value
+            with self._lock:
+                self._stats['follower_timeouts'] += 1
+            return fn()
+
+        try:
+            flight.value = self._load(key, fn)
+            return flight.value
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[flight_key]
+            flight.done.set()
+
+    async def do_async(self, key, fn, generation=None):
+        """do() for coroutines on one event loop (the ASGI app); per process only."""
+        flight_key = (generation, key)
+        future = self._async_flights.get(flight_key)
+        if future is not None:
+            with self._lock:
+                self._stats['followers'] += 1
+            value = await asyncio.shield(future)
+            metrics.mark_cache('coalesced')
+            return value
+
+        future = self._async_flights[flight_key] = asyncio.get_running_loop().create_future()
+        with self._lock:
+            self._stats['leaders'] += 1
+        try:
+            value = await fn()
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            # Retrieved here so a flight without followers doesn't log it
+            future.exception()
+            raise
+        finally:
+            del self._async_flights[flight_key]
+
+    # -- across workers ----------------------------------------------------
+
+    def _load(self, key, fn):
+        if self.lock_dir is None:
+            return fn()
+        started = time.time()
+        digest = hashlib.blake2b(repr(key).encode('utf-8'), digest_size=16).hexdigest()
+        lock_path = os.path.join(self.lock_dir, f'{int(digest, 16) % LOCK_STRIPES}.lock')
+        result_path = os.path.join(self.lock_dir, f'{digest}.result')
+        with open(lock_path, 'a') as lock_file:
+            if not self._lock_file(lock_file, started + self.wait_timeout):
+                with self._lock:
+                    self._stats['lock_timeouts'] += 1
+                return fn()
+            try:
+                value = self._read_result(result_path, started)
+                if value is not _MISSING:
+                    with self._lock:
+                        self._stats['shared_across_workers'] += 1
+                    metrics.mark_cache('shared')
+                    return value
+                loaded_at = time.time()
+                value = fn()
+                self._write_result(result_path, loaded_at, value)
+                return value
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _lock_file(lock_file, deadline):
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                if time.time() >= deadline:
+                    return False
+                time.sleep(0.005)
+
+    def _read_result(self, path, started):
+        """The result left by another worker, if its load began after `started`."""
+        try:
+            with open(path, 'rb') as f:
+                header = json.loads(f.readline(MAX_HEADER_BYTES))
+                body = f.read()
+            if not isinstance(header, dict) or not isinstance(header.get('loaded_at'), (int, float)):
+                return _MISSING
+            if header['loaded_at'] < started or header.get('size') != len(body):
+                # Stale, or a torn file
+                return _MISSING
+            return self.load(header.get('meta'), body)
+        except FileNotFoundError:
+            return _MISSING
+        except (OSError, ValueError, TypeError, KeyError, AttributeError) as e:
+            logger.warning(f"Ignoring unreadable shared result {path}: {e}")
+            return _MISSING
+
+    def _write_result(self, path, loaded_at, value):
+        tmp_path = None
+        try:
+            meta, body = self.dump(value)
+            header = json.dumps({'loaded_at': loaded_at, 'size': len(body), 'meta': meta},
+                                separators=(',', ':')).encode('utf-8')
+            fd, tmp_path = tempfile.mkstemp(dir=self.lock_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(header + b'\n')
+                f.write(body)
+            os.replace(tmp_path, path)
+        except (OSError, ValueError, TypeError) as e:
+            logger.warning(f"Could not share result across workers: {e}")
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            return
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self._sweep()
+
+    def _sweep(self):
+        """Remove results too old for any waiting request to use."""
+        cutoff = time.time() - 2 * self.wait_timeout
+        with os.scandir(self.lock_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith(('.result', '.tmp')):
+                    continue
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        os.unlink(entry.path)
+                except OSError:
+                    # Replaced or removed by another worker meanwhile
+                    pass
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = len(self._flights) + len(self._async_flights)
+        stats['across_workers'] = self.lock_dir is not None
+        return stats
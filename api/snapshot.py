@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+Export the catalog read path as static files for nginx or a CDN.
+
+    python snapshot.py /var/www/catalog            # incremental
+    python snapshot.py /var/www/catalog --full     # re-render everything
+
+Every catalog endpoint's JSON (/api/categories, each category and its
+product list, each product, and the featured list) is rendered with the
+API's own queries and encoder into a new version directory, laid out like
+the URLs with index.json files:
+
+    <out>/<version>/api/categories/index.json
+    <out>/<version>/api/categories/<id>/index.json
+    <out>/<version>/api/categories/<id>/products/index.json
+    <out>/<version>/api/products/<id>/index.json
+    <out>/<version>/api/products/featured/index.json
+    <out>/<version>/manifest.json
+
+Next to each index.json are precompressed variants (.gz, and .br/.zst when
+brotli/zstandard are installed) for gzip_static and friends. Files are
+written to temporary names and renamed, the version directory is built
+under a temporary name, and the `current` symlink is swapped to it in one
+rename, so a proxy never sees a partial snapshot.
+
+Runs are incremental. The manifest records a fingerprint per file: for
+products an md5 of the row (computed by Postgres, so unchanged rows are
+never fetched) plus the cover's content version; for category product lists
+the fingerprints of their products. Files whose fingerprint or content
+is unchanged are hard-linked from the previous version instead of being
+rendered and compressed again. All rows are read in one repeatable-read
+transaction, so a snapshot is consistent.
+
+The featured list is rendered at export time; scheduled features go live
+with the next export.
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from flask import Flask
+from psycopg2.extras import RealDictCursor
+
+import catalog
+import compression
+from config import SNAPSHOT
+from db import connect
+from http_cache import build_cached_body
+from images import image_store
+from json_provider import init_json
+
+MANIFEST = 'manifest.json'
+CURRENT = 'current'
+INDEX = 'index.json'
+# Encoding -> file suffix, as gzip_static / brotli_static / zstd_static expect
+SUFFIXES = {'gzip': '.gz', 'br': '.br', 'zstd': '.zst'}
+
+# Product ids that can't be a directory name, or that collide with other
+# routes, are left to the API
+_UNSAFE_ID_RE = re.compile(r'[/\\\x00]')
+RESERVED_PRODUCT_IDS = {'featured', 'browse'}
+
+FETCH_BATCH = 1000
+
+
+def _safe_segment(value):
+    return bool(value) and value not in ('.', '..') and not _UNSAFE_ID_RE.search(value)
+
+
+class SnapshotWriter:
+    """
+    Builds one version directory, reusing files of the previous version
+    whose fingerprint or content hasn't changed.
+    """
+
+    def __init__(self, directory, json_provider, previous_dir=None, previous_files=None):
+        self.directory = directory
+        self.json_provider = json_provider
+        self.previous_dir = previous_dir
+        self.previous_files = previous_files or {}
+        self.files = {}
+        self.stats = {'written': 0, 'reused': 0, 'bytes': 0}
+
+    @staticmethod
+    def file_for(url):
+        return url.lstrip('/') + '/' + INDEX
+
+    def reuse(self, url, fingerprint):
+        """Link the previous version's file if its fingerprint matches; returns whether it did."""
+        previous = self.previous_files.get(url)
+        if previous is None or previous.get('fingerprint') != fingerprint:
+            return False
+        return self._link(url, previous)
+
+    def write(self, url, data, fingerprint=None):
+        entry = build_cached_body(data, json_provider=self.json_provider)
+        previous = self.previous_files.get(url)
+        if previous is not None and previous['etag'] == entry.etag:
+            # Same bytes as before (e.g. a category row that didn't change)
+            if self._link(url, dict(previous, fingerprint=fingerprint)):
+                return
+        path = os.path.join(self.directory, self.file_for(url))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        record = {'file': self.file_for(url), 'etag': entry.etag, 'size': len(entry.body),
+                  'fingerprint': fingerprint, 'encodings': {}}
+        _write_atomic(path, entry.body)
+        self.stats['bytes'] += len(entry.body)
+        for encoding in compression.ENCODINGS:
+            body = entry.encoded(encoding)
+            _write_atomic(path + SUFFIXES[encoding], body)
+            record['encodings'][encoding] = len(body)
+            self.stats['bytes'] += len(body)
+        self.files[url] = record
+        self.stats['written'] += 1
+
+    def _link(self, url, previous):
+        """Hard-link (or copy) a file and its variants from the previous version."""
+        names = [previous['file']] + [previous['file'] + SUFFIXES[e] for e in previous['encodings']]
+        try:
+            for name in names:
+                target = os.path.join(self.directory, name)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                source = os.path.join(self.previous_dir, name)
+                try:
+                    os.link(source, target)
+                except OSError:
+                    # Other filesystem, or links not supported
+                    shutil.copy2(source, target)
+        except OSError:
+            # Previous file gone: render it again
+            return False
+        self.files[url] = previous
+        self.stats['reused'] += 1
+        return True
+
+
+def _write_atomic(path, body):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(body)
+        # Readable by the web server (mkstemp creates files 0600)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def _run(cur, query):
+    cur.execute(query.sql, query.params)
+    return query.shape(cur.fetchone() if query.one else cur.fetchall())
+
+
+def _digest(*parts):
+    return hashlib.blake2b('\x1f'.join(parts).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def load_manifest(version_dir):
+    try:
+        with open(os.path.join(version_dir, MANIFEST), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def export_catalog(cur, writer):
+    """Render every catalog endpoint into the writer."""
+    categories = _run(cur, catalog.categories_query())
+    writer.write('/api/categories', categories)
+    for category in categories:
+        if _safe_segment(category['id']):
+            writer.write(f"/api/categories/{category['id']}", category)
+    writer.write('/api/products/featured', _run(cur, catalog.featured_products_query()))
+
+    # Fingerprint every product without fetching it: md5 of the row, plus
+    # the cover version that prepare_product() adds to its image URL
+    fingerprints = {}
+    members = {}
+    # Server-side cursor: streamed in batches however large the catalog is
+    with cur.connection.cursor(name='snapshot_fingerprints') as rows:
+        rows.itersize = 10000
+        rows.execute(f'''
+            SELECT p.id, p.category_id, p.image_url,
+                   md5(ROW({catalog.PRODUCT_COLUMNS_P})::text)
+            FROM products p ORDER BY p.id
+        ''')
+        for product_id, category_id, image_url, row_hash in rows:
+            image_url = catalog.prepare_product({'image_url': image_url})['image_url']
+            fingerprints[product_id] = _digest(row_hash, image_url or '')
+            members.setdefault(category_id, []).append(product_id)
+
+    changed = [pid for pid, fingerprint in fingerprints.items()
+               if _safe_segment(pid) and pid not in RESERVED_PRODUCT_IDS
+               and not writer.reuse(f'/api/products/{pid}', fingerprint)]
+    for start in range(0, len(changed), FETCH_BATCH):
+        batch = _run(cur, catalog.products_by_ids_query(changed[start:start + FETCH_BATCH]))
+        for product in batch['products']:
+            writer.write(f"/api/products/{product['id']}", product, fingerprints[product['id']])
+
+    for category in categories:
+        if not _safe_segment(category['id']):
+            continue
+        url = f"/api/categories/{category['id']}/products"
+        fingerprint = _digest(*(f'{pid}:{fingerprints[pid]}' for pid in members.get(category['id'], [])))
+        if not writer.reuse(url, fingerprint):
+            writer.write(url, _run(cur, catalog.products_by_category_query(category['id'])), fingerprint)
+
+
+def _switch_current(out_dir, version):
+    """Point <out>/current at the version directory in one atomic rename."""
+    link = os.path.join(out_dir, CURRENT)
+    tmp_link = os.path.join(out_dir, f'.{CURRENT}.{os.getpid()}')
+    if os.path.lexists(tmp_link):
+        os.unlink(tmp_link)
+    os.symlink(version, tmp_link)
+    os.replace(tmp_link, link)
+
+
+def _prune(out_dir, keep, current):
+    """Remove all but the newest `keep` versions (never the current one)."""
+    versions = sorted(name for name in os.listdir(out_dir)
+                      if not name.startswith('.') and name != CURRENT
+                      and os.path.isdir(os.path.join(out_dir, name)))
+    for name in versions[:-keep] if keep > 0 else []:
+        if name != current:
+            shutil.rmtree(os.path.join(out_dir, name), ignore_errors=True)
+
+
+def create_snapshot(out_dir, full=False, keep=None):
+    """
+    Export a new snapshot version into out_dir and make it current.
+    Returns its manifest.
+    """
+    keep = SNAPSHOT['keep'] if keep is None else keep
+    started = time.monotonic()
+    os.makedirs(out_dir, exist_ok=True)
+    image_store.refresh()
+
+    previous_dir = os.path.realpath(os.path.join(out_dir, CURRENT))
+    previous = None if full else load_manifest(previous_dir)
+    version = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')
+    staging = tempfile.mkdtemp(dir=out_dir, prefix=f'.{version}.')
+    os.chmod(staging, 0o755)
+
+    # Same encoder and settings as the API's responses, so bodies (and
+    # ETags) are byte-identical
+    app = Flask(__name__)
+    writer = SnapshotWriter(staging, init_json(app), previous_dir,
+                            previous['files'] if previous else None)
+    conn = connect()
+    try:
+        conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            export_catalog(cur, writer)
+        conn.rollback()
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    finally:
+        conn.close()
+
+    manifest = {
+        'version': version,
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'previous': previous['version'] if previous else None,
+        'encodings': compression.ENCODINGS,
+        'stats': dict(writer.stats, files=len(writer.files),
+                      seconds=round(time.monotonic() - started, 3)),
+        'files': writer.files,
+    }
+    _write_atomic(os.path.join(staging, MANIFEST),
+                  json.dumps(manifest, indent=1, sort_keys=True).encode('utf-8'))
+    os.rename(staging, os.path.join(out_dir, version))
+    _switch_current(out_dir, version)
+    _prune(out_dir, keep, version)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export catalog endpoints as static JSON files.")
+    parser.add_argument('out_dir', nargs='?', default=SNAPSHOT['dir'],
+                        help="snapshot root (default: SNAPSHOT_DIR)")
+    parser.add_argument('--full', action='store_true',
+                        help="re-render every file instead of reusing unchanged ones")
+    parser.add_argument('--keep', type=int, default=SNAPSHOT['keep'],
+                        help=f"versions to keep (default {SNAPSHOT['keep']})")
+    args = parser.parse_args()
+    if not args.out_dir:
+        parser.error("an output directory is required (or set SNAPSHOT_DIR)")
+
+    try:
+        manifest = create_snapshot(args.out_dir, full=args.full, keep=args.keep)
+    except Exception as e:
+        print(f"Error exporting snapshot: {e}")
+        sys.exit(1)
+    stats = manifest['stats']
+    print(f"Snapshot {manifest['version']}: {stats['files']} files, {stats['written']} rendered, "
+          f"{stats['reused']} unchanged, {stats['bytes']} bytes written in {stats['seconds']:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
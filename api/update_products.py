@@ -1,78 +1,26 @@
 #!/usr/bin/env python3
 """
-Script to insert the missing products into the database.
+Script to insert the missing seed products (seed_products.jsonl) into the database.
 """
 import os
 import sys
-import psycopg2
-from main import mock_products
+from import_products import import_feed
 
-# Database connection configuration
-DB_HOST = os.environ.get('DB_HOST', 'localhost')
-DB_PORT = os.environ.get('DB_PORT', '5432')
-DB_NAME = os.environ.get('DB_NAME', 'bookstore')
-DB_USER = os.environ.get('DB_USER', 'postgres')
-DB_PASSWORD = os.environ.get('DB_PASSWORD', 'postgres')
-
-def get_db_connection():
-    """Create a database connection and return it"""
-    conn = psycopg2.connect(
-        host=DB_HOST,
-        port=DB_PORT,
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD
-    )
-    conn.autocommit = False
-    return conn
+SEED_FEED = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'seed_products.jsonl')
 
 def update_products():
     """Check for missing products and add them to the database"""
-    conn = get_db_connection()
     try:
-        with conn.cursor() as cur:
-            # Get existing product IDs
-            cur.execute('SELECT id FROM products')
-            existing_ids = {row[0] for row in cur.fetchall()}
-            
-            # Find missing products
-            missing_products = [p for p in mock_products if p['id'] not in existing_ids]
-            
-            if len(missing_products) > 0:
-                print(f"Found {len(missing_products)} missing products. Adding them...")
-                # Insert missing products
-                for product in missing_products:
-                    print(f"Adding product: {product['id']} - {product['name']}")
-                    try:
-                        cur.execute('''
-                        INSERT INTO products (id, name, author, price, category_id, category, 
-                                            description, image_url, pages, published) 
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                        ''', (
-                            product['id'], 
-                            product['name'],
-                            product['author'],
-                            product['price'],
-                            product['categoryId'],
-                            product['category'],
-                            product['description'],
-                            f"/api/images/books/{os.path.basename(product['imageUrl'])}" if product.get('imageUrl') else None,
-                            product.get('pages'),
-                            product.get('published')
-                        ))
-                        print(f"  Successfully added {product['id']} - {product['name']}")
-                    except Exception as e:
-                        print(f"  Error adding {product['id']} - {product['name']}: {e}")
-                
-                conn.commit()
-                print("Products updated successfully")
-            else:
-                print("All products are up to date.")
+        # Insert-only: products that already exist are left as they are
+        counts = import_feed(SEED_FEED, update=False)
     except Exception as e:
-        conn.rollback()
         print(f"Error updating products: {e}")
-    finally:
-        conn.close()
+        return
+
+    if counts['inserted']:
+        print(f"Added {counts['inserted']} missing products. Products updated successfully")
+    else:
+        print("All products are up to date.")
 
 if __name__ == "__main__":
     update_products()
@@ -59,10 +59,7 @@ pip install -r requirements.txt
 
 # Setup database
 echo "Setting up database..."
-python create_db.py
-PGPASSWORD=postgres psql -h localhost -U postgres -d bookstore -f db_setup.sql -v ON_ERROR_STOP=1 || echo "Database schema already exists"
-python update_products.py
-python check_db_schema.py
+python migrate.py
 
 # Set environment variables for API
 export DB_HOST=localhost
@@ -1,7 +1,7 @@
 // src/pages/Cart.js
 import React, { useState, useEffect } from 'react';
 import { Link } from 'react-router-dom';
-import { getBookCoverById } from '../utils/imageUtils';
+import { getBookCoverById, getThumbnailUrl } from '../utils/imageUtils';
 
 function Cart() {
   const [cartItems, setCartItems] = useState([]);
@@ -18,7 +18,8 @@ function Cart() {
       });
   }, []);
 
-  const updateQuantity = (itemId, newQuantity) => {
+  // Cart lines are addressed by product id on the API side
+  const updateQuantity = (productId, newQuantity) => {
     if (newQuantity < 1) return;
     
     // Updated to use relative URL
@@ -28,31 +29,58 @@ function Cart() {
         'Content-Type': 'application/json',
       },
       body: JSON.stringify({
-        itemId,
+        itemId: productId,
         quantity: newQuantity
       }),
-    }).then(() => {
-      setCartItems(cartItems.map(item => 
-        item.id === itemId ? {...item, quantity: newQuantity} : item
-      ));
-    });
+    })
+      .then(res => res.json())
+      .then(data => {
+        // The API returns the updated line, so no need to re-fetch the cart
+        if (data.item) {
+          setCartItems(items => items.map(item =>
+            item.product_id === productId ? data.item : item
+          ));
+        }
+      });
   };
 
-  const removeItem = (itemId) => {
+  const removeItem = (productId) => {
     // Updated to use relative URL
-    fetch(`/api/cart/remove/${itemId}`, { method: 'DELETE' })
+    fetch(`/api/cart/remove/${productId}`, { method: 'DELETE' })
       .then(() => {
-        setCartItems(cartItems.filter(item => item.id !== itemId));
+        setCartItems(items => items.filter(item => item.product_id !== productId));
       });
   };
 
+  // One key per checkout attempt, reused if the user retries after an
+  // error, so the order is never placed twice
+  const [checkoutKey, setCheckoutKey] = useState(null);
+
   const checkout = () => {
-    // Updated to use relative URL
-    fetch(`/api/cart/checkout`, { method: 'POST' })
-      .then(() => {
+    const key = checkoutKey || `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+    setCheckoutKey(key);
+    fetch(`/api/cart/checkout`, { method: 'POST', headers: { 'Idempotency-Key': key } })
+      .then(res => res.json().then(data => ({ ok: res.ok, data })))
+      .then(({ ok, data }) => {
+        if (!ok) {
+          if (data.items) {
+            // Out of stock: the cart changes, so the next attempt is a new checkout
+            setCheckoutKey(null);
+            const titles = data.items.map(short => {
+              const item = cartItems.find(i => i.product_id === short.product_id);
+              return `${item ? item.name : short.product_id} (${short.available} left)`;
+            });
+            alert(`Not enough stock for: ${titles.join(', ')}`);
+          } else {
+            alert(data.error || 'Checkout failed, please try again.');
+          }
+          return;
+        }
+        setCheckoutKey(null);
         setCartItems([]);
         alert('Thank you for your purchase!');
-      });
+      })
+      .catch(() => alert('Checkout failed, please try again.'));
   };
 
   const total = cartItems.reduce((sum, item) => sum + (item.price * item.quantity), 0);
@@ -77,7 +105,7 @@ function Cart() {
               <div key={item.id} className="cart-item">
                 <div className="item-image">
                   <img 
-                    src={getBookCoverById(item.image_url || item.product_id, item)}
+                    src={getThumbnailUrl(getBookCoverById(item.image_url || item.product_id, item), 100)}
                     alt={item.name}
                   />
                 </div>
@@ -87,14 +115,14 @@ function Cart() {
                   <p className="price">${item.price.toFixed(2)}</p>
                 </div>
                 <div className="item-quantity">
-                  <button onClick={() => updateQuantity(item.id, item.quantity - 1)}>−</button>
+                  <button onClick={() => updateQuantity(item.product_id, item.quantity - 1)}>−</button>
                   <span>{item.quantity}</span>
-                  <button onClick={() => updateQuantity(item.id, item.quantity + 1)}>+</button>
+                  <button onClick={() => updateQuantity(item.product_id, item.quantity + 1)}>+</button>
                 </div>
                 <div className="item-total">
                   ${(item.price * item.quantity).toFixed(2)}
                 </div>
-                <button className="remove-item" onClick={() => removeItem(item.id)}>
+                <button className="remove-item" onClick={() => removeItem(item.product_id)}>
                   <span className="material-icons">delete</span>
                 </button>
               </div>
@@ -1,7 +1,7 @@
 // src/pages/Home.js
 import React, { useState, useEffect } from 'react';
 import { Link } from 'react-router-dom';
-import { getBookCoverById } from '../utils/imageUtils';
+import { getBookCoverById, getThumbnailUrl } from '../utils/imageUtils';
 
 function Home() {
   const [categories, setCategories] = useState([]);
@@ -51,7 +51,7 @@ function Home() {
             <Link to={`/product/${book.id}`} key={book.id} className="book-card">
               <div className="book-cover">
                 <img 
-                  src={getBookCoverById(book.image_url || book.id, book)}
+                  src={getThumbnailUrl(getBookCoverById(book.image_url || book.id, book), 300)}
                   alt={book.name}
                 />
               </div>
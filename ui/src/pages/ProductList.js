@@ -1,7 +1,7 @@
 // src/pages/ProductList.js
 import React, { useState, useEffect } from 'react';
 import { Link, useParams } from 'react-router-dom';
-import { getBookCoverById } from '../utils/imageUtils';
+import { getBookCoverById, getThumbnailUrl } from '../utils/imageUtils';
 
 function ProductList() {
   const { categoryId } = useParams();
@@ -44,7 +44,7 @@ function ProductList() {
             <Link to={`/product/${book.id}`} key={book.id} className="book-card">
               <div className="book-cover">
                 <img 
-                  src={getBookCoverById(book.image_url || book.id, book)}
+                  src={getThumbnailUrl(getBookCoverById(book.image_url || book.id, book), 300)}
                   alt={book.name}
                 />
               </div>
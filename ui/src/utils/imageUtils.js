@@ -44,3 +44,19 @@ export function getBookCoverById(idOrImageUrl, bookData) {
     return logo;
   }
 }
+
+/**
+ * Ask the API for a resized cover instead of the full-size original.
+ *
+ * Only applies to images served by our API (/api/images/...); the API
+ * renders the variant once, caches it on disk and picks WebP/AVIF from the
+ * browser's Accept header. Other URLs (fallback logo, external) are
+ * returned unchanged.
+ */
+export function getThumbnailUrl(imageUrl, width) {
+  if (typeof imageUrl !== 'string' || !imageUrl.startsWith('/api/images/')) {
+    return imageUrl;
+  }
+  const separator = imageUrl.includes('?') ? '&' : '?';
+  return `${imageUrl}${separator}w=${width}`;
+}